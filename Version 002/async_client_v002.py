@@ -0,0 +1,404 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+import argparse
+import sys
+from collections import OrderedDict, deque
+
+
+def encode_frame(message):
+    """Serialise a message as one newline-terminated JSON frame"""
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+class ConnectionClosed(Exception):
+    """The client was closed, so a pending request will never be answered"""
+
+
+class AsyncChatClient:
+    """Headless asyncio client for a Whisper Chat server
+
+    Speaks the same protocol as ModernChatClient, without any UI:
+
+        client = AsyncChatClient("localhost", 9999, "bot")
+        await client.connect()
+        await client.send_message("hello")  # Resolves with the server's ack
+        async for event in client:
+            ...
+
+    send_message() only queues the frame and returns a future, so many sends
+    can be in flight at once; a writer task flushes whatever has queued up
+    with one drain. Incoming frames (messages, whispers, presence, system
+    notices...) are delivered through the async iterator. When the
+    connection drops it is re-established with jittered exponential
+    backoff, unacknowledged messages are resent (the server drops repeats
+    by client_id) and anything missed is fetched with history requests and
+    delivered as ordinary message events.
+
+    Each client is just a pair of tasks and a socket, so one process can run
+    thousands of them.
+    """
+
+    def __init__(self, host="localhost", port=9999, username="bot", reconnect=True,
+                 base_delay=1.0, max_delay=30.0, max_events=10000):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.reconnect = reconnect
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.connected = asyncio.Event()
+        self.closed = False
+        self.last_message_id = None
+        self.reconnects = 0
+
+        self.events = asyncio.Queue(maxsize=max_events)  # Oldest events are dropped once full
+        self.dropped_events = 0
+        self.outbox = deque()  # (encoded frame, resent from unacked anyway) waiting for the writer task
+        self.outbox_ready = asyncio.Event()
+        self.unacked = OrderedDict()  # {client_id: (frame, future)}
+        self.pending_history = deque()  # Futures for history requests, answered in order
+        self.catching_up = False
+        self.own_ids = set()  # Ids acked to us while catching up, left out of the catch-up
+        self.rtt = None  # Smoothed round-trip time from ping(), in seconds
+        self.rtt_var = None
+
+        self.reader = None
+        self.writer = None
+        self.tasks = []
+
+    async def connect(self):
+        """Connect and log in, raising if the server can't be reached"""
+        await self._open()
+        self.tasks = [
+            asyncio.ensure_future(self._read_loop()),
+            asyncio.ensure_future(self._write_loop()),
+        ]
+
+    async def _open(self):
+        # Let go of the dropped connection's transport before opening another
+        if self.writer is not None:
+            self.writer.close()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=1024 * 1024)
+
+        # After a reconnect, say what we saw last so the server skips the recent
+        # slice; the catch-up comes from history requests instead
+        connect_frame = {"type": "connect", "username": self.username}
+        if self.last_message_id is not None:
+            connect_frame["last_id"] = self.last_message_id
+        frames = [encode_frame(connect_frame)]
+
+        # Resends go before the catch-up request, so their acks name our own
+        # messages before the catch-up page arrives
+        frames.extend(encode_frame(frame) for frame, _ in self.unacked.values())
+        if self.last_message_id is not None:
+            self.catching_up = True
+            self.own_ids.clear()
+            frames.append(encode_frame({"type": "history", "after_id": self.last_message_id}))
+
+        self.writer.write(b"".join(frames))
+        await self.writer.drain()
+        self.connected.set()
+
+    # Sending
+
+    def send_message(self, content):
+        """Queue a chat message, returning a future resolved with its ack frame"""
+        client_id = uuid.uuid4().hex
+        frame = {"type": "message", "username": self.username, "content": content, "client_id": client_id}
+        future = asyncio.get_event_loop().create_future()
+        self.unacked[client_id] = (frame, future)
+        self._queue(frame, resendable=True)
+        return future
+
+    def whisper(self, to, content):
+        self._queue({"type": "whisper", "to": to, "content": content})
+
+    def history(self, before_id=None, after_id=None, limit=100):
+        """Request a page of history, returning a future resolved with the history frame"""
+        frame = {"type": "history", "limit": limit}
+        if before_id is not None:
+            frame["before_id"] = before_id
+        if after_id is not None:
+            frame["after_id"] = after_id
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending_history.append(future)
+        self._queue(frame)
+        return future
+
+    def ping(self):
+        """Time a round trip to the server, reporting the smoothed RTT measured so far"""
+        frame = {"type": "ping", "sent": asyncio.get_event_loop().time()}
+        if self.rtt is not None:
+            frame["rtt"] = self.rtt
+            frame["jitter"] = self.rtt_var
+        self._queue(frame)
+
+    def _queue(self, frame, resendable=False):
+        if self.closed:
+            raise ConnectionClosed("Client is closed")
+        self.outbox.append((encode_frame(frame), resendable))
+        self.outbox_ready.set()
+
+    async def _write_loop(self):
+        while not self.closed:
+            await self.outbox_ready.wait()
+            await self.connected.wait()
+            self.outbox_ready.clear()
+
+            # Everything queued since the last write goes out in one go
+            batch = []
+            while self.outbox:
+                batch.append(self.outbox.popleft())
+            if not batch:
+                continue
+
+            try:
+                self.writer.write(b"".join(data for data, _ in batch))
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                # Chat messages are resent from unacked after reconnecting; other
+                # frames go again too, in case they never left
+                self.outbox.extendleft(reversed([entry for entry in batch if not entry[1]]))
+                self.outbox_ready.set()
+                await asyncio.sleep(0)
+
+    # Receiving
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Next incoming frame; stops once the client is closed and everything is consumed"""
+        while True:
+            if self.closed and self.events.empty():
+                raise StopAsyncIteration
+            event = await self.events.get()
+            if event is None:
+                continue  # Wake-up from close()
+            return event
+
+    async def _read_loop(self):
+        while not self.closed:
+            try:
+                line = await self.reader.readline()
+                if not line:
+                    raise ConnectionResetError("Server closed the connection")
+                self._handle(json.loads(line))
+            except (ConnectionError, OSError, asyncio.IncompleteReadError, ValueError):
+                self.connected.clear()
+                if self.closed or not self.reconnect:
+                    break
+                await self._reconnect()
+
+        self.closed = True
+        self._fail_pending()
+        self._emit(None)
+
+    def _handle(self, message):
+        message_type = message.get("type")
+
+        if message_type == "message":
+            self._note_id(message.get("id"))
+        elif message_type == "ack":
+            self._note_id(message.get("id"))
+            if self.catching_up:
+                self.own_ids.add(message.get("id"))
+            entry = self.unacked.pop(message.get("client_id"), None)
+            if entry and not entry[1].done():
+                entry[1].set_result(message)
+            return
+        elif message_type == "history":
+            if message.get("retry_after") is not None:
+                # Rate limited: ask again once allowed, keeping our place in line
+                retry = {"type": "history"}
+                for key in ("before_id", "after_id"):
+                    if message.get(key) is not None:
+                        retry[key] = message[key]
+                asyncio.get_event_loop().call_later(message["retry_after"], self._queue, retry)
+                return
+            if self.catching_up and message.get("after_id") is not None and message.get("before_id") is None:
+                self._catch_up(message)
+                return
+            if self.pending_history:
+                future = self.pending_history.popleft()
+                if not future.done():
+                    future.set_result(message)
+            return
+        elif message_type == "ping":
+            # Answer the server's heartbeat with its own timestamp
+            self._queue({"type": "pong", "sent": message.get("sent")})
+            return
+        elif message_type == "pong":
+            if isinstance(message.get("sent"), (int, float)):
+                self._record_rtt(asyncio.get_event_loop().time() - message["sent"])
+            return
+
+        self._emit(message)
+
+    def _catch_up(self, message):
+        """Deliver missed messages after a reconnect as ordinary message events
+
+        Our own messages are known by their acked ids, not by username, as
+        other users may share our name.
+        """
+        for missed in message["messages"]:
+            self._note_id(missed["id"])
+            if missed["id"] not in self.own_ids:
+                self._emit(missed)
+
+        if message["has_more"]:
+            self._queue({"type": "history", "after_id": message["messages"][-1]["id"]})
+        else:
+            self.catching_up = False
+            self.own_ids.clear()
+
+    def _record_rtt(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+
+    def _note_id(self, message_id):
+        if message_id is not None and (self.last_message_id is None or message_id > self.last_message_id):
+            self.last_message_id = message_id
+
+    def _emit(self, event):
+        if self.events.full():
+            self.events.get_nowait()
+            self.dropped_events += 1
+        self.events.put_nowait(event)
+
+    async def _reconnect(self):
+        """Try until connected again, waiting a random time up to the capped exponential delay"""
+        attempt = 0
+        while not self.closed:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** min(attempt, 16)))
+            attempt += 1
+            await asyncio.sleep(delay)
+            try:
+                await self._open()
+            except (ConnectionError, OSError):
+                continue
+            self.reconnects += 1
+            self.outbox_ready.set()
+            return
+
+    def _fail_pending(self):
+        for _, future in self.unacked.values():
+            if not future.done():
+                future.set_exception(ConnectionClosed("Connection closed before the ack"))
+        for future in self.pending_history:
+            if not future.done():
+                future.set_exception(ConnectionClosed("Connection closed before the reply"))
+        self.pending_history.clear()
+
+    async def close(self):
+        """Say goodbye to the server and stop, failing anything still waiting for a reply"""
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.writer is not None and self.connected.is_set():
+            try:
+                self.writer.write(encode_frame({"type": "disconnect", "username": self.username}))
+                await self.writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            self.writer.close()
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        self._fail_pending()
+        self._emit(None)
+
+
+async def run_bot(index, args, latencies, stats):
+    """One load-test client: connect, send at a steady rate, record ack latency, leave"""
+    client = AsyncChatClient(args.host, args.port, f"{args.prefix}{index}")
+    await asyncio.sleep(random.uniform(0, args.ramp))  # Spread out the connects
+    try:
+        await client.connect()
+    except OSError:
+        stats["connect_errors"] += 1
+        return
+
+    # Read (and discard) incoming events so the server never sees a slow consumer
+    async def drain_events():
+        async for _ in client:
+            stats["events"] += 1
+    drain_task = asyncio.ensure_future(drain_events())
+
+    pending = []
+    for number in range(args.messages):
+        sent_at = time.perf_counter()
+        future = client.send_message(f"message {number} from {client.username}")
+        future.add_done_callback(
+            lambda done, sent_at=sent_at: latencies.append(time.perf_counter() - sent_at)
+            if not done.exception() else None
+        )
+        pending.append(future)
+        await asyncio.sleep(args.interval)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*pending), timeout=args.settle)
+    except (asyncio.TimeoutError, ConnectionClosed):
+        pass
+    stats["unacked"] += len(client.unacked)
+    stats["reconnects"] += client.reconnects
+
+    await client.close()
+    drain_task.cancel()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index] * 1000
+
+
+async def run_bots(args):
+    latencies = []
+    stats = {"connect_errors": 0, "events": 0, "unacked": 0, "reconnects": 0}
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_bot(index, args, latencies, stats) for index in range(args.clients)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"{args.clients} clients, {len(latencies)} messages acknowledged in {elapsed:.1f}s")
+    if latencies:
+        print(f"  ack latency    p50 {percentile(latencies, 0.50):.2f} ms, p90 {percentile(latencies, 0.90):.2f} ms, "
+              f"p99 {percentile(latencies, 0.99):.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    print(f"  events received {stats['events']}, unacknowledged {stats['unacked']}, "
+          f"connect errors {stats['connect_errors']}, reconnects {stats['reconnects']}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run many headless Whisper Chat clients from one process")
+    parser.add_argument("--host", default="localhost", help="Chat server address")
+    parser.add_argument("--port", type=int, default=9999, help="Chat server port")
+    parser.add_argument("--clients", type=int, default=100, help="Concurrent clients")
+    parser.add_argument("--messages", type=int, default=10, help="Messages each client sends")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between a client's messages")
+    parser.add_argument("--ramp", type=float, default=5.0, help="Seconds over which clients connect")
+    parser.add_argument("--settle", type=float, default=10.0, help="Seconds to wait for the last acks")
+    parser.add_argument("--prefix", default="bot", help="Username prefix")
+    args = parser.parse_args()
+
+    stats = asyncio.run(run_bots(args))
+    if stats["connect_errors"] or stats["unacked"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+import json
+import time
+import timeit
+import platform
+import argparse
+import tempfile
+import shutil
+import sys
+from collections import deque
+
+import server_v002
+from server_v002 import ChatServer, Session, OutboundQueue, FrameDecoder, encode_frame
+
+
+class NullSocket:
+    """Accepts and discards everything, so fan-out benchmarks measure the server and not the kernel"""
+
+    def sendall(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+# One of each frame the protocol carries, as the server or client would send it
+SAMPLE_FRAMES = {
+    "connect": {"type": "connect", "username": "alice"},
+    "message": {"type": "message", "id": 1234, "username": "alice",
+                "content": "Hello everyone, how is it going today?", "timestamp": 1700000000.123},
+    "whisper": {"type": "whisper", "from": "alice", "to": "bob",
+                "content": "Just between us", "timestamp": 1700000000.123, "echo": True},
+    "system": {"type": "system", "content": "Welcome to the chat! Here are the most recent messages.",
+               "timestamp": 1700000000.123},
+    "roster": {"type": "roster", "users": [f"user{i}" for i in range(100)], "online": 100,
+               "timestamp": 1700000000.123},
+    "presence": {"type": "presence", "joined": [f"user{i}" for i in range(10)], "left": ["user99"],
+                 "joined_count": 10, "left_count": 1, "online": 109, "timestamp": 1700000000.123},
+    "error": {"type": "error", "content": "bob is not online", "timestamp": 1700000000.123},
+    "ping": {"type": "ping"},
+    "disconnect": {"type": "disconnect", "username": "alice"},
+}
+
+
+class BenchServer:
+    """A ChatServer that is never started, with its log file and data kept in a temp dir"""
+
+    def __init__(self):
+        self.temp_dir = tempfile.mkdtemp(prefix="whisper_bench_")
+        self.server = ChatServer(host="bench", port=0, node_id="bench",
+                                 data_dir=self.temp_dir, logs_dir=self.temp_dir)
+
+        # Keep the file handler cost, but not the console's
+        self.server.logger.propagate = False
+
+    def populate(self, count):
+        for index in range(count):
+            session = Session(NullSocket(), f"user{index}", ("10.0.0.1", 40000 + index))
+            self.server.clients.add(session)
+        return self.server.clients.snapshot()
+
+    def fill_history(self):
+        for number in range(self.server.max_history):
+            self.server.record_message({
+                "type": "message", "username": "alice",
+                "content": f"history message {number}", "timestamp": time.time(),
+            })
+
+    def fill_logs(self, count):
+        self.server.max_logs = count
+        self.server.logs = deque(maxlen=count)
+        for number in range(count):
+            self.server.logs.append({
+                "timestamp": "2024-01-01 12:00:00", "type": "MESSAGE",
+                "message": f"user{number % 100}: log line {number}",
+            })
+
+    def close(self):
+        for handler in list(self.server.logger.handlers):
+            handler.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+# Benchmarks: each takes a fresh BenchServer and returns (callable, operations per call)
+
+def bench_broadcast(clients):
+    def setup(bench):
+        bench.populate(clients)
+        message = dict(SAMPLE_FRAMES["message"])
+        return (lambda: bench.server.broadcast(message)), 1
+    return setup
+
+
+def bench_broadcast_queued(clients):
+    """Fan-out through the outbound lanes, including the writer's side of each queue"""
+    def setup(bench):
+        sessions = bench.populate(clients)
+        for session in sessions:
+            session.queue = OutboundQueue(bench.server.lane_weights, bench.server.max_queue_bytes)
+        message = dict(SAMPLE_FRAMES["message"])
+
+        def run():
+            bench.server.broadcast(message)
+            for session in sessions:
+                lane, data = session.queue.pop()
+                session.queue.task_done(lane, len(data))
+        return run, 1
+    return setup
+
+
+def bench_broadcast_system(clients):
+    def setup(bench):
+        bench.populate(clients)
+        return (lambda: bench.server.broadcast_system_message("alice has joined the chat")), 1
+    return setup
+
+
+def bench_log_event(bench):
+    return (lambda: bench.server.log_event("MESSAGE", "alice: Hello everyone, how is it going today?")), 1
+
+
+def bench_record_message(bench):
+    # History is full, so every append also trims the oldest message
+    bench.fill_history()
+    server = bench.server
+    return (lambda: server.record_message({
+        "type": "message", "username": "alice", "content": "hello", "timestamp": 1700000000.123,
+    })), 1
+
+
+def bench_send_history(bench):
+    bench.fill_history()
+    session = bench.populate(1)[0]
+    return (lambda: bench.server.send_history(session)), 1
+
+
+def bench_encode(frame_type):
+    def setup(bench):
+        frame = SAMPLE_FRAMES[frame_type]
+        return (lambda: encode_frame(frame)), 1
+    return setup
+
+
+def bench_decode(frame_type):
+    def setup(bench):
+        data = encode_frame(SAMPLE_FRAMES[frame_type]) * 100
+        decoder = FrameDecoder()
+        return (lambda: decoder.feed(data)), 100
+    return setup
+
+
+def bench_status(log_count, clients=100):
+    def setup(bench):
+        bench.populate(clients)
+        bench.fill_logs(log_count)
+        return (lambda: json.dumps(bench.server.status_snapshot())), 1
+    return setup
+
+
+def bench_status_route(log_count, clients=100):
+    def setup(bench):
+        bench.populate(clients)
+        bench.fill_logs(log_count)
+        server_v002.chat_server = bench.server
+        client = server_v002.app.test_client()
+        return (lambda: client.get("/api/status").get_data()), 1
+    return setup
+
+
+def build_benchmarks():
+    benchmarks = {}
+    for clients in (10, 100, 1000, 10000):
+        benchmarks[f"broadcast[{clients}]"] = bench_broadcast(clients)
+    for clients in (100, 10000):
+        benchmarks[f"broadcast_queued[{clients}]"] = bench_broadcast_queued(clients)
+    for clients in (100, 10000):
+        benchmarks[f"broadcast_system[{clients}]"] = bench_broadcast_system(clients)
+    benchmarks["log_event"] = bench_log_event
+    benchmarks["record_message"] = bench_record_message
+    benchmarks["send_history"] = bench_send_history
+    for frame_type in SAMPLE_FRAMES:
+        benchmarks[f"encode[{frame_type}]"] = bench_encode(frame_type)
+        benchmarks[f"decode[{frame_type}]"] = bench_decode(frame_type)
+    for log_count in (1000, 10000, 100000):
+        benchmarks[f"status_snapshot[{log_count} logs]"] = bench_status(log_count)
+    for log_count in (1000, 100000):
+        benchmarks[f"api_status[{log_count} logs]"] = bench_status_route(log_count)
+    return benchmarks
+
+
+BENCHMARKS = build_benchmarks()
+
+
+def run_benchmark(setup, repeat, min_time):
+    """Time one benchmark, returning per-operation microseconds and the locks taken meanwhile"""
+    bench = BenchServer()
+    try:
+        function, operations = setup(bench)
+        timer = timeit.Timer(function)
+
+        # Pick a loop count that makes one repeat take at least min_time
+        loops = 1
+        while True:
+            elapsed = timer.timeit(loops)
+            if elapsed >= min_time:
+                break
+            loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9) * 1.2))
+
+        # Lock statistics cover the timed repeats only, not the calibration above
+        bench.server.reset_lock_stats()
+        times = sorted(timer.repeat(repeat, loops))
+        per_op = [t / loops / operations * 1e6 for t in times]
+        return {
+            "loops": loops,
+            "operations": repeat * loops * operations,
+            "min_us": per_op[0],
+            "median_us": per_op[len(per_op) // 2],
+            "max_us": per_op[-1],
+            "locks": bench.server.lock_report(),
+        }
+    finally:
+        bench.close()
+
+
+def compare_results(results, baseline, tolerance):
+    """Print the change in fastest time per benchmark, returning those that regressed
+
+    The fastest repeat is compared rather than the median; it is the least
+    disturbed by whatever else the machine was doing.
+    """
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            print(f"  {name:<34} {'':>12}    {result['min_us']:>12.3f} us  (new)")
+            continue
+
+        change = (result["min_us"] - previous["min_us"]) / previous["min_us"]
+        worse = change > tolerance
+        if worse:
+            regressions.append(name)
+
+        marker = "REGRESSION" if worse else ""
+        print(f"  {name:<34} {previous['min_us']:>12.3f} -> {result['min_us']:>12.3f} us  "
+              f"({change:+.1%}) {marker}")
+
+    return regressions
+
+
+def lock_usage(result):
+    """Per operation lock use in a result, by lock and function
+
+    Call sites carry line numbers, which move with unrelated edits, so they
+    are folded into the function they are in.
+    """
+    usage = {}
+    operations = result.get("operations")
+    for entry in result.get("locks", []) if operations else []:
+        key = f"{entry['lock']} {entry['site'].rsplit(':', 1)[0]}"
+        totals = usage.setdefault(key, {"acquisitions": 0.0, "wait_us": 0.0, "hold_us": 0.0})
+        totals["acquisitions"] += entry["acquisitions"] / operations
+        totals["wait_us"] += entry["wait_total_ms"] * 1000 / operations
+        totals["hold_us"] += entry["hold_total_ms"] * 1000 / operations
+    return usage
+
+
+def compare_locks(results, baseline, tolerance, floor_us):
+    """Print changes in lock use per operation, returning the benchmarks whose contention regressed
+
+    Taking a lock more often per operation always counts. Longer waits or
+    holds count once they grow by more than the tolerance and floor_us.
+    """
+    regressions = []
+
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None or "locks" not in previous:
+            continue
+
+        before, after = lock_usage(previous), lock_usage(result)
+        for key in sorted(set(before) | set(after)):
+            old = before.get(key, {"acquisitions": 0.0, "wait_us": 0.0, "hold_us": 0.0})
+            new = after.get(key, {"acquisitions": 0.0, "wait_us": 0.0, "hold_us": 0.0})
+
+            worse = new["acquisitions"] > old["acquisitions"] + 1e-9 or any(
+                new[field] - old[field] > max(old[field] * tolerance, floor_us)
+                for field in ("wait_us", "hold_us")
+            )
+            if worse and name not in regressions:
+                regressions.append(name)
+
+            if worse or new["acquisitions"] != old["acquisitions"]:
+                marker = "REGRESSION" if worse else ""
+                print(f"  {name:<34} {key:<36} "
+                      f"{old['acquisitions']:.2f} -> {new['acquisitions']:.2f} acq/op  "
+                      f"wait {old['wait_us']:.3f} -> {new['wait_us']:.3f} us  "
+                      f"hold {old['hold_us']:.3f} -> {new['hold_us']:.3f} us {marker}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the Whisper Chat server hot paths")
+    parser.add_argument("--filter", metavar="TEXT", help="Only run benchmarks whose name contains TEXT")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed repeats per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.2, help="Minimum seconds per repeat")
+    parser.add_argument("--save", metavar="PATH", help="Save the results as a baseline JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative slowdown allowed before a benchmark counts as a regression")
+    parser.add_argument("--lock-floor-us", type=float, default=1.0,
+                        help="Lock wait or hold growth per operation (us) ignored as noise when comparing")
+    parser.add_argument("--locks", action="store_true", help="Print lock use per operation for each benchmark")
+    args = parser.parse_args()
+
+    names = [name for name in BENCHMARKS if not args.filter or args.filter in name]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    results = {}
+    for name in names:
+        result = run_benchmark(BENCHMARKS[name], args.repeat, args.min_time)
+        results[name] = result
+        print(f"{name:<34} median {result['median_us']:>12.3f} us   min {result['min_us']:>12.3f} us")
+        if args.locks:
+            for key, usage in sorted(lock_usage(result).items()):
+                print(f"    {key:<40} {usage['acquisitions']:>8.2f} acq/op  "
+                      f"wait {usage['wait_us']:>9.3f} us  hold {usage['hold_us']:>9.3f} us")
+
+    report = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+        print(f"\nCompared with {args.compare} (fastest per operation):")
+        regressions = compare_results(results, baseline, args.tolerance)
+
+        print(f"\nLock use compared with {args.compare} (per operation, regressions and changed counts):")
+        lock_regressions = compare_locks(results, baseline, args.tolerance, args.lock_floor_us)
+
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed beyond {args.tolerance:.0%}")
+        if lock_regressions:
+            print(f"{len(lock_regressions)} benchmark(s) take locks more often or for longer")
+        if regressions or lock_regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
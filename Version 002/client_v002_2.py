@@ -1,12 +1,447 @@
 import socket
 import threading
 import json
+import codecs
 import sys
 import tkinter as tk
-from tkinter import ttk, scrolledtext, messagebox
+from tkinter import ttk, scrolledtext, messagebox, filedialog
 import time
 from datetime import datetime
 import os
+import uuid
+import queue
+import random
+import re
+import gzip
+import bisect
+import itertools
+import base64
+import hashlib
+from array import array
+from collections import Counter, OrderedDict, deque
+
+
+def encode_frame(message):
+    """Serialise a message as one newline-terminated JSON frame"""
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+class FrameDecoder:
+    """Split the byte stream from the server back into JSON messages"""
+
+    def __init__(self, max_frame_size=1024 * 1024):
+        self.max_frame_size = max_frame_size
+        self.buffer = ""
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+
+    def feed(self, data):
+        """Add received bytes, returning every message that is now complete"""
+        buffer = self.buffer + self._text.decode(data)
+        messages = []
+        pos = 0
+
+        while True:
+            # Skip the newline terminators between frames
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos == len(buffer):
+                break
+
+            try:
+                message, pos = self._json.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # A finished line that still doesn't parse is garbage, not a partial frame
+                if "\n" in buffer[pos:]:
+                    raise
+                break
+
+            messages.append(message)
+
+        self.buffer = buffer[pos:]
+        if len(self.buffer) > self.max_frame_size:
+            raise ValueError(f"Frame exceeds {self.max_frame_size} bytes")
+
+        return messages
+
+
+class ChatSearchIndex:
+    """Inverted index over the chat_history logs, searchable by word, sender and date
+
+    Every logged line is a document. Each word, and each sender as "@name",
+    maps to the ascending ids of the documents that contain it, so a query
+    only reads the lists for its own terms. The lists are kept delta-encoded,
+    which is also how they are saved, and each one is only decoded the first
+    time it is searched. Loading also indexes anything logged since the last save.
+    """
+
+    LINE = re.compile(r"\[(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\] (.*?): (.*)")
+    WORD = re.compile(r"\w+")
+
+    def __init__(self, logs_dir):
+        self.logs_dir = logs_dir
+        self.path = os.path.join(logs_dir, "search_index.json.gz")
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.pending = []  # Lines logged while loading, added once it finishes
+        self.reset()
+
+    def reset(self):
+        self.files = {}  # {log file name: [file number, bytes indexed]}
+        self.file_names = []
+        self.doc_file = array("I")  # Per document: file number...
+        self.doc_offset = array("Q")  # ...byte offset of its line...
+        self.doc_time = array("q")  # ...and when it was logged
+        self.packed = {}  # {term: [first document id, delta, ...]}
+        self.postings = {}  # {term: [document id, ...]}, decoded from packed when first searched
+        self.tails = {}  # {term: last document id}, for appending to packed
+        self.last_doc = {}  # {file number: id of its latest document}, for continuation lines
+        self.dirty = False
+
+    def load(self):
+        """Load the saved index, then catch up with the log files; run off the UI thread"""
+        try:
+            if os.path.exists(self.path):
+                with gzip.open(self.path, "rt", encoding="utf-8") as index_file:
+                    saved = json.load(index_file)
+                with self.lock:
+                    self.file_names = saved["file_names"]
+                    self.files = {name: [number, size] for number, (name, size)
+                                  in enumerate(zip(saved["file_names"], saved["file_sizes"]))}
+                    self.doc_file = array("I", saved["doc_file"])
+                    self.doc_offset = array("Q", itertools.accumulate(saved["doc_offset"]))
+                    self.doc_time = array("q", saved["doc_time"])
+                    self.packed = saved["postings"]
+        except Exception as e:
+            print(f"Error loading search index, rebuilding it: {e}")
+            with self.lock:
+                self.reset()
+
+        try:
+            for name in sorted(os.listdir(self.logs_dir)):
+                if name.startswith("chat_log_") and name.endswith(".txt"):
+                    self.index_file(name)
+        except Exception as e:
+            print(f"Error indexing chat history: {e}")
+
+        with self.lock:
+            for line in self.pending:
+                self._add(*line)
+            self.pending = []
+            self.ready.set()
+
+    def index_file(self, name):
+        """Index the complete lines a log file gained since it was last indexed"""
+        path = os.path.join(self.logs_dir, name)
+        with self.lock:
+            number, offset = self._file(name)
+
+        with open(path, "rb") as log_file:
+            log_file.seek(offset)
+            for raw in log_file:
+                if not raw.endswith(b"\n"):
+                    break  # Still being written; the writer adds it
+                text = raw.decode("utf-8", "replace").rstrip("\r\n")
+
+                with self.lock:
+                    match = self.LINE.match(text)
+                    if match:
+                        when = int(datetime(*map(int, match.group(1, 2, 3, 4, 5, 6))).timestamp())
+                        self._add_doc(number, offset, when, match.group(7), match.group(8))
+                    elif number in self.last_doc:
+                        # A message with line breaks carries on over several lines
+                        self._add_terms(self.last_doc[number], self.WORD.findall(text.lower()))
+                    offset += len(raw)
+                    self.files[name][1] = offset
+
+    def add(self, path, offset, timestamp, username, message, length):
+        """Index a line the log writer has just written at `offset` of `path`"""
+        line = (os.path.basename(path), offset, int(timestamp), username, message, length)
+        with self.lock:
+            if self.ready.is_set():
+                self._add(*line)
+            else:
+                self.pending.append(line)
+
+    def _add(self, name, offset, when, username, message, length):
+        number, indexed = self._file(name)
+        if offset < indexed:
+            return  # Already read from the file while loading
+        self._add_doc(number, offset, when, username, message)
+        self.files[name][1] = offset + length
+
+    def _file(self, name):
+        if name not in self.files:
+            self.files[name] = [len(self.file_names), 0]
+            self.file_names.append(name)
+        return self.files[name]
+
+    def _add_doc(self, number, offset, when, username, message):
+        doc = len(self.doc_file)
+        self.doc_file.append(number)
+        self.doc_offset.append(offset)
+        self.doc_time.append(when)
+        self.last_doc[number] = doc
+
+        # Whisper lines are logged as "alice -> bob (whisper)"; the sender is the first name
+        sender = username.split(" -> ")[0].lower()
+        self._add_terms(doc, self.WORD.findall(message.lower()) + [f"@{sender}"])
+
+    def _add_terms(self, doc, terms):
+        for term in set(terms):
+            packed = self.packed.setdefault(term, [])
+            tail = self.tails.get(term)
+            if tail is None:
+                tail = sum(packed) if packed else -1
+            if tail == doc:
+                continue  # A continuation line repeating a word
+
+            packed.append(doc - tail if packed else doc)
+            self.tails[term] = doc
+            if term in self.postings:
+                self.postings[term].append(doc)
+        self.dirty = True
+
+    def _postings(self, term):
+        postings = self.postings.get(term)
+        if postings is None:
+            packed = self.packed.get(term)
+            if not packed:
+                return []
+            postings = self.postings[term] = list(itertools.accumulate(packed))
+        return postings
+
+    def search(self, query, limit=100):
+        """Run a query, returning (total matches, [(timestamp, log line)] newest first)
+
+        Words must all appear; from:name, since:YYYY-MM-DD and until:YYYY-MM-DD narrow it down.
+        """
+        terms = []
+        since = until = None
+        for token in query.split():
+            key, _, value = token.partition(":")
+            if key == "from" and value:
+                terms.append(f"@{value.lower()}")
+            elif key == "since" and value:
+                since = datetime.strptime(value, "%Y-%m-%d").timestamp()
+            elif key == "until" and value:
+                until = datetime.strptime(value, "%Y-%m-%d").timestamp() + 86400
+            else:
+                terms.extend(self.WORD.findall(token.lower()))
+
+        with self.lock:
+            if terms:
+                # Walk the shortest list, looking each document up in the others
+                lists = sorted((self._postings(term) for term in set(terms)), key=len)
+                candidates = [doc for doc in lists[0] if all(self._contains(other, doc) for other in lists[1:])]
+            else:
+                candidates = range(len(self.doc_file))
+
+            matches = [
+                doc for doc in candidates
+                if (since is None or self.doc_time[doc] >= since) and (until is None or self.doc_time[doc] < until)
+            ]
+            found = [
+                (self.doc_time[doc], self.file_names[self.doc_file[doc]], self.doc_offset[doc])
+                for doc in reversed(matches[-limit:])
+            ]
+
+        results = []
+        for when, name, offset in found:
+            try:
+                with open(os.path.join(self.logs_dir, name), "rb") as log_file:
+                    log_file.seek(offset)
+                    results.append((when, log_file.readline().decode("utf-8", "replace").rstrip("\r\n")))
+            except OSError:
+                pass
+        return len(matches), results
+
+    @staticmethod
+    def _contains(postings, doc):
+        index = bisect.bisect_left(postings, doc)
+        return index < len(postings) and postings[index] == doc
+
+    def save(self):
+        """Write the index out compactly, if anything changed since it was loaded or saved"""
+        with self.lock:
+            if not self.ready.is_set() or not self.dirty:
+                return
+
+            offsets = self.doc_offset.tolist()
+            saved = {
+                "version": 1,
+                "file_names": self.file_names,
+                "file_sizes": [self.files[name][1] for name in self.file_names],
+                "doc_file": self.doc_file.tolist(),
+                "doc_offset": [offsets[0]] + [b - a for a, b in zip(offsets, offsets[1:])] if offsets else [],
+                "doc_time": self.doc_time.tolist(),
+                "postings": self.packed,
+            }
+
+            # Serialised under the lock, since packed lists keep growing
+            data = json.dumps(saved, separators=(",", ":")).encode("utf-8")
+            self.dirty = False
+
+        temp_path = self.path + ".tmp"
+        try:
+            with gzip.open(temp_path, "wb", compresslevel=1) as index_file:
+                index_file.write(data)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"Error saving search index: {e}")
+
+
+class ChatLogWriter:
+    """Appends chat history from a background thread through one open, buffered file
+
+    Callers only queue lines, so a slow disk never holds up receiving or
+    displaying messages. Buffered lines are written out every flush_interval
+    seconds and whenever flush() or close() is called. With `structured`,
+    each line also goes to a .jsonl file next to the text log, which is
+    quicker to load back than parsing the text format. Lines written are
+    also added to `index`, a ChatSearchIndex, if there is one.
+    """
+
+    def __init__(self, flush_interval=1.0, structured=True, index=None):
+        self.flush_interval = flush_interval
+        self.structured = structured
+        self.index = index
+        self.queue = queue.Queue()
+        self.text_file = None
+        self.text_path = None
+        self.text_offset = 0  # Bytes in the text log, so the index knows where each line starts
+        self.json_file = None
+
+        writer_thread = threading.Thread(target=self.run)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def open(self, path, header=""):
+        """Switch to a new log file at `path`, starting it with `header`"""
+        self.queue.put(("open", path, header))
+
+    def write(self, username, message, timestamp=None):
+        self.queue.put(("line", username, message, time.time() if timestamp is None else timestamp))
+
+    def flush(self, timeout=5.0):
+        """Write out everything queued so far, returning once it has reached the files"""
+        done = threading.Event()
+        self.queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def save_index(self):
+        """Save the search index in the background"""
+        self.queue.put(("save",))
+
+    def close(self, timeout=5.0):
+        done = threading.Event()
+        self.queue.put(("close", done))
+        return done.wait(timeout)
+
+    def run(self):
+        last_flush = time.monotonic()
+        dirty = False
+
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval if dirty else None)
+            except queue.Empty:
+                item = None
+
+            try:
+                if item is None:
+                    pass
+                elif item[0] == "line":
+                    self.write_line(*item[1:])
+                    dirty = True
+                elif item[0] == "open":
+                    self.close_files()
+                    self.open_files(item[1], item[2])
+                    dirty = True
+                elif item[0] == "flush":
+                    dirty = True
+                    last_flush = 0.0
+                elif item[0] == "save":
+                    if self.index is not None:
+                        self.index.save()
+                elif item[0] == "close":
+                    self.close_files()
+                    dirty = False
+                    if self.index is not None:
+                        self.index.save()
+
+                # Steady traffic never lets get() time out, so check the clock too
+                if dirty and time.monotonic() - last_flush >= self.flush_interval:
+                    self.flush_files()
+                    dirty = False
+                    last_flush = time.monotonic()
+            except Exception as e:
+                print(f"Error writing to log file: {e}")
+            finally:
+                if item is not None and item[0] in ("flush", "close"):
+                    item[1].set()
+
+    def open_files(self, path, header):
+        self.text_offset = os.path.getsize(path) if os.path.exists(path) else 0
+        self.text_file = open(path, "a", encoding="utf-8", buffering=64 * 1024)
+        self.text_path = path
+        self.text_file.write(header)
+        self.text_offset += self.encoded_length(header)
+        if self.structured:
+            json_path = os.path.splitext(path)[0] + ".jsonl"
+            self.json_file = open(json_path, "a", encoding="utf-8", buffering=64 * 1024)
+
+    def write_line(self, username, message, timestamp):
+        if self.text_file is None:
+            return
+
+        stamp = datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S")
+        line = f"[{stamp}] {username}: {message}\n"
+        self.text_file.write(line)
+
+        length = self.encoded_length(line)
+        if self.index is not None:
+            self.index.add(self.text_path, self.text_offset, timestamp, username, message, length)
+        self.text_offset += length
+        if self.json_file is not None:
+            self.json_file.write(json.dumps({"time": timestamp, "username": username, "content": message}) + "\n")
+
+    @staticmethod
+    def encoded_length(text):
+        """Bytes `text` takes on disk, where text mode writes os.linesep for each newline"""
+        return len(text.replace("\n", os.linesep).encode("utf-8"))
+
+    def flush_files(self):
+        for log_file in (self.text_file, self.json_file):
+            if log_file is not None:
+                log_file.flush()
+
+    def close_files(self):
+        for log_file in (self.text_file, self.json_file):
+            if log_file is not None:
+                log_file.close()
+        self.text_file = None
+        self.json_file = None
+
+
+class FileTransfer:
+    """A file being uploaded or downloaded, with its progress bar under the messages"""
+
+    def __init__(self, transfer_id, path, name, size, sha256, verb):
+        self.transfer_id = transfer_id
+        self.path = path  # The file to send, or where a download ends up
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.verb = verb  # "Uploading" or "Downloading", for the progress label
+        self.done_bytes = 0  # Acknowledged by the server, or written to disk
+        self.sent = 0  # Uploads: sent on this connection, up to a window ahead of done_bytes
+        self.window = 0  # Uploads: set by the server once it accepts the file
+        self.finished = False
+        self.error = None
+        self.row = None  # Progress widgets, made on the UI thread
+        self.label = None
+        self.bar = None
 
 
 class ModernChatClient:
@@ -17,12 +452,82 @@ class ModernChatClient:
         self.username = None
         self.connected = False
         self.message_history = []
+        self.online_users = Counter()  # {username: sessions online}
+        self.online_count = 0  # The server's total; presence frames only name the first few
+
+        # Sent messages the server hasn't acknowledged yet, resent after reconnecting.
+        # The server drops repeats of a client_id, so resending never duplicates
+        self.unacked = OrderedDict()  # {client_id: frame}
+        self.unacked_lock = threading.Lock()
+        self.max_unacked = 100
+
+        # Display updates from any thread are queued here and applied by one
+        # periodic UI pump, so a busy room costs one widget update per frame
+        self.ui_queue = queue.SimpleQueue()
+        self.ui_interval_ms = 16  # About 60 Hz
+        self.max_lines_per_pump = 500  # The rest waits for the next frame, keeping typing responsive
+
+        # The message area only holds the most recent lines; older ones move to a
+        # bounded in-memory store and are paged back in when scrolled to the top.
+        # Each line is [[(text, tag), ...], mark]
+        self.max_display_lines = 2000
+        self.trim_batch = 500  # Trim in batches, not a line at a time
+        self.page_size = 200
+        self.shown_lines = deque()
+        self.scrollback = deque(maxlen=100000)
+        self.pending_marks = {}  # {mark: line} for sent lines awaiting their delivery tick
+        self.paging = False
+
+        # Server message ids seen so far. Once the local store runs out, scrolling
+        # up asks the server for the page before the oldest, and reconnecting
+        # asks for everything after the newest
+        self.oldest_message_id = None
+        self.last_message_id = None
+        self.history_exhausted = False  # The server has nothing older
+        self.catchup_seen = None  # Ids shown live or acked as ours while catching up, None when not
+        self.caught_up = 0
+
+        # A dropped connection is retried in the background with capped exponential
+        # backoff and full jitter, so clients cut off by a server restart don't all
+        # come back at the same moment. Set stop_reconnecting to give up
+        self.reconnect_base_delay = 1.0  # Seconds
+        self.reconnect_max_delay = 30.0
+        self.reconnect_stable_after = 10.0  # Seconds up before the backoff starts over
+        self.reconnect_attempts = 0
+        self.stop_reconnecting = threading.Event()
+        self.connected_at = 0.0
+        self.offline_whispers = []  # Whisper frames typed while disconnected
+
+        # Both ends ping with a timestamp that the pong echoes back. Our round trip
+        # is smoothed as TCP does and reported to the server with each ping
+        self.ping_interval = 15.0  # Seconds
+        self.rtt = None  # Smoothed round-trip time to the server, in seconds
+        self.rtt_var = None  # Its mean deviation (jitter)
+
+        # Files go up in chunks on the chat connection, never more than the
+        # server's window ahead of its acks, with chat frames sent in between.
+        # Downloads use a connection of their own and resume from a .part file
+        self.send_lock = threading.Lock()  # Frames are written whole, one at a time
+        self.transfer_lock = threading.Condition()
+        self.uploads = OrderedDict()  # {transfer_id: FileTransfer}
+        self.downloads = {}  # {file id: FileTransfer}
+        self.shared_files = {}  # {file id: file info} for the download links on screen
+        self.file_chunk_size = 16 * 1024
+        self.transfers_frame = None
+        self.downloads_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
 
         # Create logs directory for saving chat history
         self.logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_history")
         if not os.path.exists(self.logs_dir):
             os.makedirs(self.logs_dir)
 
+        # Saved chat logs are indexed for searching; loading the index may take a moment
+        self.search_index = ChatSearchIndex(self.logs_dir)
+        self.log_writer = ChatLogWriter(index=self.search_index)
+        index_thread = threading.Thread(target=self.search_index.load)
+        index_thread.daemon = True
+        index_thread.start()
+
         # Set up the main window
         self.root = tk.Tk()
         self.root.title("Whisper Chat")
@@ -38,7 +543,8 @@ class ModernChatClient:
             "text_muted": "#a7a7a7",
             "sent_msg": "#3b7ebd",
             "received_msg": "#404040",
-            "system_msg": "#5c6bc0"
+            "system_msg": "#5c6bc0",
+            "whisper_msg": "#ce93d8"
         }
 
         # Configure styles
@@ -56,11 +562,13 @@ class ModernChatClient:
                        background=[('active', self.colors["accent"])])
 
         self.create_login_ui()
+        self.root.after(self.ui_interval_ms, self.pump_ui)
 
     def create_login_ui(self):
         # Clear any existing widgets
         for widget in self.root.winfo_children():
             widget.destroy()
+        self.message_area = None  # Holds queued lines until the chat view is back
 
         # Create a frame for login
         login_frame = ttk.Frame(self.root, style='TFrame')
@@ -197,6 +705,14 @@ class ModernChatClient:
         self.chat_frame = ttk.Frame(main_container)
         self.chat_frame.pack(fill=tk.BOTH, expand=True)
 
+        # Progress bars for file transfers; takes no room while there are none
+        self.transfers_frame = ttk.Frame(main_container)
+        self.transfers_frame.pack(fill=tk.X)
+        with self.transfer_lock:
+            transfers = list(self.uploads.values()) + list(self.downloads.values())
+        for transfer in transfers:
+            self.show_transfer(transfer)
+
         # Create and configure the message display area
         self.message_area = scrolledtext.ScrolledText(
             self.chat_frame,
@@ -210,6 +726,12 @@ class ModernChatClient:
             state=tk.DISABLED
         )
         self.message_area.pack(fill=tk.BOTH, expand=True)
+        self.message_area.config(yscrollcommand=self.on_message_scroll)
+        self.configure_tags()
+
+        # A fresh view after reconnecting; what was on screen can still be paged back in
+        self.scrollback.extend(self.shown_lines)
+        self.shown_lines.clear()
 
         # Input area
         input_frame = ttk.Frame(main_container)
@@ -239,6 +761,15 @@ class ModernChatClient:
         )
         self.send_button.pack(side=tk.RIGHT, padx=(10, 0))
 
+        # Attach button
+        attach_button = ttk.Button(
+            input_frame,
+            text="Attach",
+            command=self.attach_file,
+            width=10
+        )
+        attach_button.pack(side=tk.RIGHT, padx=(10, 0))
+
         # Status bar
         status_frame = ttk.Frame(main_container)
         status_frame.pack(fill=tk.X, pady=(5, 0))
@@ -265,12 +796,22 @@ class ModernChatClient:
         )
         self.disconnect_button.pack(side=tk.RIGHT)
 
+        # Search button
+        search_button = ttk.Button(
+            status_frame,
+            text="Search",
+            command=self.open_search_window,
+            width=10
+        )
+        search_button.pack(side=tk.RIGHT, padx=(0, 5))
+
         # Bind Enter key to send message
         self.message_entry.bind('<Return>', self.handle_return)
 
         # Show welcome message
         self.display_system_message(f"Welcome to Whisper Chat, {self.username}!")
         self.display_system_message(f"Connected to {self.host}:{self.port}")
+        self.display_system_message("Type /w <username> <message> to whisper privately")
 
     def handle_return(self, event):
         # Don't add newline when Enter is pressed
@@ -301,34 +842,157 @@ class ModernChatClient:
 
     def connect(self):
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
-
-            # Send username to server
-            self.socket.send(
-                json.dumps({"type": "connect", "username": self.username}).encode("utf-8")
-            )
-
-            # Start thread to receive messages
-            self.connected = True
-            receive_thread = threading.Thread(target=self.receive_messages)
-            receive_thread.daemon = True
-            receive_thread.start()
-
-            # Update UI
-            self.root.after(0, self.create_chat_ui)
-
-            # Create a chat log file
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            self.log_file_path = os.path.join(self.logs_dir, f"chat_log_{timestamp}.txt")
-            with open(self.log_file_path, "a", encoding="utf-8") as log_file:
-                log_file.write(f"=== Chat session started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===\n")
-                log_file.write(f"Connected to {self.host}:{self.port} as {self.username}\n\n")
-
+            sock = socket.create_connection((self.host, self.port), timeout=10)
         except Exception as e:
             error_message = f"Connection error: {e}"
             print(error_message)
             self.root.after(0, lambda: self.status_label.config(text=error_message))
+            return
+
+        self.stop_reconnecting.clear()
+        self.reconnect_attempts = 0
+
+        # Start a chat log file before anything received needs saving to it
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.log_file_path = os.path.join(self.logs_dir, f"chat_log_{timestamp}.txt")
+        self.log_writer.open(
+            self.log_file_path,
+            f"=== Chat session started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')} ===\n"
+            f"Connected to {self.host}:{self.port} as {self.username}\n\n",
+        )
+
+        # Build the chat UI before anything received can be displayed in it
+        self.root.after(0, self.create_chat_ui)
+
+        try:
+            self.start_session(sock)
+        except Exception as e:
+            self.display_system_message(f"Connection error: {e}")
+            self.connection_lost(sock)
+
+    def start_session(self, sock):
+        """Log in on a newly connected socket and start receiving, resuming where we left off"""
+        sock.settimeout(None)
+        self.socket = sock
+
+        # Send username to server. After a reconnect, say what we saw last so the
+        # server skips the recent slice and we catch up with history requests
+        connect_frame = {"type": "connect", "username": self.username}
+        if self.last_message_id is not None:
+            connect_frame["last_id"] = self.last_message_id
+        self.send_frame(connect_frame, sock)
+        self.connected = True
+        self.connected_at = time.time()
+        self.paging = False
+        self.rtt = self.rtt_var = None  # The route may have changed
+
+        if self.last_message_id is not None:
+            self.catchup_seen = set()
+            self.caught_up = 0
+
+        # Anything that never got through last time goes out again now. Before the
+        # catch-up request, so the acks name our own messages before the page arrives
+        resent = self.resend_unacked()
+        if self.last_message_id is not None:
+            self.request_history(after_id=self.last_message_id)
+        whispers, self.offline_whispers = self.offline_whispers, []
+        for frame in whispers:
+            self.send_frame(frame, sock)
+        self.offer_uploads(sock)
+
+        # Start thread to receive messages
+        receive_thread = threading.Thread(target=self.receive_messages, args=(sock,))
+        receive_thread.daemon = True
+        receive_thread.start()
+
+        heartbeat_thread = threading.Thread(target=self.heartbeat_loop, args=(sock,))
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        if resent:
+            self.display_system_message(f"Resent {resent} message(s) that were not delivered")
+
+    def send_frame(self, frame, sock=None):
+        """Write one whole frame, so a file chunk from another thread can't split it"""
+        data = encode_frame(frame)
+        with self.send_lock:
+            (sock or self.socket).sendall(data)
+
+    def heartbeat_loop(self, sock):
+        """Ping the server while this socket is current, reporting the round trip measured so far"""
+        while not self.stop_reconnecting.wait(self.ping_interval):
+            if not self.connected or sock is not self.socket:
+                return
+
+            frame = {"type": "ping", "sent": time.monotonic()}
+            if self.rtt is not None:
+                frame["rtt"] = self.rtt
+                frame["jitter"] = self.rtt_var
+            try:
+                self.send_frame(frame, sock)
+            except OSError:
+                return  # The receive loop notices and reconnects
+
+    def record_rtt(self, sample):
+        """Fold one round-trip sample into the smoothed RTT and jitter"""
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+
+    def connection_lost(self, sock):
+        """Called once a session's socket has failed, to start reconnecting unless the user left"""
+        if sock is not self.socket:
+            return  # Already replaced by a newer connection
+
+        self.connected = False
+        try:
+            sock.close()
+        except:
+            pass
+
+        if self.stop_reconnecting.is_set():
+            return
+        if time.time() - self.connected_at >= self.reconnect_stable_after:
+            self.reconnect_attempts = 0
+
+        reconnect_thread = threading.Thread(target=self.reconnect_loop)
+        reconnect_thread.daemon = True
+        reconnect_thread.start()
+
+    def reconnect_loop(self):
+        """Keep trying to reach the server again, backing off between attempts"""
+        while not self.stop_reconnecting.is_set():
+            # Full jitter: anywhere up to the capped exponential delay
+            ceiling = min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** min(self.reconnect_attempts, 16))
+            delay = random.uniform(0, ceiling)
+            self.reconnect_attempts += 1
+
+            self.post(lambda delay=delay: self.status_text.set(
+                f"Disconnected from server \u2014 reconnecting in {delay:.0f}s"
+            ))
+            if self.stop_reconnecting.wait(delay):
+                return
+
+            try:
+                sock = socket.create_connection((self.host, self.port), timeout=10)
+            except OSError:
+                continue
+
+            if self.stop_reconnecting.is_set():
+                sock.close()
+                return
+
+            self.display_system_message("Reconnected to server")
+            self.save_to_log("SYSTEM", "Reconnected to server")
+            try:
+                self.start_session(sock)
+            except OSError as e:
+                self.display_system_message(f"Connection error: {e}")
+                self.connection_lost(sock)
+            return
 
     def send_message_ui(self):
         # Get message from the text widget
@@ -338,133 +1002,840 @@ class ModernChatClient:
             # Clear the message entry
             self.message_entry.delete("1.0", tk.END)
 
-            # Display the message
-            self.display_sent_message(self.username, message)
+            # Whispers are shown once the server confirms delivery
+            if message.startswith("/w ") or message == "/w":
+                self.send_whisper(message)
+                return
+
+            # Display the message, marked delivered once the server acks its id
+            client_id = uuid.uuid4().hex
+            self.display_sent_message(self.username, message, client_id)
 
             # Send the message
-            self.send_message(message)
+            self.send_message(message, client_id)
 
             # Save to history
             self.save_to_log(self.username, message)
 
-    def send_message(self, message):
-        if not message or not self.connected:
+    def send_message(self, message, client_id=None):
+        if not message:
+            return
+
+        frame = {
+            "type": "message",
+            "username": self.username,
+            "content": message,
+            "client_id": client_id,
+        }
+
+        # Keep it until acknowledged so a dropped connection doesn't lose it
+        if client_id:
+            with self.unacked_lock:
+                self.unacked[client_id] = frame
+                if len(self.unacked) > self.max_unacked:
+                    _, oldest = self.unacked.popitem(last=False)
+                    self.display_system_message(f"Gave up resending: {oldest['content'][:40]}")
+
+        if not self.connected:
+            self.display_system_message("Not connected; the message will be sent after reconnecting")
             return
 
         try:
-            self.socket.send(
-                json.dumps(
-                    {"type": "message", "username": self.username, "content": message}
-                ).encode("utf-8")
-            )
+            self.send_frame(frame)
         except Exception as e:
-            self.display_system_message(f"Error sending message: {e}")
+            self.display_system_message(f"Error sending message, it will be resent after reconnecting: {e}")
+
+    def resend_unacked(self):
+        """Send every unacknowledged message again, returning how many went out"""
+        with self.unacked_lock:
+            # Only messages written under the name we are connected as
+            frames = [frame for frame in self.unacked.values() if frame["username"] == self.username]
+
+        for frame in frames:
+            self.send_frame(frame)
+        return len(frames)
+
+    def send_whisper(self, command):
+        # "/w <username> <message>"
+        parts = command.split(None, 2)
+        if len(parts) < 3:
+            self.display_system_message("Usage: /w <username> <message>")
+            return
+
+        _, recipient, content = parts
+        frame = {"type": "whisper", "to": recipient, "content": content}
+
+        if not self.connected:
+            self.offline_whispers.append(frame)
+            self.display_system_message("Not connected; the whisper will be sent after reconnecting")
+            return
 
-    def receive_messages(self):
-        while self.connected:
+        try:
+            self.send_frame(frame)
+        except Exception as e:
+            self.display_system_message(f"Error sending whisper: {e}")
+
+    def receive_messages(self, sock):
+        decoder = FrameDecoder()
+
+        while self.connected and sock is self.socket:
             try:
-                data = self.socket.recv(4096)
+                data = sock.recv(65536)
                 if not data:
-                    self.root.after(0, lambda: self.display_system_message("Disconnected from server"))
-                    self.connected = False
+                    if sock is self.socket:
+                        self.display_system_message("Disconnected from server")
                     break
 
-                message = json.loads(data.decode("utf-8"))
-
-                if message["type"] == "message":
-                    # Don't display our own messages (already displayed when sent)
-                    if message["username"] != self.username:
-                        self.root.after(0, lambda msg=message: self.display_received_message(
-                            msg["username"], msg["content"]
-                        ))
-                        self.save_to_log(message["username"], message["content"])
-
-                elif message["type"] == "system":
-                    self.root.after(0, lambda msg=message: self.display_system_message(
-                        msg["content"]
-                    ))
-                    self.save_to_log("SYSTEM", message["content"])
+                for message in decoder.feed(data):
+                    self.handle_server_message(message)
 
             except Exception as e:
-                self.root.after(0, lambda e=e: self.display_system_message(f"Error receiving message: {e}"))
-                self.connected = False
+                if sock is self.socket:
+                    self.display_system_message(f"Error receiving message: {e}")
                 break
 
-        # Try to reconnect or show reconnect button
-        self.root.after(0, lambda: self.status_text.set("Disconnected from server"))
+        # Try to get back, unless the user disconnected
+        self.connection_lost(sock)
+
+    def handle_server_message(self, message):
+        if message["type"] == "message":
+            self.note_message_id(message.get("id"))
+            if self.catchup_seen is not None:
+                self.catchup_seen.add(message.get("id"))
+
+            # The server never echoes our own messages back, so everything here is someone else's
+            self.display_received_message(message["username"], message["content"], message.get("file"))
+            self.save_to_log(message["username"], message["content"])
+
+        elif message["type"] == "ack":
+            self.note_message_id(message.get("id"))
+            if self.catchup_seen is not None:
+                self.catchup_seen.add(message.get("id"))
+            if message.get("client_id"):
+                with self.unacked_lock:
+                    self.unacked.pop(message["client_id"], None)
+                self.post(lambda client_id=message["client_id"]: self.mark_delivered(client_id))
+
+        elif message["type"] == "whisper":
+            if message.get("echo"):
+                label = f"You \u2192 {message['to']}"
+            else:
+                label = f"{message['from']} \u2192 you"
+            self.display_whisper_message(label, message["content"])
+            self.save_to_log(f"{message['from']} -> {message['to']} (whisper)", message["content"])
+
+        elif message["type"] == "roster":
+            self.online_users = Counter(message["users"])
+            self.online_count = message["online"]
+            self.post(self.update_online_status)
+
+        elif message["type"] == "presence":
+            self.online_users.update(message["joined"])
+            self.online_users.subtract(message["left"])
+            self.online_users = +self.online_users  # Drop users whose count hit zero
+            self.online_count = message["online"]
+
+            summary = self.format_presence(message)
+            if summary:
+                self.display_system_message(summary)
+                self.save_to_log("SYSTEM", summary)
+            self.post(self.update_online_status)
+
+        elif message["type"] == "error":
+            self.display_system_message(f"Error: {message['content']}")
+
+        elif message["type"] == "system":
+            self.display_system_message(message["content"])
+            self.save_to_log("SYSTEM", message["content"])
+
+        elif message["type"] == "history":
+            self.handle_history(message)
+
+        elif message["type"] == "ping":
+            # Answer the server's heartbeat, echoing its timestamp so it can time the round trip
+            pong = {"type": "pong"}
+            if "sent" in message:
+                pong["sent"] = message["sent"]
+            try:
+                self.send_frame(pong)
+            except OSError:
+                pass
 
-    def display_sent_message(self, username, content):
-        self.message_area.config(state=tk.NORMAL)
+        elif message["type"] == "file_accept":
+            self.handle_file_progress(message, resume=True)
 
-        # Format timestamp
-        timestamp = datetime.now().strftime("%H:%M")
+        elif message["type"] == "file_ack":
+            self.handle_file_progress(message)
+
+        elif message["type"] == "file_error":
+            self.handle_file_error(message)
+
+        elif message["type"] == "pong":
+            if isinstance(message.get("sent"), (int, float)):
+                self.record_rtt(time.monotonic() - message["sent"])
+                self.post(self.update_online_status)
+
+    def note_message_id(self, message_id):
+        if message_id is None:
+            return
+        if self.oldest_message_id is None or message_id < self.oldest_message_id:
+            self.oldest_message_id = message_id
+        if self.last_message_id is None or message_id > self.last_message_id:
+            self.last_message_id = message_id
+
+    def request_history(self, before_id=None, after_id=None):
+        """Ask the server for the page of messages before `before_id` or after `after_id`"""
+        frame = {"type": "history", "limit": self.page_size}
+        if before_id is not None:
+            frame["before_id"] = before_id
+        if after_id is not None:
+            frame["after_id"] = after_id
 
-        # Insert message with username in bold and message bubble styling
-        self.message_area.insert(tk.END, f"\n{timestamp} ", "timestamp")
-        self.message_area.insert(tk.END, f"{username}: ", "sent_user")
-        self.message_area.insert(tk.END, f"{content}\n", "sent_msg")
+        try:
+            self.send_frame(frame)
+        except Exception as e:
+            self.display_system_message(f"Error requesting history: {e}")
+
+    def handle_history(self, message):
+        """Show a page of history: missed messages at the bottom, or older ones at the top"""
+        if message.get("retry_after") is not None:
+            # Asked too often; try the same page again once allowed
+            delay_ms = int(message["retry_after"] * 1000) + 1
+            self.post(lambda: self.root.after(delay_ms, lambda: self.request_history(
+                message["before_id"], message["after_id"]
+            )))
+            return
 
-        # Apply tags for styling
+        messages = message["messages"]
+        for msg in messages:
+            self.note_message_id(msg["id"])
+
+        if message["after_id"] is not None:
+            # Catching up after a reconnect. Skip what was shown live, and our own
+            # messages (known by their acks, as others may share our name)
+            seen = self.catchup_seen or ()
+            for msg in messages:
+                if msg["id"] in seen:
+                    continue
+                self.caught_up += 1
+                self.post_line(self.history_segments(msg))
+                self.save_to_log(msg["username"], msg["content"], msg["timestamp"])
+
+            if message["has_more"] and self.connected:
+                self.request_history(after_id=messages[-1]["id"])
+                return
+            if self.caught_up:
+                self.display_system_message(f"Caught up on {self.caught_up} missed message(s)")
+            self.catchup_seen = None
+        else:
+            # An older page for scrolling up
+            if not message["has_more"]:
+                self.history_exhausted = True
+            page = [[self.history_segments(msg), None] for msg in messages]
+            self.post(lambda: self.insert_older_lines(page))
+
+    def history_segments(self, message):
+        """Line segments for a chat message from history, stamped with its original time"""
+        timestamp = datetime.fromtimestamp(message["timestamp"]).strftime("%H:%M")
+        own = message["username"] == self.username
+        return [
+            (f"\n{timestamp} ", "timestamp"),
+            (f"{message['username']}: ", "sent_user" if own else "recv_user"),
+            *self.content_segments(message["content"], "sent_msg" if own else "recv_msg", message.get("file")),
+        ]
+
+    def content_segments(self, content, tag, file=None):
+        """The text of a message, followed by a download link if it shares a file"""
+        if not file:
+            return [(f"{content}\n", tag)]
+        self.shared_files[file["id"]] = file
+        return [(content, tag), ("  Download", ("file_link", f"file_{file['id']}")), ("\n", tag)]
+
+    def format_presence(self, message):
+        """Summarise a batched presence update, e.g. +12 joined (a, b, ...), -3 left (c)"""
+        parts = []
+        for verb, names_key, count_key, sign in (
+            ("joined", "joined", "joined_count", "+"),
+            ("left", "left", "left_count", "\u2212"),
+        ):
+            # Our own arrival is already obvious to us
+            names = [name for name in message[names_key] if name != self.username]
+            count = message[count_key] - (len(message[names_key]) - len(names))
+            if count <= 0:
+                continue
+
+            names = names[:10]  # Keep the line readable during reconnect storms
+            listed = ", ".join(names)
+            if count > len(names):
+                listed += f" and {count - len(names)} more"
+
+            if count == 1:
+                parts.append(f"{listed} has {verb} the chat")
+            else:
+                parts.append(f"{sign}{count} {verb} ({listed})")
+
+        return ", ".join(parts)
+
+    def update_online_status(self):
+        status = f"Connected to server \u2014 {self.online_count} online"
+        if self.rtt is not None:
+            status += f" \u2014 {self.rtt * 1000:.0f} ms"
+        self.status_text.set(status)
+
+    def configure_tags(self):
+        """Set up the message styles once, rather than on every inserted line"""
         self.message_area.tag_config("timestamp", foreground=self.colors["text_muted"], font=('Segoe UI', 8))
         self.message_area.tag_config("sent_user", foreground=self.colors["accent"], font=('Segoe UI', 10, 'bold'))
         self.message_area.tag_config("sent_msg", foreground=self.colors["text"])
+        self.message_area.tag_config("recv_user", foreground="#9ccc65", font=('Segoe UI', 10, 'bold'))
+        self.message_area.tag_config("recv_msg", foreground=self.colors["text"])
+        self.message_area.tag_config("whisper_user", foreground=self.colors["whisper_msg"], font=('Segoe UI', 10, 'bold'))
+        self.message_area.tag_config("whisper_msg", foreground=self.colors["whisper_msg"], font=('Segoe UI', 10, 'italic'))
+        self.message_area.tag_config("system_msg", foreground=self.colors["accent"], font=('Segoe UI', 10, 'italic'))
+        self.message_area.tag_config("delivered", foreground=self.colors["text_muted"], font=('Segoe UI', 8))
+        self.message_area.tag_config("file_link", foreground=self.colors["accent"], underline=True)
+        self.message_area.tag_bind("file_link", "<Button-1>", self.on_file_link)
+        self.message_area.tag_bind("file_link", "<Enter>", lambda event: self.message_area.config(cursor="hand2"))
+        self.message_area.tag_bind("file_link", "<Leave>", lambda event: self.message_area.config(cursor=""))
+
+    def post(self, action):
+        """Run `action` on the UI thread at the next pump"""
+        self.ui_queue.put(action)
+
+    def post_line(self, segments, mark=None):
+        """Queue a line of [(text, tag)] for the message area
+
+        A `mark` is set just before the line's last segment, where the delivery
+        tick of a sent message goes.
+        """
+        line = [segments, mark]
+        if mark:
+            self.pending_marks[mark] = line
+        self.ui_queue.put(line)
+
+    def pump_ui(self):
+        """Apply queued display updates in one batch, about 60 times a second"""
+        try:
+            if getattr(self, "message_area", None) is None:
+                return
+
+            lines = []
+            actions = []
+            for _ in range(self.max_lines_per_pump):
+                try:
+                    item = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if callable(item):
+                    actions.append(item)
+                else:
+                    lines.append(item)
+
+            if lines:
+                self.insert_lines(lines)
+            for action in actions:
+                action()
+        except Exception as e:
+            print(f"Error updating chat window: {e}")
+        finally:
+            self.root.after(self.ui_interval_ms, self.pump_ui)
+
+    def render_lines(self, lines):
+        """Flatten lines into Text.insert arguments, returning them with the marks to place
+
+        A marked line also carries the mark name as a temporary tag up to its
+        last segment, so the mark's position can be found after one insert.
+        """
+        args = []
+        marks = []
+        for segments, mark in lines:
+            for index, (text, tag) in enumerate(segments):
+                if mark and index < len(segments) - 1:
+                    tag = (tag, mark)
+                args.extend((text, tag))
+            if mark:
+                marks.append(mark)
+        return args, marks
+
+    def place_marks(self, marks):
+        for mark in marks:
+            ranges = self.message_area.tag_ranges(mark)
+            if ranges:
+                self.message_area.mark_set(mark, ranges[-1])
+                self.message_area.mark_gravity(mark, tk.LEFT)
+            self.message_area.tag_delete(mark)
+
+    def insert_lines(self, lines):
+        """Append a batch of lines with a single widget call"""
+        # Only follow new messages if the user hasn't scrolled up to read older ones
+        at_bottom = self.message_area.yview()[1] >= 0.999
+
+        args, marks = self.render_lines(lines)
+        self.message_area.config(state=tk.NORMAL)
+        self.message_area.insert("end-1c", *args)
+
+        # Remember where each sent line ends so the delivery tick can go there
+        self.place_marks(marks)
+        self.shown_lines.extend(lines)
+
+        # Trimming while the user reads older lines would move the text under
+        # them, so it waits until they're back at the bottom unless far over
+        excess = len(self.shown_lines) - self.max_display_lines
+        if excess >= self.trim_batch and (at_bottom or excess >= self.max_display_lines):
+            self.trim_lines(excess)
 
-        # Scroll to bottom
-        self.message_area.see(tk.END)
+        if at_bottom:
+            self.message_area.see(tk.END)
         self.message_area.config(state=tk.DISABLED)
 
-    def display_received_message(self, username, content):
-        self.message_area.config(state=tk.NORMAL)
+    def trim_lines(self, count):
+        """Move the oldest `count` lines out of the widget into the scrollback store"""
+        newlines = 0
+        for _ in range(count):
+            line = self.shown_lines.popleft()
+            segments, mark = line
+            if mark:
+                self.message_area.mark_unset(mark)
+            newlines += sum(text.count("\n") for text, _ in segments)
+            self.scrollback.append(line)
+
+        # Every line starts at the beginning of a text line, so whole text lines go
+        self.message_area.delete("1.0", f"{newlines + 1}.0")
+
+    def on_message_scroll(self, first, last):
+        """Scrollbar callback for the message area, paging in older lines at the top"""
+        self.message_area.vbar.set(first, last)
+        if float(first) > 0.0 or self.paging:
+            return
+
+        if self.scrollback:
+            self.paging = True
+            self.root.after_idle(self.load_older_lines)
+        elif (self.connected and not self.history_exhausted
+              and self.oldest_message_id is not None and self.oldest_message_id > 1):
+            # The local store is used up; the reply arrives via handle_history
+            self.paging = True
+            self.request_history(before_id=self.oldest_message_id)
+
+    def load_older_lines(self):
+        """Insert the previous page of lines from the scrollback store above the current ones"""
+        page = []
+        while self.scrollback and len(page) < self.page_size:
+            page.append(self.scrollback.pop())
+        page.reverse()
+        self.insert_older_lines(page)
+
+    def insert_older_lines(self, page):
+        """Insert lines above the current ones, oldest first"""
+        try:
+            if getattr(self, "message_area", None) is None or not page:
+                return
+
+            args, marks = self.render_lines(page)
+            newlines = sum(text.count("\n") for segments, _ in page for text, _ in segments)
 
+            self.message_area.config(state=tk.NORMAL)
+            self.message_area.insert("1.0", *args)
+            self.place_marks(marks)
+            self.shown_lines.extendleft(reversed(page))
+            self.message_area.config(state=tk.DISABLED)
+
+            # Keep the line the user was looking at in place rather than jumping to the new top
+            self.message_area.yview(f"{newlines + 1}.0")
+        finally:
+            self.paging = False
+
+    def display_sent_message(self, username, content, client_id=None):
         # Format timestamp
         timestamp = datetime.now().strftime("%H:%M")
 
-        # Insert message with username in bold
-        self.message_area.insert(tk.END, f"\n{timestamp} ", "timestamp")
-        self.message_area.insert(tk.END, f"{username}: ", "recv_user")
-        self.message_area.insert(tk.END, f"{content}\n", "recv_msg")
+        # Username in bold, with the delivery tick going after the text
+        self.post_line([
+            (f"\n{timestamp} ", "timestamp"),
+            (f"{username}: ", "sent_user"),
+            (content, "sent_msg"),
+            ("\n", "sent_msg"),
+        ], mark=f"ack_{client_id}" if client_id else None)
+
+    def mark_delivered(self, client_id):
+        """Tick a sent message once the server has acknowledged it"""
+        mark = f"ack_{client_id}"
+        line = self.pending_marks.pop(mark, None)
+        if line is None:
+            return
 
-        # Apply tags for styling
-        self.message_area.tag_config("timestamp", foreground=self.colors["text_muted"], font=('Segoe UI', 8))
-        self.message_area.tag_config("recv_user", foreground="#9ccc65", font=('Segoe UI', 10, 'bold'))
-        self.message_area.tag_config("recv_msg", foreground=self.colors["text"])
+        # Record the tick on the line itself, so it survives trimming and paging back in
+        segments = line[0]
+        segments.insert(len(segments) - 1, (" \u2713", "delivered"))
+        line[1] = None
 
-        # Scroll to bottom
-        self.message_area.see(tk.END)
-        self.message_area.config(state=tk.DISABLED)
+        if mark in self.message_area.mark_names():
+            self.message_area.config(state=tk.NORMAL)
+            self.message_area.insert(mark, " \u2713", "delivered")
+            self.message_area.mark_unset(mark)
+            self.message_area.config(state=tk.DISABLED)
 
-    def display_system_message(self, content):
-        self.message_area.config(state=tk.NORMAL)
+    def display_received_message(self, username, content, file=None):
+        # Format timestamp
+        timestamp = datetime.now().strftime("%H:%M")
+
+        # Username in bold
+        self.post_line([
+            (f"\n{timestamp} ", "timestamp"),
+            (f"{username}: ", "recv_user"),
+            *self.content_segments(content, "recv_msg", file),
+        ])
 
+    def display_whisper_message(self, label, content):
         # Format timestamp
         timestamp = datetime.now().strftime("%H:%M")
 
-        # Insert system message
-        self.message_area.insert(tk.END, f"\n{timestamp} ", "timestamp")
-        self.message_area.insert(tk.END, f"System: {content}\n", "system_msg")
+        # Whisper route in bold and the text in italics
+        self.post_line([
+            (f"\n{timestamp} ", "timestamp"),
+            (f"{label}: ", "whisper_user"),
+            (f"{content}\n", "whisper_msg"),
+        ])
 
-        # Apply tags for styling
-        self.message_area.tag_config("timestamp", foreground=self.colors["text_muted"], font=('Segoe UI', 8))
-        self.message_area.tag_config("system_msg", foreground=self.colors["accent"], font=('Segoe UI', 10, 'italic'))
+    def display_system_message(self, content):
+        # Format timestamp
+        timestamp = datetime.now().strftime("%H:%M")
 
-        # Scroll to bottom
-        self.message_area.see(tk.END)
-        self.message_area.config(state=tk.DISABLED)
+        self.post_line([
+            (f"\n{timestamp} ", "timestamp"),
+            (f"System: {content}\n", "system_msg"),
+        ])
+
+    def open_search_window(self):
+        """Search every saved chat log by word, sender (from:name) and date (since:/until: YYYY-MM-DD)"""
+        window = tk.Toplevel(self.root)
+        window.title("Search Chat History")
+        window.geometry("600x450")
+        window.configure(bg=self.colors["bg_dark"])
+
+        query_entry = tk.Entry(window,
+                               font=('Segoe UI', 11),
+                               bg=self.colors["bg_light"],
+                               fg=self.colors["text"],
+                               insertbackground=self.colors["text"],
+                               relief=tk.FLAT)
+        query_entry.pack(fill=tk.X, padx=10, pady=(10, 5), ipady=5)
+
+        results_area = scrolledtext.ScrolledText(
+            window,
+            bg=self.colors["bg_light"],
+            fg=self.colors["text"],
+            font=('Segoe UI', 10),
+            padx=10,
+            pady=10,
+            wrap=tk.WORD,
+            relief=tk.FLAT,
+            state=tk.DISABLED
+        )
+        results_area.pack(fill=tk.BOTH, expand=True, padx=10)
+
+        search_status = tk.StringVar()
+        search_status.set("e.g. lunch from:alice since:2024-01-01 until:2024-06-30")
+        tk.Label(window,
+                 textvariable=search_status,
+                 font=('Segoe UI', 8),
+                 bg=self.colors["bg_dark"],
+                 fg=self.colors["text_muted"],
+                 anchor=tk.W).pack(fill=tk.X, padx=10, pady=5)
+
+        def run_search(event=None):
+            if not self.search_index.ready.is_set():
+                search_status.set("Still indexing chat history, try again in a moment")
+                return
+
+            started = time.perf_counter()
+            try:
+                total, results = self.search_index.search(query_entry.get())
+            except ValueError:
+                search_status.set("Dates must look like 2024-01-31")
+                return
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            results_area.config(state=tk.NORMAL)
+            results_area.delete("1.0", tk.END)
+            if results:
+                results_area.insert(tk.END, "\n".join(line for _, line in results))
+            results_area.config(state=tk.DISABLED)
+
+            shown = f", newest {len(results)} shown" if total > len(results) else ""
+            search_status.set(f"{total} result(s) in {elapsed_ms:.1f} ms{shown}")
+
+        query_entry.bind('<Return>', run_search)
+        query_entry.focus()
+
+    def attach_file(self):
+        path = filedialog.askopenfilename(parent=self.root, title="Share a file")
+        if path:
+            upload_thread = threading.Thread(target=self.upload_file, args=(path,))
+            upload_thread.daemon = True
+            upload_thread.start()
+
+    def upload_file(self, path):
+        """Hash a file, offer it to the server and send it chunk by chunk as the window allows"""
+        name = os.path.basename(path)
+        try:
+            size = os.path.getsize(path)
+            digest = hashlib.sha256()
+            with open(path, "rb") as source:
+                for block in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(block)
+        except OSError as e:
+            self.display_system_message(f"Could not read {name}: {e}")
+            return
+
+        transfer = FileTransfer(uuid.uuid4().hex, path, name, size, digest.hexdigest(), "Uploading")
+        with self.transfer_lock:
+            self.uploads[transfer.transfer_id] = transfer
+        self.post(lambda: self.show_transfer(transfer))
+
+        if self.connected:
+            try:
+                self.send_frame(self.offer_frame(transfer))
+            except Exception:
+                pass  # Offered again after reconnecting
 
-    def save_to_log(self, username, message):
         try:
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with open(self.log_file_path, "a", encoding="utf-8") as log_file:
-                log_file.write(f"[{timestamp}] {username}: {message}\n")
-        except Exception as e:
-            print(f"Error writing to log file: {e}")
+            self.send_chunks(transfer)
+        except OSError as e:
+            with self.transfer_lock:
+                self.uploads.pop(transfer.transfer_id, None)
+                transfer.error = str(e)
+            try:
+                self.send_frame({"type": "file_cancel", "transfer_id": transfer.transfer_id})
+            except Exception:
+                pass
+            self.display_system_message(f"Could not read {name}: {e}")
+            self.post(lambda: self.update_transfer(transfer))
+
+    def offer_frame(self, transfer):
+        return {
+            "type": "file_offer",
+            "transfer_id": transfer.transfer_id,
+            "name": transfer.name,
+            "size": transfer.size,
+            "sha256": transfer.sha256,
+        }
+
+    def offer_uploads(self, sock):
+        """Offer unfinished uploads on a new connection; the server says where each resumes"""
+        with self.transfer_lock:
+            uploads = list(self.uploads.values())
+            for transfer in uploads:
+                transfer.window = 0  # Nothing more goes out until it answers
+        for transfer in uploads:
+            self.send_frame(self.offer_frame(transfer), sock)
+
+    def can_send(self, transfer):
+        limit = min(transfer.size, transfer.done_bytes + transfer.window)
+        return self.connected and transfer.window > 0 and transfer.sent < limit
+
+    def send_chunks(self, transfer):
+        """Send chunks while the window is open, until the upload finishes or fails"""
+        with open(transfer.path, "rb") as source:
+            while True:
+                with self.transfer_lock:
+                    while not (transfer.finished or transfer.error or self.can_send(transfer)):
+                        self.transfer_lock.wait(1.0)
+                    if transfer.finished or transfer.error:
+                        return
+                    offset = transfer.sent
+                    length = min(self.file_chunk_size, min(transfer.size, transfer.done_bytes + transfer.window) - offset)
+                    transfer.sent += length
+
+                source.seek(offset)
+                frame = {
+                    "type": "file_chunk",
+                    "transfer_id": transfer.transfer_id,
+                    "offset": offset,
+                    "data": base64.b64encode(source.read(length)).decode("ascii"),
+                }
+                try:
+                    self.send_frame(frame)
+                except Exception:
+                    with self.transfer_lock:
+                        transfer.window = 0  # Resumed once offered on the next connection
+
+    def handle_file_progress(self, message, resume=False):
+        """The server has an upload up to `offset`; after an accept, sending carries on from there"""
+        with self.transfer_lock:
+            transfer = self.uploads.get(message.get("transfer_id"))
+            if transfer is None:
+                return
+            transfer.done_bytes = message["offset"]
+            if resume:
+                transfer.sent = message["offset"]
+            transfer.window = message.get("window", transfer.window)
+            if message.get("done"):
+                transfer.finished = True
+                del self.uploads[transfer.transfer_id]
+            self.transfer_lock.notify_all()
+
+        if transfer.finished:
+            # Ticked when the server's ack for the announcement (the transfer id) arrives
+            content = f"shared {transfer.name} ({transfer.size:,} bytes)"
+            self.display_sent_message(self.username, content, transfer.transfer_id)
+            self.save_to_log(self.username, content)
+        self.post(lambda: self.update_transfer(transfer))
+
+    def handle_file_error(self, message):
+        with self.transfer_lock:
+            transfer = self.uploads.pop(message.get("transfer_id"), None)
+            if transfer:
+                transfer.error = message["content"]
+                self.transfer_lock.notify_all()
+
+        self.display_system_message(f"Error: {message['content']}")
+        if transfer:
+            self.post(lambda: self.update_transfer(transfer))
+
+    def on_file_link(self, event):
+        for tag in self.message_area.tag_names(f"@{event.x},{event.y}"):
+            if tag.startswith("file_") and tag != "file_link":
+                file = self.shared_files.get(tag[len("file_"):])
+                if file:
+                    self.start_download(file)
+                return
+
+    def start_download(self, file):
+        """Fetch a shared file into the downloads folder, unless it is already on its way"""
+        with self.transfer_lock:
+            if file["id"] in self.downloads:
+                return
+            transfer = FileTransfer(file["id"], None, file["name"], file["size"], file.get("sha256"), "Downloading")
+            self.downloads[file["id"]] = transfer
+        self.show_transfer(transfer)
+
+        download_thread = threading.Thread(target=self.download_file, args=(transfer,))
+        download_thread.daemon = True
+        download_thread.start()
+
+    def download_file(self, transfer):
+        """Download into a .part file, resuming from its length after each dropped connection"""
+        if not os.path.exists(self.downloads_dir):
+            os.makedirs(self.downloads_dir)
+        part_path = os.path.join(self.downloads_dir, f"{transfer.transfer_id}.part")
+
+        attempts = 0
+        while not transfer.finished and not transfer.error:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            try:
+                self.fetch_file(transfer, part_path, offset)
+            except (OSError, ValueError) as e:
+                attempts += 1
+                if attempts > 5:
+                    transfer.error = str(e)
+                    break
+                time.sleep(random.uniform(0, min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** attempts)))
+
+        if not transfer.error:
+            digest = hashlib.sha256()
+            with open(part_path, "rb") as part:
+                for block in iter(lambda: part.read(1024 * 1024), b""):
+                    digest.update(block)
+            if transfer.sha256 and digest.hexdigest() != transfer.sha256:
+                os.remove(part_path)
+                transfer.error = "it was damaged in transfer"
+            else:
+                transfer.path = self.unused_path(os.path.basename(transfer.name))
+                os.replace(part_path, transfer.path)
+
+        with self.transfer_lock:
+            self.downloads.pop(transfer.transfer_id, None)
+        if transfer.error:
+            self.display_system_message(f"Could not download {transfer.name}: {transfer.error}")
+        else:
+            self.display_system_message(f"Saved {transfer.name} to {transfer.path}")
+        self.post(lambda: self.update_transfer(transfer))
+
+    def fetch_file(self, transfer, part_path, offset):
+        """Read a file from `offset` on a new connection, appending to the partial copy"""
+        with socket.create_connection((self.host, self.port), timeout=30) as sock:
+            sock.sendall(encode_frame({"type": "file_get", "file_id": transfer.transfer_id, "offset": offset}))
+
+            # One JSON header line, then the raw bytes up to the end of the file
+            buffer = b""
+            while b"\n" not in buffer:
+                data = sock.recv(65536)
+                if not data:
+                    raise ConnectionError("The server closed the connection")
+                buffer += data
+            line, buffer = buffer.split(b"\n", 1)
+            header = json.loads(line)
+            if header.get("type") != "file_data":
+                transfer.error = header.get("content", "the server refused")
+                return
+
+            size = header["size"]
+            with open(part_path, "ab") as part:
+                part.truncate(offset)
+                received = offset
+                while True:
+                    if buffer:
+                        part.write(buffer)
+                        before, received = received, received + len(buffer)
+                        transfer.done_bytes = received
+                        if received * 100 // max(size, 1) != before * 100 // max(size, 1):
+                            self.post(lambda: self.update_transfer(transfer))
+                    if received >= size:
+                        transfer.finished = True
+                        return
+                    buffer = sock.recv(65536)
+                    if not buffer:
+                        raise ConnectionError("The download was cut off")
+
+    def unused_path(self, name):
+        """A path in the downloads folder that won't overwrite an earlier download"""
+        stem, extension = os.path.splitext(name or "download")
+        path = os.path.join(self.downloads_dir, name)
+        for number in itertools.count(1):
+            if not os.path.exists(path):
+                return path
+            path = os.path.join(self.downloads_dir, f"{stem} ({number}){extension}")
+
+    def show_transfer(self, transfer):
+        """Add a progress bar for a transfer under the messages"""
+        if self.transfers_frame is None or not self.transfers_frame.winfo_exists():
+            return
+
+        transfer.row = ttk.Frame(self.transfers_frame)
+        transfer.row.pack(fill=tk.X, pady=(5, 0))
+        transfer.label = tk.Label(transfer.row,
+                                  font=('Segoe UI', 8),
+                                  bg=self.colors["bg_dark"],
+                                  fg=self.colors["text_muted"],
+                                  anchor=tk.W)
+        transfer.label.pack(side=tk.LEFT)
+        transfer.bar = ttk.Progressbar(transfer.row, maximum=max(transfer.size, 1), mode="determinate")
+        transfer.bar.pack(side=tk.RIGHT, fill=tk.X, expand=True, padx=(10, 0))
+        self.update_transfer(transfer)
+
+    def update_transfer(self, transfer):
+        """Move a transfer's progress bar, removing it once the transfer is over"""
+        if transfer.row is None or not transfer.row.winfo_exists():
+            return
+        if transfer.finished or transfer.error:
+            transfer.row.destroy()
+            transfer.row = None
+            return
+
+        percent = transfer.done_bytes * 100 // max(transfer.size, 1)
+        transfer.label.config(text=f"{transfer.verb} {transfer.name} \u2014 {percent}%")
+        transfer.bar["value"] = transfer.done_bytes
+
+    def save_to_log(self, username, message, timestamp=None):
+        # Queued for the log writer thread; the disk is never touched here
+        self.log_writer.write(username, message, timestamp)
 
     def disconnect(self):
+        self.stop_reconnecting.set()
         if self.connected and self.socket:
             try:
-                self.socket.send(
-                    json.dumps({"type": "disconnect", "username": self.username}).encode("utf-8")
-                )
+                self.send_frame({"type": "disconnect", "username": self.username})
                 self.socket.close()
             except:
                 pass
@@ -472,6 +1843,16 @@ class ModernChatClient:
         self.connected = False
         self.socket = None
 
+        # Uploads go with the connection; downloads carry on by themselves
+        with self.transfer_lock:
+            for transfer in self.uploads.values():
+                transfer.error = "Disconnected"
+            self.uploads.clear()
+            self.transfer_lock.notify_all()
+
+        self.log_writer.flush()
+        self.log_writer.save_index()
+
         # Return to login screen
         self.create_login_ui()
 
@@ -482,9 +1863,13 @@ class ModernChatClient:
     def on_closing(self):
         if self.connected:
             if messagebox.askokcancel("Quit", "Are you sure you want to disconnect and quit?"):
+                self.stop_reconnecting.set()
                 self.disconnect()
+                self.log_writer.close()
                 self.root.destroy()
         else:
+            self.stop_reconnecting.set()
+            self.log_writer.close()
             self.root.destroy()
 
 
@@ -0,0 +1,50 @@
+import json
+import codecs
+
+
+def encode_frame(message):
+    """Serialise a message as one newline-terminated JSON frame"""
+    return (json.dumps(message) + "\n").encode("utf-8")
+
+
+class FrameDecoder:
+    """Split a TCP byte stream back into JSON messages
+
+    Frames are newline-terminated, but peers that write bare back-to-back
+    JSON objects are still understood. A frame may span several recv() calls.
+    """
+
+    def __init__(self, max_frame_size=1024 * 1024):
+        self.max_frame_size = max_frame_size
+        self.buffer = ""
+        self._text = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+
+    def feed(self, data):
+        """Add received bytes, returning every message that is now complete"""
+        buffer = self.buffer + self._text.decode(data)
+        messages = []
+        pos = 0
+
+        while True:
+            # Skip the newline terminators (and any other whitespace) between frames
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos += 1
+            if pos == len(buffer):
+                break
+
+            try:
+                message, pos = self._json.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # A finished line that still doesn't parse is garbage, not a partial frame
+                if "\n" in buffer[pos:]:
+                    raise
+                break
+
+            messages.append(message)
+
+        self.buffer = buffer[pos:]
+        if len(self.buffer) > self.max_frame_size:
+            raise ValueError(f"Frame exceeds {self.max_frame_size} bytes")
+
+        return messages
@@ -0,0 +1,278 @@
+import socket
+import threading
+import queue
+import time
+import argparse
+import logging
+
+from protocol_v002 import FrameDecoder, encode_frame
+
+
+class NodeLink:
+    """One chat server process connected to the relay
+
+    Frames for the node wait in a bounded queue drained by its own writer
+    thread, so a slow node never holds up forwarding to the others.
+    """
+
+    def __init__(self, node_socket, node_id, instance, address, max_queue=10000):
+        self.socket = node_socket
+        self.node_id = node_id
+        self.instance = instance  # Tells apart two processes of one node during a reload
+        self.address = f"{address[0]}:{address[1]}"
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.connected_at = time.time()
+        self.frames_in = 0
+        self.frames_out = 0
+        self.closed = False
+
+    @property
+    def key(self):
+        return self.node_id, self.instance
+
+    def start(self):
+        writer_thread = threading.Thread(target=self.write_loop)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def send(self, data):
+        """Queue a frame for the node, returning False if it has fallen too far behind"""
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            return False
+        return True
+
+    def write_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                break
+            self.frames_out += 1
+        self.close()
+
+    def close(self):
+        """Stop the writer and hang up, which also ends the node's reader"""
+        self.closed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass  # The writer fails on the closed socket instead
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+
+class FederationRelay:
+    """Small broker linking several ChatServer nodes into one federation
+
+    Every message a node publishes is forwarded once to each other node,
+    never back to its origin. Nodes fan it out to their own clients and
+    use the origin id and sequence number to drop anything they have
+    already seen. Links are keyed by node id and process instance, so the
+    old and new process of a reloading node can both stay linked.
+    """
+
+    def __init__(self, host="0.0.0.0", port=9900):
+        self.host = host
+        self.port = port
+        self.server_socket = None
+        self.nodes = {}  # {(node_id, instance): NodeLink}
+        self.lock = threading.Lock()
+        self.active = True
+
+        logging.basicConfig(
+            level=logging.INFO,
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
+        self.logger = logging.getLogger('FederationRelay')
+
+    def start(self):
+        try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind((self.host, self.port))
+            self.server_socket.listen(socket.SOMAXCONN)
+            self.port = self.server_socket.getsockname()[1]
+
+            self.logger.info(f"Relay listening on {self.host}:{self.port}")
+
+            accept_thread = threading.Thread(target=self.accept_connections)
+            accept_thread.daemon = True
+            accept_thread.start()
+
+            return True
+        except Exception as e:
+            self.logger.error(f"Relay error: {e}")
+            return False
+
+    def accept_connections(self):
+        while self.active:
+            try:
+                self.server_socket.settimeout(1.0)
+                try:
+                    node_socket, address = self.server_socket.accept()
+                except socket.timeout:
+                    continue
+                node_thread = threading.Thread(target=self.handle_node, args=(node_socket, address))
+                node_thread.daemon = True
+                node_thread.start()
+            except Exception as e:
+                if self.active:
+                    self.logger.error(f"Error accepting node: {e}")
+                break
+
+    def handle_node(self, node_socket, address):
+        node = None
+        decoder = FrameDecoder()
+
+        try:
+            # The first frame names the node
+            node_socket.settimeout(10.0)
+            frames = []
+            while not frames:
+                data = node_socket.recv(65536)
+                if not data:
+                    return
+                frames = decoder.feed(data)
+
+            hello = frames.pop(0)
+            if hello.get("type") != "relay_hello":
+                return
+            node_socket.settimeout(None)
+
+            node = NodeLink(node_socket, hello["node_id"], hello.get("instance"), address)
+            node.start()
+            with self.lock:
+                previous = self.nodes.get(node.key)
+                self.nodes[node.key] = node
+            if previous is not None:
+                # The same process reconnected; drop its stale link
+                self.close_node(previous)
+
+            self.logger.info(f"Node {node.node_id} linked from {node.address}")
+            self.announce_peers()
+
+            while self.active:
+                for frame in frames:
+                    node.frames_in += 1
+                    if frame.get("type") == "relay_publish":
+                        self.forward(node, frame)
+
+                data = node_socket.recv(65536)
+                if not data:
+                    break
+                frames = decoder.feed(data)
+
+        except Exception as e:
+            if self.active:
+                self.logger.error(f"Error handling node {node.node_id if node else address}: {e}")
+
+        finally:
+            if node is None:
+                try:
+                    node_socket.close()
+                except:
+                    pass
+            else:
+                node.close()
+                with self.lock:
+                    removed = self.nodes.get(node.key) is node
+                    if removed:
+                        del self.nodes[node.key]
+                if removed:
+                    self.logger.info(f"Node {node.node_id} unlinked")
+                    self.announce_peers()
+
+    def forward(self, origin, frame):
+        """Deliver a published frame once to every node except the one it came from"""
+        frame["relayed_at"] = time.time()
+        data = encode_frame(frame)
+
+        with self.lock:
+            # Another process of the origin node (mid reload) would drop it as its own
+            targets = [node for node in self.nodes.values() if node.node_id != origin.node_id]
+
+        for node in targets:
+            self.send_to(node, data)
+
+    def announce_peers(self):
+        with self.lock:
+            targets = list(self.nodes.values())
+            node_ids = sorted({node.node_id for node in targets})
+
+        data = encode_frame({"type": "relay_peers", "nodes": node_ids, "timestamp": time.time()})
+        for node in targets:
+            self.send_to(node, data)
+
+    def send_to(self, node, data):
+        if not node.send(data) and not node.closed:
+            self.logger.warning(f"Node {node.node_id} fell {node.queue.maxsize} frames behind, unlinking it")
+            self.close_node(node)
+
+    def close_node(self, node):
+        node.close()
+
+    def status(self):
+        with self.lock:
+            return [
+                {
+                    "node_id": node.node_id,
+                    "instance": node.instance,
+                    "address": node.address,
+                    "connected_at": node.connected_at,
+                    "frames_in": node.frames_in,
+                    "frames_out": node.frames_out,
+                    "queued": node.queue.qsize(),
+                }
+                for node in self.nodes.values()
+            ]
+
+    def shutdown(self):
+        self.active = False
+        with self.lock:
+            nodes = list(self.nodes.values())
+            self.nodes.clear()
+        for node in nodes:
+            self.close_node(node)
+        if self.server_socket:
+            try:
+                self.server_socket.close()
+            except:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Whisper Chat federation relay")
+    parser.add_argument("--host", default="0.0.0.0", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=9900, help="Port chat servers connect to")
+    args = parser.parse_args()
+
+    relay = FederationRelay(args.host, args.port)
+    if not relay.start():
+        print("Failed to start relay. Exiting.")
+        return
+
+    print("Whisper Chat relay is running. Press Ctrl+C to stop.")
+    print(f"Start chat servers with --relay localhost:{relay.port} to federate them.")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print("\nShutting down relay...")
+    finally:
+        relay.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import socket
+import threading
+import json
+import gzip
+import time
+import argparse
+import sys
+import uuid
+from collections import deque
+
+from protocol_v002 import FrameDecoder, encode_frame
+
+
+def load_capture(path):
+    """Read a capture written by ChatServer --record into [(seconds, connection id, frame)]"""
+    opener = gzip.open if path.endswith(".gz") else open
+    events = []
+
+    with opener(path, "rt", encoding="utf-8") as capture:
+        for line in capture:
+            entry = json.loads(line)
+            if isinstance(entry, dict):
+                continue  # Capture header
+            events.append(tuple(entry))
+
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def echo_key(frame):
+    """What the server sends back to the sender for a frame, if anything
+
+    Chat messages are acknowledged in the order they were sent, so any ack
+    confirms the oldest one outstanding. Whispers are echoed back in full.
+    """
+    if frame.get("type") == "message":
+        return ("ack",)
+    if frame.get("type") == "whisper":
+        return "whisper", frame.get("content")
+    return None
+
+
+class ReplayConnection:
+    """One recorded client connection being played back"""
+
+    def __init__(self, replayer, connection_id):
+        self.replayer = replayer
+        self.connection_id = connection_id
+        self.socket = None
+        self.pending = deque()  # [(echo key, sent_at)] awaiting their ack or echo
+        self.closed = False
+
+    def open(self, host, port):
+        self.socket = socket.create_connection((host, port), timeout=10)
+        self.socket.settimeout(None)
+
+        reader_thread = threading.Thread(target=self.read_loop)
+        reader_thread.daemon = True
+        reader_thread.start()
+
+    def send(self, frame):
+        key = echo_key(frame)
+        if key is not None:
+            with self.replayer.lock:
+                self.pending.append((key, time.perf_counter()))
+
+        # Recorded client ids would be dropped as repeats by a server that has seen
+        # them before (or restored them from saved state), so each run uses its own
+        if "client_id" in frame:
+            frame = dict(frame, client_id=f"{self.replayer.run_id}-{frame['client_id']}")
+
+        self.socket.sendall(encode_frame(frame))
+
+    def read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            while not self.closed:
+                data = self.socket.recv(65536)
+                if not data:
+                    break
+                for message in decoder.feed(data):
+                    self.replayer.on_receive(self, message)
+        except (OSError, ValueError):
+            pass
+
+    def match_echo(self, message):
+        """Return the round-trip time if `message` is the ack or echo of something we sent"""
+        if message.get("type") == "ack":
+            key = ("ack",)
+        elif message.get("type") == "whisper" and message.get("echo"):
+            key = ("whisper", message.get("content"))
+        else:
+            return None
+
+        for index, (pending_key, sent_at) in enumerate(self.pending):
+            if pending_key == key:
+                del self.pending[index]
+                return time.perf_counter() - sent_at
+        return None
+
+    def close(self):
+        self.closed = True
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+
+
+class TrafficReplayer:
+    """Re-run a recorded capture against a server, keeping its timing (optionally scaled)
+
+    speed=1 plays the capture in real time, speed=10 ten times faster and
+    speed=0 as fast as possible. Latency is measured from sending a message
+    to receiving its acknowledgement (or, for whispers, its echo) from the server.
+    """
+
+    def __init__(self, host="localhost", port=9999, speed=1.0, settle=2.0):
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.settle = settle
+        self.run_id = uuid.uuid4().hex[:8]  # Prefixed to recorded client ids
+        self.connections = {}  # {connection id: ReplayConnection}
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.deliveries = 0
+        self.frames_sent = 0
+        self.messages_sent = 0
+        self.errors = 0
+        self.max_slip = 0.0
+
+    def on_receive(self, connection, message):
+        with self.lock:
+            if message.get("type") in ("message", "whisper"):
+                self.deliveries += 1
+
+            latency = connection.match_echo(message)
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def run(self, events):
+        started = time.perf_counter()
+
+        for offset, connection_id, frame in events:
+            if self.speed > 0:
+                due = started + offset / self.speed
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_slip = max(self.max_slip, -delay)
+
+            try:
+                self.play(connection_id, frame)
+            except OSError:
+                self.errors += 1
+                connection = self.connections.pop(connection_id, None)
+                if connection:
+                    connection.close()
+
+        send_duration = time.perf_counter() - started
+
+        # Give the last echoes time to arrive
+        deadline = time.perf_counter() + self.settle
+        while time.perf_counter() < deadline and any(c.pending for c in self.connections.values()):
+            time.sleep(0.05)
+
+        for connection in list(self.connections.values()):
+            connection.close()
+
+        return self.report(send_duration, len({event[1] for event in events}))
+
+    def play(self, connection_id, frame):
+        connection = self.connections.get(connection_id)
+
+        if frame is None:
+            # The recorded connection closed here. One still waiting for echoes
+            # (likely when replaying faster than recorded) is closed after settling
+            if connection and not connection.pending:
+                connection.close()
+            return
+
+        if connection is None:
+            connection = ReplayConnection(self, connection_id)
+            connection.open(self.host, self.port)
+            self.connections[connection_id] = connection
+
+        connection.send(frame)
+        self.frames_sent += 1
+        if echo_key(frame) is not None:
+            self.messages_sent += 1
+
+    def report(self, send_duration, connection_count):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            deliveries = self.deliveries
+
+        unconfirmed = sum(len(connection.pending) for connection in self.connections.values())
+
+        return {
+            "speed": self.speed,
+            "connections": connection_count,
+            "duration_s": send_duration,
+            "frames_sent": self.frames_sent,
+            "messages_sent": self.messages_sent,
+            "send_rate": self.frames_sent / send_duration if send_duration else 0.0,
+            "deliveries": deliveries,
+            "delivery_rate": deliveries / send_duration if send_duration else 0.0,
+            "unconfirmed": unconfirmed,
+            "errors": self.errors,
+            "max_schedule_slip_ms": self.max_slip * 1000,
+            "latency_ms": {
+                "mean": sum(latencies) / len(latencies) * 1000 if latencies else None,
+                "p50": percentile(latencies, 0.50),
+                "p90": percentile(latencies, 0.90),
+                "p99": percentile(latencies, 0.99),
+                "max": latencies[-1] * 1000 if latencies else None,
+            },
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index] * 1000
+
+
+# Metrics compared against a baseline, and whether a higher value is worse
+COMPARED_METRICS = [
+    ("latency_ms.p50", True),
+    ("latency_ms.p90", True),
+    ("latency_ms.p99", True),
+    ("delivery_rate", False),
+    ("send_rate", False),
+    ("unconfirmed", True),
+    ("errors", True),
+]
+
+
+def lookup(report, dotted_name):
+    value = report
+    for part in dotted_name.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare_reports(report, baseline, tolerance):
+    """Print the change in each metric, returning the names of those that regressed"""
+    regressions = []
+
+    for name, higher_is_worse in COMPARED_METRICS:
+        current, previous = lookup(report, name), lookup(baseline, name)
+        if current is None or previous is None:
+            continue
+
+        if previous:
+            change = (current - previous) / previous
+        else:
+            change = 0.0 if current == previous else float("inf")
+
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        if worse:
+            regressions.append(name)
+
+        marker = "REGRESSION" if worse else ""
+        print(f"  {name:<16} {previous:>12.3f} -> {current:>12.3f}  ({change:+.1%}) {marker}")
+
+    return regressions
+
+
+def print_report(report):
+    latency = report["latency_ms"]
+    print(f"Replayed {report['frames_sent']} frames over {report['connections']} connections "
+          f"in {report['duration_s']:.2f}s (speed {report['speed'] or 'max'})")
+    print(f"  send rate      {report['send_rate']:.1f} frames/s")
+    print(f"  delivery rate  {report['delivery_rate']:.1f} messages/s ({report['deliveries']} delivered)")
+    if latency["p50"] is not None:
+        print(f"  ack latency    p50 {latency['p50']:.2f} ms, p90 {latency['p90']:.2f} ms, "
+              f"p99 {latency['p99']:.2f} ms, max {latency['max']:.2f} ms")
+    print(f"  unconfirmed    {report['unconfirmed']}, errors {report['errors']}, "
+          f"max schedule slip {report['max_schedule_slip_ms']:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Whisper Chat traffic capture against a server")
+    parser.add_argument("capture", help="Capture file written by server_v002.py --record")
+    parser.add_argument("--host", default="localhost", help="Chat server address")
+    parser.add_argument("--port", type=int, default=9999, help="Chat server port")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Time scale: 1 = as recorded, 10 = ten times faster, 0 = as fast as possible")
+    parser.add_argument("--settle", type=float, default=2.0, help="Seconds to wait for final echoes")
+    parser.add_argument("--report", metavar="PATH", help="Save the report as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against a previously saved report")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative change allowed before a metric counts as a regression")
+    args = parser.parse_args()
+
+    events = load_capture(args.capture)
+    replayer = TrafficReplayer(args.host, args.port, args.speed, args.settle)
+    report = replayer.run(events)
+    report["capture"] = args.capture
+
+    print_report(report)
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+        print(f"Compared with {args.compare}:")
+        regressions = compare_reports(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,25 +5,745 @@ import time
 import datetime
 import os
 import signal
+import subprocess
 import sys
+import argparse
+import select
+import uuid
+import gzip
+import itertools
+import bisect
+import queue
+import base64
+import binascii
+import hashlib
 from flask import Flask, render_template, jsonify, request, Response, send_from_directory
+from werkzeug.serving import make_server
 import webbrowser
 from threading import Thread
 import logging
+from collections import Counter, OrderedDict, deque
+
+from protocol_v002 import FrameDecoder, encode_frame
+
+# Per-socket keepalive idle time: TCP_KEEPIDLE on Linux and Windows, TCP_KEEPALIVE on macOS
+TCP_KEEPIDLE = getattr(socket, "TCP_KEEPIDLE", getattr(socket, "TCP_KEEPALIVE", None))
+
+
+class InstrumentedLock:
+    """threading.Lock wrapper that records wait and hold times per call site"""
+
+    def __init__(self, name="lock"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {}  # {site: [acquisitions, total_wait, max_wait, total_hold, max_hold]}
+        self._holder_site = None
+        self._acquired_at = 0.0
+        self._wait = 0.0
+
+    def __enter__(self):
+        self._acquire(self._call_site(sys._getframe(1)))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @staticmethod
+    def _call_site(frame):
+        return f"{frame.f_code.co_name}:{frame.f_lineno}"
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self._acquire(self._call_site(sys._getframe(1)), blocking, timeout)
+
+    def _acquire(self, site, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            self._wait = self._acquired_at - start
+            self._holder_site = site
+        return acquired
+
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        site, wait = self._holder_site, self._wait
+        self._lock.release()
+
+        with self._stats_lock:
+            stats = self._stats.get(site)
+            if stats is None:
+                stats = self._stats[site] = [0, 0.0, 0.0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            stats[3] += held
+            stats[4] = max(stats[4], held)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def report(self):
+        """Return per call site statistics, worst total wait first"""
+        with self._stats_lock:
+            items = [(site, list(stats)) for site, stats in self._stats.items()]
+
+        report = []
+        for site, (count, total_wait, max_wait, total_hold, max_hold) in items:
+            report.append({
+                "lock": self.name,
+                "site": site,
+                "acquisitions": count,
+                "wait_total_ms": total_wait * 1000,
+                "wait_avg_ms": total_wait * 1000 / count,
+                "wait_max_ms": max_wait * 1000,
+                "hold_total_ms": total_hold * 1000,
+                "hold_avg_ms": total_hold * 1000 / count,
+                "hold_max_ms": max_hold * 1000,
+            })
+
+        report.sort(key=lambda entry: entry["wait_total_ms"], reverse=True)
+        return report
+
+    def reset(self):
+        with self._stats_lock:
+            self._stats.clear()
+
+
+class Session:
+    """State kept for one connected client"""
+
+    __slots__ = (
+        "socket", "username", "address", "ip", "connected_at", "last_active",
+        "messages_in", "messages_out", "bytes_in", "bytes_out", "queue",
+        "history_tokens", "history_checked", "last_ping", "rtt", "rtt_var", "client_rtt", "client_jitter",
+        "gap", "pinged_at", "idle_timeout", "keepalive_idle", "uploads",
+    )
+
+    def __init__(self, client_socket, username, address, now=None):
+        now = time.time() if now is None else now
+        self.socket = client_socket
+        self.username = username
+        self.address = f"{address[0]}:{address[1]}"
+        self.ip = address[0]
+        self.connected_at = now
+        self.last_active = now
+        self.messages_in = 0
+        self.messages_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.queue = None  # Outbound frame queue, attached once the session has a writer
+        self.history_tokens = None  # History request allowance, filled on first use
+        self.history_checked = now
+        self.last_ping = now  # When the server last pinged, to time the round trip
+        self.rtt = None  # Smoothed round-trip time from the server's pings, in seconds
+        self.rtt_var = None  # Its mean deviation (jitter)
+        self.client_rtt = None  # As measured and reported by the client's own pings
+        self.client_jitter = None
+        self.gap = None  # Smoothed seconds between reads, how long this client usually goes quiet
+        self.pinged_at = None  # When a ping still waiting for an answer was sent
+        self.idle_timeout = None  # Silence allowed before the heartbeat checks on it
+        self.keepalive_idle = None  # Kernel keepalive idle seconds, None when the heartbeat pings instead
+        self.uploads = {}  # {transfer_id: Upload} being received on this connection
+
+    def note_activity(self, now):
+        """Record data arriving, which answers any ping and shows how often the client talks"""
+        gap = now - self.last_active
+        self.gap = gap if self.gap is None else self.gap + (gap - self.gap) / 4
+        self.last_active = now
+        self.pinged_at = None
+
+    def record_rtt(self, sample):
+        """Fold one round-trip sample into the smoothed RTT and jitter, weighted as TCP does"""
+        if self.rtt is None:
+            self.rtt = sample
+            self.rtt_var = sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+
+    def send(self, data, lane="live"):
+        """Queue a frame on one of the outbound lanes, or write it straight out if there's no writer"""
+        if self.queue is None:
+            self.socket.sendall(data)
+        else:
+            self.queue.put(data, lane)
+        self.messages_out += 1
+        self.bytes_out += len(data)
+
+    def close(self):
+        """Stop the writer and close the socket, discarding anything still queued"""
+        if self.queue is not None:
+            self.queue.close()
+        try:
+            self.socket.close()
+        except:
+            pass
+
+    def to_dict(self):
+        return {
+            "username": self.username,
+            "address": self.address,
+            "connected_at": self.connected_at,
+            "last_active": self.last_active,
+            "messages_in": self.messages_in,
+            "messages_out": self.messages_out,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "lanes": self.queue.stats() if self.queue is not None else None,
+            "rtt_ms": milliseconds(self.rtt),
+            "jitter_ms": milliseconds(self.rtt_var),
+            "client_rtt_ms": milliseconds(self.client_rtt),
+            "client_jitter_ms": milliseconds(self.client_jitter),
+            "idle_timeout": self.idle_timeout,
+            "keepalive": self.keepalive_idle is not None,
+        }
+
+
+def milliseconds(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def valid_file_id(file_id):
+    """Transfer and file ids are 32 hex digits, which also keeps them safe as file names"""
+    return isinstance(file_id, str) and len(file_id) == 32 and all(c in "0123456789abcdef" for c in file_id)
+
+
+class Upload:
+    """A file arriving in chunks, appended to a .part file until all of it is there"""
+
+    __slots__ = ("transfer_id", "name", "size", "sha256", "path", "file", "received", "digest")
+
+    def __init__(self, transfer_id, name, size, sha256, path):
+        self.transfer_id = transfer_id
+        self.name = name
+        self.size = size
+        self.sha256 = sha256
+        self.path = path
+
+        # Unbuffered, so a newer connection resuming the same upload sees every byte
+        # already written; whatever a dropped connection left behind is kept
+        self.file = open(path + ".part", "ab", buffering=0)
+        self.received = self.file.tell()
+        if self.received > size:
+            self.file.truncate(0)
+            self.received = 0
+
+        self.digest = hashlib.sha256()
+        if self.received:
+            with open(path + ".part", "rb") as partial:
+                for block in iter(lambda: partial.read(1024 * 1024), b""):
+                    self.digest.update(block)
+
+    def write(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+        self.received += len(data)
+
+    def close(self):
+        self.file.close()
+
+
+class SlowConsumerError(OSError):
+    """A client has stopped reading and its outbound queue is full"""
+
+
+class OutboundQueue:
+    """One session's outbound frames, split into priority lanes
+
+    Control frames (pings, pongs, acks, presence, errors and server notices)
+    always go first. Live chat and backfill (history replay) then share the
+    socket by weight, so a long catch-up can't delay live traffic and live
+    traffic can't starve the catch-up.
+    """
+
+    LANES = ("control", "live", "backfill")
+
+    def __init__(self, weights=None, max_bytes=1024 * 1024):
+        self.weights = weights or {"live": 4, "backfill": 1}
+        self.credits = dict(self.weights)
+        self.max_bytes = max_bytes
+        self.lanes = {lane: deque() for lane in self.LANES}
+        self.partial = None  # (lane, rest of a frame) that must go out before anything else
+        self.bytes = 0  # Queued or being written
+        self.sent = dict.fromkeys(self.LANES, 0)  # Frames written per lane
+        self.closed = False
+
+        # put() runs once per recipient of every broadcast, so it takes a plain
+        # lock and only pays for a notify when someone is actually waiting
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)  # Writer waiting for frames
+        self.drained = threading.Condition(self.lock)  # wait_empty() callers
+        self.writer_waiting = False
+        self.flush_waiters = 0
+
+    def put(self, data, lane="live"):
+        with self.lock:
+            if self.closed:
+                raise OSError("Connection closed")
+            if self.bytes + len(data) > self.max_bytes:
+                raise SlowConsumerError(f"Outbound queue over {self.max_bytes} bytes")
+            self.lanes[lane].append(data)
+            self.bytes += len(data)
+            if self.writer_waiting:
+                self.ready.notify()
+
+    def pop(self):
+        """Take the next frame due without blocking, as (lane, data), or None"""
+        with self.lock:
+            return self._next()
+
+    def _next(self):
+        if self.partial is not None:
+            item, self.partial = self.partial, None
+            return item
+        if self.lanes["control"]:
+            return "control", self.lanes["control"].popleft()
+
+        ready = [lane for lane in ("live", "backfill") if self.lanes[lane]]
+        if not ready:
+            return None
+        if len(ready) == 1:
+            return ready[0], self.lanes[ready[0]].popleft()
+
+        # Both have frames waiting: weighted round robin
+        if not any(self.credits[lane] > 0 for lane in ready):
+            self.credits = dict(self.weights)
+        for lane in ready:
+            if self.credits[lane] > 0:
+                self.credits[lane] -= 1
+                return lane, self.lanes[lane].popleft()
+
+    def get(self):
+        """Block until a frame is due, returning (lane, data), or None once closed"""
+        with self.lock:
+            while not self.closed:
+                item = self._next()
+                if item is not None:
+                    return item
+                self.writer_waiting = True
+                self.ready.wait()
+                self.writer_waiting = False
+            return None
+
+    def put_back(self, lane, data):
+        """Hand back the unwritten rest of a frame taken with pop(); it goes out next"""
+        with self.lock:
+            self.partial = (lane, data)
+
+    def task_done(self, lane, size, frame_finished=True):
+        """Record that `size` bytes taken from `lane` have been written"""
+        with self.lock:
+            self.bytes -= size
+            if frame_finished:
+                self.sent[lane] += 1
+            if not self.bytes and self.flush_waiters:
+                self.drained.notify_all()
+
+    def wait_empty(self, timeout=None):
+        """Wait until everything queued has been written, returning whether it was"""
+        with self.lock:
+            self.flush_waiters += 1
+            try:
+                return self.drained.wait_for(lambda: self.closed or not self.bytes, timeout)
+            finally:
+                self.flush_waiters -= 1
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+            self.drained.notify_all()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": {lane: len(frames) for lane, frames in self.lanes.items()},
+                "queued_bytes": self.bytes,
+                "sent": dict(self.sent),
+            }
+
+
+class ClientRegistry:
+    """Sessions indexed by socket, username and IP address
+
+    Joins and leaves are O(1) dict updates under one lock. Broadcasters read
+    snapshot(), a tuple rebuilt lazily after membership changes, so fan-out
+    never holds the lock.
+    """
+
+    def __init__(self):
+        self.lock = InstrumentedLock("clients")
+        self._by_socket = {}  # {client_socket: session}
+        self._by_username = {}  # {username: {client_socket: session}}
+        self._by_ip = {}  # {ip: {client_socket: session}}
+        self._snapshot = ()
+
+    def __len__(self):
+        return len(self._by_socket)
+
+    def __contains__(self, client_socket):
+        return client_socket in self._by_socket
+
+    def get(self, client_socket):
+        return self._by_socket.get(client_socket)
+
+    def add(self, session):
+        with self.lock:
+            self._by_socket[session.socket] = session
+            self._by_username.setdefault(session.username, {})[session.socket] = session
+            self._by_ip.setdefault(session.ip, {})[session.socket] = session
+            self._snapshot = None
+
+    def remove(self, client_socket):
+        """Drop a session from every index, returning it if it was present"""
+        with self.lock:
+            session = self._by_socket.pop(client_socket, None)
+            if session is None:
+                return None
+            self._unindex(self._by_username, session.username, client_socket)
+            self._unindex(self._by_ip, session.ip, client_socket)
+            self._snapshot = None
+        return session
+
+    @staticmethod
+    def _unindex(index, key, client_socket):
+        sessions = index.get(key)
+        if sessions is not None:
+            sessions.pop(client_socket, None)
+            if not sessions:
+                del index[key]
+
+    def clear(self):
+        """Empty the registry, returning the sessions it held"""
+        with self.lock:
+            sessions = tuple(self._by_socket.values())
+            self._by_socket = {}
+            self._by_username = {}
+            self._by_ip = {}
+            self._snapshot = ()
+        return sessions
+
+    def snapshot(self):
+        """Immutable tuple of the current sessions, safe to iterate without a lock"""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self.lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._by_socket.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def find(self, username):
+        """Sessions logged in under a username (names are not unique)"""
+        with self.lock:
+            return tuple(self._by_username.get(username, {}).values())
+
+    def from_ip(self, ip):
+        with self.lock:
+            return tuple(self._by_ip.get(ip, {}).values())
+
+
+class RelayLink:
+    """A ChatServer's connection to the federation relay (relay_v002.py)
+
+    Messages published here reach every other node exactly once. Each node
+    tags what it publishes with its node id and a per-process instance id
+    plus sequence number, so echoes of our own messages and duplicates are
+    dropped on arrival.
+    """
+
+    def __init__(self, server, host, port, reconnect_delay=2.0, max_backlog=1000):
+        self.server = server
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.socket = None
+        self.send_lock = threading.Lock()
+        self.instance = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.backlog = deque(maxlen=max_backlog)  # Published while the relay was unreachable
+        self.peers = {}  # {node_id: {"instance", "last_seq", "frames", "lag_ms", "last_lag_ms", "last_seen"}}
+
+    @property
+    def connected(self):
+        return self.socket is not None
+
+    def start(self):
+        relay_thread = threading.Thread(target=self.run)
+        relay_thread.daemon = True
+        relay_thread.start()
+
+    def run(self):
+        while self.server.active:
+            relay_socket = None
+            try:
+                relay_socket = socket.create_connection((self.host, self.port), timeout=5)
+                relay_socket.settimeout(None)
+                relay_socket.sendall(encode_frame({
+                    "type": "relay_hello", "node_id": self.server.node_id, "instance": self.instance,
+                }))
+
+                with self.send_lock:
+                    self.socket = relay_socket
+                    while self.backlog:
+                        relay_socket.sendall(self.backlog.popleft())
+
+                self.server.log_event("SERVER", f"Joined federation relay {self.host}:{self.port}")
+
+                decoder = FrameDecoder()
+                while self.server.active:
+                    data = relay_socket.recv(65536)
+                    if not data:
+                        break
+                    for frame in decoder.feed(data):
+                        self.server.handle_relay_frame(frame)
+            except Exception as e:
+                if self.server.active:
+                    self.server.logger.error(f"Relay connection error: {e}")
+            finally:
+                with self.send_lock:
+                    self.socket = None
+                if relay_socket is not None:
+                    try:
+                        relay_socket.close()
+                    except:
+                        pass
+
+            time.sleep(self.reconnect_delay)
+
+    def publish(self, message):
+        """Send a local message to the other nodes, queueing it while the relay is unreachable"""
+        with self.send_lock:
+            self.seq += 1
+            data = encode_frame({
+                "type": "relay_publish",
+                "origin": self.server.node_id,
+                "instance": self.instance,
+                "seq": self.seq,
+                "sent_at": time.time(),
+                "message": message,
+            })
+
+            if self.socket is None:
+                self.backlog.append(data)
+                return
+
+            try:
+                self.socket.sendall(data)
+            except OSError:
+                self.backlog.append(data)
+
+    def new_peer(self, instance=None):
+        return {
+            "instance": instance, "last_seq": 0, "frames": 0,
+            "lag_ms": None, "last_lag_ms": None, "last_seen": None,
+        }
+
+    def accept(self, frame):
+        """Record a frame from another node, returning False for echoes and duplicates"""
+        origin = frame["origin"]
+        if origin == self.server.node_id:
+            return False
+
+        peer = self.peers.get(origin)
+        if peer is None or peer["instance"] != frame["instance"]:
+            # New peer, or the peer restarted and its sequence started over
+            peer = self.peers[origin] = self.new_peer(frame["instance"])
+
+        if frame["seq"] <= peer["last_seq"]:
+            return False
+
+        lag_ms = max(0.0, (time.time() - frame["sent_at"]) * 1000)
+        peer["last_seq"] = frame["seq"]
+        peer["frames"] += 1
+        peer["last_lag_ms"] = lag_ms
+        peer["lag_ms"] = lag_ms if peer["lag_ms"] is None else 0.8 * peer["lag_ms"] + 0.2 * lag_ms
+        peer["last_seen"] = time.time()
+        return True
+
+    def update_peers(self, node_ids):
+        """Track the nodes the relay says are linked, including ones that haven't spoken yet"""
+        for node_id in node_ids:
+            if node_id != self.server.node_id and node_id not in self.peers:
+                self.peers[node_id] = self.new_peer()
+        for node_id in list(self.peers):
+            if node_id not in node_ids:
+                del self.peers[node_id]
+
+    def status(self):
+        return {
+            "relay": f"{self.host}:{self.port}",
+            "connected": self.connected,
+            "backlog": len(self.backlog),
+            "peers": [
+                {
+                    "node_id": node_id,
+                    "frames": peer["frames"],
+                    "lag_ms": peer["lag_ms"],
+                    "last_lag_ms": peer["last_lag_ms"],
+                    "last_seen": peer["last_seen"],
+                }
+                for node_id, peer in list(self.peers.items())
+            ],
+        }
+
+
+class TrafficRecorder:
+    """Append every inbound frame, with its arrival time and connection id, to a capture file
+
+    Each line is [seconds since recording started, connection id, frame], with
+    a null frame when the connection closed. Paths ending in .gz are gzipped.
+    Lines are written by a background thread so handlers never wait on disk.
+    Replay captures with replay_v002.py.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.monotonic()
+        self.connection_ids = itertools.count(1)
+        self.queue = queue.SimpleQueue()
+        self.frames = 0
+
+        opener = gzip.open if path.endswith(".gz") else open
+        self.file = opener(path, "wt", encoding="utf-8")
+        self.file.write(json.dumps({"capture": 1, "started_at": time.time()}) + "\n")
+
+        self.writer_thread = threading.Thread(target=self.run)
+        self.writer_thread.daemon = True
+        self.writer_thread.start()
+
+    def next_connection_id(self):
+        return next(self.connection_ids)
+
+    def record(self, connection_id, frame):
+        self.queue.put([round(time.monotonic() - self.started, 6), connection_id, frame])
+
+    def record_close(self, connection_id):
+        self.record(connection_id, None)
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            entries = [self.queue.get()]
+            # Write whatever else has piled up in one go
+            while len(entries) < 1000:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            if None in entries:
+                stopping = True
+                entries = [entry for entry in entries if entry is not None]
+
+            self.file.write("".join(json.dumps(entry, separators=(",", ":")) + "\n" for entry in entries))
+            self.file.flush()
+            self.frames += len(entries)
+
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.writer_thread.join(timeout=5)
 
 
 class ChatServer:
-    def __init__(self, host="0.0.0.0", port=9999):
+    def __init__(self, host="0.0.0.0", port=9999, node_id=None, data_dir=None, logs_dir=None):
         self.host = host
         self.port = port
+        self.node_id = node_id or f"{socket.gethostname()}:{port}"
+        self.relay = None  # RelayLink when this server is part of a federation
+        self.recorder = None  # TrafficRecorder while inbound traffic is being captured
         self.server_socket = None
-        self.clients = {}  # {client_socket: {"username": username, "last_active": timestamp}}
-        self.logs = []
-        self.lock = threading.Lock()
+        self.clients = ClientRegistry()
+        self.max_logs = 1000  # In-memory events kept for the dashboard; the log file has everything
+        self.logs = deque(maxlen=self.max_logs)
+        self.logs_lock = InstrumentedLock("logs")
+        self.message_count = 0
         self.log_file_path = None
         self.active = True
-        self.message_history = []  # Store recent messages for new clients
+        self.accepting = True
+        self.handed_off = False  # Set once a reload has passed our sockets to a new process
+        self.next_message_id = 0  # Last id handed out, continues across reloads
+        self.drain_period = 5.0  # Seconds over which clients are disconnected after a reload
+        self.clock = time.time  # Liveness clock; the simulation harness swaps in a virtual one
+        self.heartbeat_interval = 5  # Seconds between idle client checks
+
+        # Each client's idle timeout adapts to how often it usually talks: a multiple
+        # of its smoothed gap between reads, within bounds. Where the kernel can
+        # keep a socket alive, its keepalive idle time follows the timeout and the
+        # kernel finds dead peers; other clients are pinged once the timeout passes.
+        # A ping must be answered within a few RTOs (srtt + 4 * rttvar), so slow
+        # links get longer to answer than a LAN
+        self.inactive_timeout = 120  # Seconds of silence allowed before we know the client's habits
+        self.min_idle_timeout = 30
+        self.max_idle_timeout = 600
+        self.idle_gap_factor = 4
+        self.min_pong_wait = 5  # Seconds
+        self.default_pong_wait = 15  # Until the round trip has been measured
+        self.keepalive_interval = 10  # Seconds between kernel keepalive probes
+        self.keepalive_count = 3  # Unanswered probes before the kernel gives up
+        self.rtt_interval = 60  # Seconds between pings that time each client's round trip
+
+        # Files are uploaded in chunks on the chat connection. Each transfer may have
+        # upload_window bytes unacknowledged, so chat from the same client is never
+        # stuck behind more than that. Finished files are kept in files_dir and
+        # fetched on a connection of their own, from any offset
+        self.max_file_size = 100 * 1024 * 1024
+        self.max_uploads = 4  # At once, per client
+        self.upload_window = 256 * 1024
+        self.partial_upload_ttl = 24 * 3600  # Seconds an abandoned upload is kept for resuming
+        self.file_bytes_received = 0
+        self.files_served = 0
+        self.file_bytes_served = 0
+
+        # Each session writes through its own OutboundQueue (control, live, backfill lanes)
+        self.lane_weights = {"live": 4, "backfill": 1}  # Frames per round once control is empty
+        self.max_queue_bytes = 1024 * 1024  # A client this far behind is dropped as a slow consumer
+        self.threaded_writers = True  # The simulation harness flushes queues itself instead
+        self.slow_consumer_drops = 0
         self.max_history = 50  # Max number of messages to store
+        self.message_history = deque(maxlen=self.max_history)  # Store recent messages for new clients
+        self.history_lock = InstrumentedLock("history")
+
+        # Clients page through older messages with history requests, answered from
+        # message_history or, further back, from an append-only archive on disk
+        self.max_history_page = 100  # Messages per history reply
+        self.history_rate = 2.0  # History requests per second per client, after a burst
+        self.history_burst = 10
+        self.archive_file = None  # Opened by start(); until then nothing is archived
+        self.archive_size = 0
+        self.archive_index_step = 256  # Messages between index entries
+        self.archive_ids = []  # Sparse index: the id starting every archive_index_step'th line
+        self.archive_offsets = []  # ...and that line's byte offset
+        self.archive_unindexed = 0
+        self.archive_lock = InstrumentedLock("archive")
+
+        # Recently seen client message ids per user, so retried sends are broadcast once
+        self.dedupe_window = 300  # Seconds a client id is remembered
+        self.max_dedupe_per_user = 1000
+        self.recent_client_ids = {}  # {username: OrderedDict(client_id: (id, timestamp, seen_at))}
+        self.dedupe_lock = InstrumentedLock("dedupe")
+
+        # Once a reload has snapshotted history for the new process, nothing more is
+        # numbered here: chat is held back unacknowledged, so clients resend it to the
+        # new process. If the reload is called off, the held back chat is recorded after all
+        self.handoff_frozen = False
+        self.withheld = []  # Callables that record what was held back
+
+        # Joins and leaves are batched into one presence frame per window
+        # instead of a broadcast each, so reconnect storms stay O(N) per window
+        self.presence_interval = 0.5  # Seconds
+        self.presence_lock = InstrumentedLock("presence")
+        self.pending_joins = Counter()
+        self.pending_leaves = Counter()
+        self.max_presence_names = 50  # Names listed per presence frame; the rest are counted
+
+        # Dashboard time series of [timestamp, clients, total messages] samples
+        self.series_interval = 10  # Seconds between samples
+        self.stats_series = deque(maxlen=360)  # One hour at the default interval
+        self.state_interval = 30  # Seconds between state snapshots on disk
 
         # Set up logging
         logging.basicConfig(
@@ -33,26 +753,51 @@ class ChatServer:
         self.logger = logging.getLogger('ChatServer')
 
         # Create logs directory if it doesn't exist
-        self.logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+        self.logs_dir = logs_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
         if not os.path.exists(self.logs_dir):
             os.makedirs(self.logs_dir)
             self.logger.info(f"Created logs directory: {self.logs_dir}")
 
+        # Saved server state for warm starts, the message archive and shared files.
+        # Nothing is created until start(), so servers that never start leave no trace
+        self.set_data_dir(data_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "state"))
+
         # Set up log file with timestamp in filename
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
         self.log_file_path = os.path.join(self.logs_dir, f"chat_log_{timestamp}.txt")
 
-        # Set up file handler for logging
-        file_handler = logging.FileHandler(self.log_file_path)
+        # Set up file handler for logging, replacing any an earlier server in this
+        # process added, so harnesses that build many servers don't stack them up
+        for handler in list(self.logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                self.logger.removeHandler(handler)
+                handler.close()
+        file_handler = logging.FileHandler(self.log_file_path, delay=True)  # Opened on the first record
         file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
         self.logger.addHandler(file_handler)
 
-    def start(self):
+    def set_data_dir(self, path):
+        """Keep saved state, the message archive and shared files under `path`"""
+        self.state_dir = path
+        self.state_path = os.path.join(path, "server_state.json")
+        self.archive_path = os.path.join(path, "messages.jsonl")
+        self.files_dir = os.path.join(path, "files")
+
+    def start(self, listen_socket=None):
+        """Start serving, either on a fresh socket or on one inherited from a reloading server"""
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(10)  # Increased from 5 to 10
+            if listen_socket is not None:
+                self.server_socket = listen_socket
+            else:
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(socket.SOMAXCONN)  # Absorb reconnect storms after a restart
+            self.port = self.server_socket.getsockname()[1]  # Resolves port 0 to the one picked
+            if not os.path.exists(self.files_dir):
+                os.makedirs(self.files_dir)  # And the data directory above it
+            self.open_archive()
+            self.purge_partial_uploads()
 
             self.log_event(
                 "SERVER", f"Server started on {self.host}:{self.port}"
@@ -64,6 +809,16 @@ class ChatServer:
             heartbeat_thread.daemon = True
             heartbeat_thread.start()
 
+            # Flush batched join/leave notifications
+            presence_thread = threading.Thread(target=self.presence_loop)
+            presence_thread.daemon = True
+            presence_thread.start()
+
+            # Sample dashboard stats and snapshot state to disk
+            state_thread = threading.Thread(target=self.state_loop)
+            state_thread.daemon = True
+            state_thread.start()
+
             # Accept client connections in a separate thread
             accept_thread = threading.Thread(target=self.accept_connections)
             accept_thread.daemon = True
@@ -75,7 +830,7 @@ class ChatServer:
             return False
 
     def accept_connections(self):
-        while self.active:
+        while self.active and self.accepting:
             try:
                 self.server_socket.settimeout(1.0)  # Set timeout for accept() to allow checking self.active
                 try:
@@ -93,18 +848,27 @@ class ChatServer:
                 break
 
     def handle_client(self, client_socket, address):
-        username = None
+        session = None
+        decoder = FrameDecoder()
+        recorder = self.recorder
+        connection_id = recorder.next_connection_id() if recorder else None
 
         try:
             # Set a timeout for initial connection
             client_socket.settimeout(10.0)
 
             # Wait for initial connect message
-            data = client_socket.recv(4096)
-            if not data:
-                return
-
-            message = json.loads(data.decode("utf-8"))
+            messages = []
+            while not messages:
+                data = client_socket.recv(4096)
+                if not data:
+                    return
+                messages = decoder.feed(data)
+                if recorder:
+                    for message in messages:
+                        recorder.record(connection_id, message)
+
+            message = messages.pop(0)
 
             if message["type"] == "connect":
                 username = message["username"]
@@ -112,185 +876,895 @@ class ChatServer:
                 # Reset timeout for normal operation
                 client_socket.settimeout(None)
 
-                with self.lock:
-                    self.clients[client_socket] = {
-                        "username": username,
-                        "address": f"{address[0]}:{address[1]}",
-                        "last_active": time.time(),
-                        "connected_at": time.time()
-                    }
-
-                self.log_event(
-                    "CONNECT",
-                    f"{username} connected from {address[0]}:{address[1]}",
-                )
-                self.broadcast_system_message(f"{username} has joined the chat")
-
-                # Send recent message history to the new client
-                self.send_history(client_socket)
+                session = self.open_session(client_socket, address, username, message.get("last_id"))
 
-                # Main message processing loop
+                # Main message processing loop, starting with anything that
+                # arrived in the same packet as the connect frame
                 while self.active:
-                    data = client_socket.recv(4096)
+                    for message in messages:
+                        session.messages_in += 1
+                        if not self.process_message(session, message):
+                            return
+
+                    data = client_socket.recv(65536)  # Room for a whole file chunk
                     if not data:
                         break
 
                     # Update last active timestamp
-                    with self.lock:
-                        if client_socket in self.clients:
-                            self.clients[client_socket]["last_active"] = time.time()
+                    session.note_activity(self.clock())
+                    session.bytes_in += len(data)
 
-                    message = json.loads(data.decode("utf-8"))
+                    messages = decoder.feed(data)
+                    if recorder:
+                        for message in messages:
+                            recorder.record(connection_id, message)
 
-                    if message["type"] == "disconnect":
-                        break
-                    elif message["type"] == "message":
-                        content = message["content"]
-                        self.log_event("MESSAGE", f"{username}: {content}")
-
-                        # Store in message history
-                        with self.lock:
-                            self.message_history.append({
-                                "type": "message",
-                                "username": username,
-                                "content": content,
-                                "timestamp": time.time()
-                            })
-                            # Trim history if needed
-                            if len(self.message_history) > self.max_history:
-                                self.message_history = self.message_history[-self.max_history:]
-
-                        self.broadcast_message(username, content)
-                    elif message["type"] == "ping":
-                        # Respond to ping with a pong
-                        try:
-                            client_socket.send(json.dumps({"type": "pong"}).encode("utf-8"))
-                        except:
-                            break
+            elif message["type"] == "file_get":
+                # A download, on a connection of its own so it never holds up chat
+                client_socket.settimeout(None)
+                self.serve_file(client_socket, address, message)
 
         except json.JSONDecodeError:
             self.log_event("ERROR", f"Invalid JSON from client {address}")
         except Exception as e:
-            if self.active:  # Only log if not shutting down
+            # Nothing to report if we are shutting down or another thread already dropped it
+            if self.active and not (session and session.socket not in self.clients):
                 self.log_event(
                     "ERROR",
-                    f"Error handling client {username if username else 'unknown'}: {e}",
+                    f"Error handling client {session.username if session else 'unknown'}: {e}",
                 )
 
         finally:
-            # Clean up on disconnect
-            if username:
-                with self.lock:
-                    if client_socket in self.clients:
-                        del self.clients[client_socket]
+            if recorder:
+                recorder.record_close(connection_id)
 
-                self.log_event("DISCONNECT", f"{username} disconnected")
-                self.broadcast_system_message(f"{username} has left the chat")
+            # Clean up on disconnect
+            if session:
+                self.drop_session(session)
+                self.close_uploads(session)
 
             try:
                 client_socket.close()
             except:
                 pass
 
-    def send_history(self, client_socket):
-        """Send recent message history to a newly connected client"""
+    def open_session(self, client_socket, address, username, last_id=None):
+        """Register a client that has sent its connect frame and bring it up to date"""
+        session = Session(client_socket, username, address, self.clock())
+        session.keepalive_idle = self.enable_keepalive(client_socket)
+        session.queue = OutboundQueue(self.lane_weights, self.max_queue_bytes)
+        if self.threaded_writers:
+            writer_thread = threading.Thread(target=self.session_writer, args=(session,))
+            writer_thread.daemon = True
+            writer_thread.start()
+        # Registered under the presence lock so the roster lines up exactly
+        # with the presence frames that follow it
+        with self.presence_lock:
+            self.clients.add(session)
+            self.note_presence(username, joined=True)
+            users = self.roster()
+
+        self.log_event(
+            "CONNECT",
+            f"{username} connected from {address[0]}:{address[1]}",
+        )
+
+        # Send the current roster and recent message history to the new client
+        self.send_roster(session, users)
+        self.send_history(session, last_id)
+        return session
+
+    def enable_keepalive(self, client_socket):
+        """Let the kernel probe an idle client socket, returning the idle seconds set
+
+        Returns None where keepalive can't be timed per socket (or the socket
+        isn't TCP), leaving dead peers to the heartbeat's pings.
+        """
+        if TCP_KEEPIDLE is None:
+            return None
         try:
-            with self.lock:
-                # Send the last N messages from history
-                for msg in self.message_history[-20:]:  # Send last 20 messages
-                    client_socket.send(json.dumps(msg).encode("utf-8"))
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, self.keepalive_interval)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, self.keepalive_count)
+            return self.set_keepalive_idle(client_socket, self.inactive_timeout)
+        except (OSError, AttributeError):
+            return None
+
+    def set_keepalive_idle(self, client_socket, idle):
+        """Start keepalive probes after `idle` seconds of silence, giving up when they go unanswered"""
+        idle = int(idle)
+        client_socket.setsockopt(socket.IPPROTO_TCP, TCP_KEEPIDLE, idle)
+        if hasattr(socket, "TCP_USER_TIMEOUT"):
+            # Also the longest sent data may go unacknowledged, so a peer that
+            # vanishes mid-write is given up on just as soon
+            deadline = idle + self.keepalive_interval * self.keepalive_count
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, deadline * 1000)
+        return idle
+
+    def session_writer(self, session):
+        """Write one session's queued frames to its socket, most urgent lane first"""
+        queue = session.queue
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+
+            lane, data = item
+            try:
+                session.socket.sendall(data)
+            except Exception:
+                self.drop_session(session, "connection error")
+                return
+            queue.task_done(lane, len(data))
+
+    def process_message(self, session, message):
+        """Act on one message from a connected client, returning False when it leaves"""
+        message_type = message["type"]
+
+        if message_type == "disconnect":
+            return False
+        elif message_type == "message":
+            self.handle_chat_message(session, message["content"], message.get("client_id"))
+        elif message_type == "whisper":
+            self.handle_whisper(session, message)
+        elif message_type == "history":
+            self.handle_history_request(session, message)
+        elif message_type in ("file_offer", "file_chunk") and self.handoff_frozen:
+            pass  # Left unacknowledged during a reload; offered again to the new process
+        elif message_type == "file_offer":
+            self.handle_file_offer(session, message)
+        elif message_type == "file_chunk":
+            self.handle_file_chunk(session, message)
+        elif message_type == "file_cancel":
+            upload = session.uploads.pop(message.get("transfer_id"), None)
+            if upload:
+                upload.close()
+        elif message_type == "ping":
+            # Clients report the round trip they measure from their own pings
+            if message.get("rtt") is not None:
+                try:
+                    session.client_rtt = float(message["rtt"])
+                    session.client_jitter = float(message.get("jitter") or 0.0)
+                except (TypeError, ValueError):
+                    pass
+
+            # Respond to ping with a pong, echoing its timestamp so the client can time it
+            pong = {"type": "pong"}
+            if "sent" in message:
+                pong["sent"] = message["sent"]
+            session.send(encode_frame(pong), "control")
+        elif message_type == "pong":
+            # Answer to one of our pings
+            sent = message.get("sent")
+            if isinstance(sent, (int, float)) and sent <= self.clock():
+                session.record_rtt(self.clock() - sent)
+
+        return True
+
+    def handle_chat_message(self, session, content, client_id=None, file=None):
+        message = {
+            "type": "message",
+            "username": session.username,
+            "content": content,
+            "timestamp": time.time()
+        }
+        if file:
+            message["file"] = file
+
+        def retry():
+            self.handle_chat_message(session, content, client_id, file)
+
+        if client_id:
+            with self.dedupe_lock:
+                seen = self.recent_client_ids.setdefault(session.username, OrderedDict())
+                original = seen.get(client_id)
+                if original is None:
+                    # Numbered under the same lock so a racing retry can't slip in between
+                    if self.record_message(message, retry) is None:
+                        return
+                    seen[client_id] = (message["id"], message["timestamp"], self.clock())
+                    if len(seen) > self.max_dedupe_per_user:
+                        seen.popitem(last=False)
+
+            if original is not None:
+                # A retry of something already broadcast: just confirm it again
+                session.send(encode_frame({
+                    "type": "ack",
+                    "client_id": client_id,
+                    "id": original[0],
+                    "timestamp": original[1],
+                    "duplicate": True,
+                }), "control")
+                return
+        elif self.record_message(message, retry) is None:
+            return
+
+        self.log_event("MESSAGE", f"{session.username}: {content}")
+
+        # The sender already shows its own message; it only needs to know it went out
+        self.broadcast(message, exclude=session)
+        session.send(encode_frame({
+            "type": "ack",
+            "client_id": client_id,
+            "id": message["id"],
+            "timestamp": message["timestamp"],
+        }), "control")
+
+        # Other federation nodes fan it out to their own clients
+        if self.relay:
+            self.relay.publish(message)
+
+    def record_message(self, message, retry=None):
+        """Number a message and store it in history (the deque trims itself)
+
+        Returns None, keeping `retry` for later, once a reload has taken its
+        handoff snapshot.
+        """
+        with self.history_lock:
+            if self.handoff_frozen:
+                if retry is not None:
+                    self.withheld.append(retry)
+                return None
+
+            self.next_message_id += 1
+            message["id"] = self.next_message_id
+            self.message_history.append(message)
+
+            # Still under the history lock, so the archive stays in id order
+            if self.archive_file is not None:
+                self.archive_message(message)
+        return message
+
+    def open_archive(self):
+        """Open the message archive for appending, indexing what the saved index doesn't cover"""
+        if not self.archive_path:
+            return
+
+        size = 0
+        lines = 0
+        last_line = None
+        ids, offsets = [], []
+        if os.path.exists(self.archive_path):
+            with open(self.archive_path, "rb") as archive:
+                # Carry on from an index restored with saved state (or kept from before a
+                # reload was called off) if it still fits the file, so only what was
+                # appended since is read, not the whole archive
+                with self.archive_lock:
+                    saved = (self.archive_size, self.archive_unindexed,
+                             list(self.archive_ids), list(self.archive_offsets))
+                if self.archive_index_fits(archive, saved[0], saved[2], saved[3]):
+                    size, lines, ids, offsets = saved
+                archive.seek(size)
+                for line in archive:
+                    if not line.endswith(b"\n"):
+                        break  # Torn by a crash mid-write; cut off below
+                    if lines % self.archive_index_step == 0:
+                        ids.append(json.loads(line)["id"])
+                        offsets.append(size)
+                    size += len(line)
+                    lines += 1
+                    last_line = line
+
+        archive_file = open(self.archive_path, "ab")
+        archive_file.truncate(size)
+
+        with self.history_lock:
+            with self.archive_lock:
+                self.archive_file = archive_file
+                self.archive_size = size
+                self.archive_ids = ids
+                self.archive_offsets = offsets
+                self.archive_unindexed = lines % self.archive_index_step
+
+            # After a cold start keep numbering past the archive, so its ids only ever increase
+            if last_line is not None:
+                self.next_message_id = max(self.next_message_id, json.loads(last_line)["id"])
+
+    def archive_index_fits(self, archive, size, ids, offsets):
+        """Whether a sparse index covering the first `size` bytes still describes `archive`"""
+        if not ids or os.fstat(archive.fileno()).st_size < size:
+            return False
+        try:
+            archive.seek(size - 1)
+            if archive.read(1) != b"\n":
+                return False
+            archive.seek(offsets[-1])
+            return json.loads(archive.readline())["id"] == ids[-1]
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def close_archive(self):
+        with self.archive_lock:
+            archive_file, self.archive_file = self.archive_file, None
+        if archive_file is not None:
+            archive_file.close()
+
+    def archive_message(self, message):
+        data = encode_frame(message)
+        with self.archive_lock:
+            if self.archive_unindexed == 0:
+                self.archive_ids.append(message["id"])
+                self.archive_offsets.append(self.archive_size)
+            self.archive_unindexed = (self.archive_unindexed + 1) % self.archive_index_step
+            try:
+                self.archive_file.write(data)
+                self.archive_size += len(data)
+            except OSError as e:
+                self.logger.error(f"Error writing message archive: {e}")
+
+    def read_archive(self, first_id, stop_id, limit, newest=False):
+        """Archived messages with first_id <= id < stop_id, the first `limit` (or last if `newest`)"""
+        with self.archive_lock:
+            if self.archive_file is None:
+                return []
+            self.archive_file.flush()
+            position = bisect.bisect_right(self.archive_ids, first_id) - 1
+            offset = self.archive_offsets[position] if position >= 0 else 0
+            end = self.archive_size
+
+        # Read outside the lock; lines are only ever appended after `end`
+        messages = deque(maxlen=limit) if newest else []
+        with open(self.archive_path, "rb") as archive:
+            archive.seek(offset)
+            while offset < end:
+                line = archive.readline()
+                offset += len(line)
+                message = json.loads(line)
+                if message["id"] >= stop_id:
+                    break
+                if message["id"] >= first_id:
+                    messages.append(message)
+                    if not newest and len(messages) == limit:
+                        break
+        return list(messages)
+
+    def prune_dedupe(self):
+        """Forget client ids older than the dedupe window"""
+        cutoff = self.clock() - self.dedupe_window
+        with self.dedupe_lock:
+            for username in list(self.recent_client_ids):
+                seen = self.recent_client_ids[username]
+                # Entries are in arrival order, so expired ones are all at the front
+                while seen and next(iter(seen.values()))[2] < cutoff:
+                    seen.popitem(last=False)
+                if not seen:
+                    del self.recent_client_ids[username]
+
+    def start_recording(self, path):
+        """Capture all inbound frames to `path` for later replay"""
+        self.recorder = TrafficRecorder(path)
+        self.log_event("SERVER", f"Recording inbound traffic to {path}")
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if recorder:
+            recorder.close()
+            self.log_event("SERVER", f"Recorded {recorder.frames} frames to {recorder.path}")
+
+    def join_federation(self, host, port):
+        """Link this server to a relay so messages are shared with the other nodes"""
+        self.relay = RelayLink(self, host, port)
+        self.relay.start()
+
+    def handle_relay_frame(self, frame):
+        if frame["type"] == "relay_peers":
+            self.relay.update_peers(frame["nodes"])
+        elif frame["type"] == "relay_publish":
+            if not self.relay.accept(frame):
+                return
+            self.deliver_remote(frame)
+
+    def deliver_remote(self, frame):
+        """Record and broadcast a message published by another node"""
+        # Renumber in our own sequence; ids are only meaningful per node
+        remote = frame["message"]
+        message = self.record_message({
+            "type": "message",
+            "username": remote["username"],
+            "content": remote["content"],
+            "timestamp": remote["timestamp"],
+            "origin": frame["origin"],
+        }, lambda: self.deliver_remote(frame))
+        if message is None:
+            return
+
+        self.log_event("MESSAGE", f"{message['username']}@{frame['origin']}: {message['content']}")
+        self.broadcast(message)
+
+    def handle_whisper(self, session, message):
+        """Deliver a private message to one user only, echoing it back to the sender as an ack"""
+        recipient = message.get("to")
+        content = message.get("content")
+
+        if not isinstance(recipient, str) or not isinstance(content, str):
+            self.send_error(session, "Usage: /w <username> <message>")
+            return
+        recipient = recipient.strip()
+        if not recipient or not content:
+            self.send_error(session, "Usage: /w <username> <message>")
+            return
+        if recipient == session.username:
+            self.send_error(session, "You cannot whisper to yourself")
+            return
+
+        whisper = {
+            "type": "whisper",
+            "from": session.username,
+            "to": recipient,
+            "content": content,
+            "timestamp": time.time(),
+        }
+
+        if not self.deliver_to(recipient, whisper):
+            self.send_error(session, f"{recipient} is not online")
+            return
+
+        # Only the route is logged; whisper content stays between the two users
+        self.log_event("WHISPER", f"{session.username} -> {recipient}")
+
+        whisper["echo"] = True
+        session.send(encode_frame(whisper), "live")  # Chat content, like the copy the recipient gets
+
+    def handle_file_offer(self, session, message):
+        """Start or resume receiving a file, telling the client which offset to send from"""
+        transfer_id = message.get("transfer_id")
+        name = os.path.basename(str(message.get("name") or "")).strip()
+        size = message.get("size")
+        sha256 = message.get("sha256")
+
+        if (not valid_file_id(transfer_id) or not name or not isinstance(size, int) or size < 0
+                or not isinstance(sha256, str)):
+            self.send_file_error(session, transfer_id, "Invalid file offer")
+            return
+        if size > self.max_file_size:
+            self.send_file_error(session, transfer_id,
+                                 f"Files are limited to {self.max_file_size // (1024 * 1024)} MB")
+            return
+
+        path = os.path.join(self.files_dir, transfer_id)
+        if os.path.exists(path):
+            # Finished before the client heard about it; just say so again
+            session.send(encode_frame({
+                "type": "file_ack", "transfer_id": transfer_id, "offset": size, "done": True,
+            }), "control")
+            return
+
+        upload = session.uploads.get(transfer_id)
+        if upload is None:
+            if len(session.uploads) >= self.max_uploads:
+                self.send_file_error(session, transfer_id, f"At most {self.max_uploads} uploads at once")
+                return
+            try:
+                upload = Upload(transfer_id, name, size, sha256.lower(), path)
+            except OSError as e:
+                self.log_event("ERROR", f"Could not store upload from {session.username}: {e}")
+                self.send_file_error(session, transfer_id, "The server could not store the file")
+                return
+            session.uploads[transfer_id] = upload
+
+        session.send(encode_frame({
+            "type": "file_accept",
+            "transfer_id": transfer_id,
+            "offset": upload.received,
+            "window": self.upload_window,
+        }), "control")
+        if upload.received == size:
+            self.finish_upload(session, upload)
+
+    def handle_file_chunk(self, session, message):
+        """Append one chunk to its upload, acknowledging it to open the window again"""
+        upload = session.uploads.get(message.get("transfer_id"))
+        if upload is None:
+            return  # Sent before this connection's offer, or after a cancel; the client is told where to resume
+
+        try:
+            data = base64.b64decode(message.get("data") or "", validate=True)
+        except (binascii.Error, ValueError):
+            self.fail_upload(session, upload, "Corrupt file chunk")
+            return
+
+        if message.get("offset") != upload.received:
+            # Out of step with what we have; the client starts again from here
+            session.send(encode_frame({
+                "type": "file_accept",
+                "transfer_id": upload.transfer_id,
+                "offset": upload.received,
+                "window": self.upload_window,
+            }), "control")
+            return
+        if len(data) > self.upload_window or upload.received + len(data) > upload.size:
+            self.fail_upload(session, upload, "More data than the file offered")
+            return
+
+        upload.write(data)
+        self.file_bytes_received += len(data)
+        if upload.received == upload.size:
+            self.finish_upload(session, upload)
+        else:
+            session.send(encode_frame({
+                "type": "file_ack",
+                "transfer_id": upload.transfer_id,
+                "offset": upload.received,
+                "window": self.upload_window,
+            }), "control")
+
+    def finish_upload(self, session, upload):
+        """Check a complete upload against its hash and share it as a chat message"""
+        session.uploads.pop(upload.transfer_id, None)
+        upload.close()
+
+        if upload.digest.hexdigest() != upload.sha256:
+            os.remove(upload.path + ".part")
+            self.send_file_error(session, upload.transfer_id, f"{upload.name} was damaged in transfer")
+            return
+
+        os.replace(upload.path + ".part", upload.path)
+        session.send(encode_frame({
+            "type": "file_ack", "transfer_id": upload.transfer_id, "offset": upload.size, "done": True,
+        }), "control")
+        self.log_event("FILE", f"{session.username} uploaded {upload.name} ({upload.size} bytes)")
+
+        # Announced like any other message, so it is numbered, archived and
+        # acknowledged (with the transfer id as client id)
+        file = {"id": upload.transfer_id, "name": upload.name, "size": upload.size, "sha256": upload.sha256}
+        self.handle_chat_message(session, f"shared {upload.name} ({upload.size:,} bytes)",
+                                 upload.transfer_id, file)
+
+    def fail_upload(self, session, upload, reason):
+        session.uploads.pop(upload.transfer_id, None)
+        upload.close()
+        try:
+            os.remove(upload.path + ".part")
+        except OSError:
+            pass
+        self.send_file_error(session, upload.transfer_id, reason)
+
+    def send_file_error(self, session, transfer_id, content):
+        session.send(encode_frame({
+            "type": "file_error", "transfer_id": transfer_id, "content": content, "timestamp": time.time(),
+        }), "control")
+
+    def close_uploads(self, session):
+        """Close a departed session's unfinished uploads, keeping what arrived for a resume"""
+        for upload in list(session.uploads.values()):
+            upload.close()
+        session.uploads.clear()
+
+    def purge_partial_uploads(self):
+        """Delete uploads abandoned for longer than partial_upload_ttl"""
+        if not self.files_dir or not os.path.isdir(self.files_dir):
+            return
+        cutoff = time.time() - self.partial_upload_ttl
+        for name in os.listdir(self.files_dir):
+            path = os.path.join(self.files_dir, name)
+            try:
+                if name.endswith(".part") and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def serve_file(self, client_socket, address, request):
+        """Stream a stored file from the requested offset, then hang up
+
+        A file_data header frame is followed by the raw bytes, which
+        socket.sendfile() hands to the kernel (os.sendfile where there is one)
+        without copying them through Python. A client that lost the
+        connection asks again from the offset it got to.
+        """
+        file_id = request.get("file_id")
+        offset = request.get("offset") or 0
+        path = os.path.join(self.files_dir, file_id) if valid_file_id(file_id) else None
+
+        if path is None or not os.path.isfile(path):
+            client_socket.sendall(encode_frame({"type": "error", "content": "No such file"}))
+            return
+
+        with open(path, "rb") as stored:
+            size = os.fstat(stored.fileno()).st_size
+            if not isinstance(offset, int) or not 0 <= offset <= size:
+                client_socket.sendall(encode_frame({"type": "error", "content": "Bad offset"}))
+                return
+
+            client_socket.sendall(encode_frame({"type": "file_data", "file_id": file_id, "offset": offset, "size": size}))
+            sent = client_socket.sendfile(stored, offset)
+
+        self.files_served += 1
+        self.file_bytes_served += sent
+        self.log_event("FILE", f"Sent {file_id} to {address[0]}:{address[1]} from offset {offset}")
+
+    def send_error(self, session, content):
+        session.send(encode_frame({"type": "error", "content": content, "timestamp": time.time()}), "control")
+
+    def send_history(self, session, last_id=None):
+        """Send recent message history to a newly connected client
+
+        A client that says which message it saw last catches up with history
+        requests instead, so it only gets the welcome.
+        """
+        try:
+            # Copy the last N messages out so no lock is held while sending
+            with self.history_lock:
+                recent = list(self.message_history)[-20:] if last_id is None else []  # Send last 20 messages
+
+            # History is backfill, so live messages aren't held up behind it
+            for msg in recent:
+                session.send(encode_frame(msg), "backfill")
 
             # Send a welcome message
-            client_socket.send(
-                json.dumps({
+            session.send(
+                encode_frame({
                     "type": "system",
                     "content": "Welcome to the chat! Here are the most recent messages.",
                     "timestamp": time.time()
-                }).encode("utf-8")
+                }),
+                "backfill",
             )
         except Exception as e:
             self.logger.error(f"Error sending history: {e}")
 
+    def handle_history_request(self, session, message):
+        """Send one batch of older (before_id) or missed (after_id) messages
+
+        The reply is a single frame on the backfill lane, and each client has a
+        request allowance, so paging through history can't crowd out live chat.
+        """
+        try:
+            before_id = message.get("before_id")
+            after_id = message.get("after_id")
+            before_id = None if before_id is None else int(before_id)
+            after_id = None if after_id is None else int(after_id)
+            limit = min(max(int(message.get("limit") or self.max_history_page), 1), self.max_history_page)
+        except (TypeError, ValueError):
+            self.send_error(session, "Invalid history request")
+            return
+
+        reply = {"type": "history", "before_id": before_id, "after_id": after_id}
+
+        # Token bucket: history_burst requests at once, then history_rate per second
+        now = self.clock()
+        if session.history_tokens is None:
+            session.history_tokens = self.history_burst
+        else:
+            session.history_tokens = min(
+                self.history_burst,
+                session.history_tokens + (now - session.history_checked) * self.history_rate,
+            )
+        session.history_checked = now
+
+        if session.history_tokens < 1:
+            reply.update(messages=[], has_more=True, retry_after=(1 - session.history_tokens) / self.history_rate)
+            session.send(encode_frame(reply), "control")
+            return
+        session.history_tokens -= 1
+
+        messages, has_more = self.history_page(before_id, after_id, limit)
+        reply.update(messages=messages, has_more=has_more, timestamp=time.time())
+        session.send(encode_frame(reply), "backfill")
+
+    def history_page(self, before_id, after_id, limit):
+        """Up to `limit` messages after `after_id`, or else before `before_id` (default the newest)
+
+        Returns (messages oldest first, whether more lie beyond them).
+        """
+        with self.history_lock:
+            ring = list(self.message_history)
+            newest_id = self.next_message_id
+        oldest_in_ring = ring[0]["id"] if ring else newest_id + 1
+
+        # The archive only fills in what is older than the ring, so a page is never
+        # short of messages the ring holds, even if the archive lost some (or is gone)
+        if after_id is not None:
+            messages = []
+            if after_id + 1 < oldest_in_ring and self.archive_file is not None:
+                messages = self.read_archive(after_id + 1, oldest_in_ring, limit + 1)
+            messages += [m for m in ring if m["id"] > after_id][:limit + 1 - len(messages)]
+            return messages[:limit], len(messages) > limit
+
+        if before_id is None:
+            before_id = newest_id + 1
+        messages = [m for m in ring if m["id"] < before_id]
+        if len(messages) <= limit and oldest_in_ring > 1 and self.archive_file is not None:
+            older = self.read_archive(max(before_id - limit - 1, 0), min(before_id, oldest_in_ring),
+                                      limit + 1 - len(messages), newest=True)
+            messages = older + messages
+        return messages[-limit:], len(messages) > limit
+
     def client_heartbeat(self):
         """Periodically check for inactive clients and clean them up"""
         while self.active:
-            time.sleep(30)  # Check every 30 seconds
-
-            current_time = time.time()
-            inactive_timeout = 120  # 2 minutes
-
-            disconnected_clients = []
-
-            with self.lock:
-                for client_socket, info in list(self.clients.items()):
-                    if current_time - info["last_active"] > inactive_timeout:
-                        try:
-                            # Try to send a ping
-                            client_socket.send(json.dumps({"type": "ping"}).encode("utf-8"))
-                        except:
-                            # Failed to send - client is disconnected
-                            disconnected_clients.append((client_socket, info["username"]))
-
-            # Clean up disconnected clients
-            for client_socket, username in disconnected_clients:
-                with self.lock:
-                    if client_socket in self.clients:
-                        del self.clients[client_socket]
-
-                self.log_event("DISCONNECT", f"{username} disconnected (timeout)")
-                self.broadcast_system_message(f"{username} has left the chat (timeout)")
-
+            time.sleep(self.heartbeat_interval)
+            self.check_heartbeats()
+
+    def idle_timeout(self, session):
+        """Seconds of silence before checking on a session, from how often it usually talks"""
+        if session.gap is None:
+            return self.inactive_timeout
+        return min(self.max_idle_timeout, max(self.min_idle_timeout, session.gap * self.idle_gap_factor))
+
+    def pong_wait(self, session):
+        """Seconds a session has to answer a ping, a few retransmission timeouts of its own link"""
+        if session.rtt is not None:
+            rtt, rtt_var = session.rtt, session.rtt_var
+        elif session.client_rtt is not None:
+            rtt, rtt_var = session.client_rtt, session.client_jitter
+        else:
+            return self.default_pong_wait
+        return max(self.min_pong_wait, 4 * (rtt + 4 * rtt_var))
+
+    def check_heartbeats(self):
+        """Check on every client, dropping those that can no longer be reached
+
+        Clients whose sockets the kernel keeps alive are only pinged to time
+        the round trip; the others are also pinged once quiet for longer than
+        their idle timeout. A ping that goes unanswered for too long, or can't
+        be sent, drops the client.
+        """
+        current_time = self.clock()
+        disconnected_clients = []
+        ping = encode_frame({"type": "ping", "sent": current_time})
+
+        for session in self.clients.snapshot():
+            if session.pinged_at is not None:
+                if current_time - session.pinged_at > self.pong_wait(session):
+                    disconnected_clients.append(session)
+                continue  # Still waiting for the answer
+
+            timeout = self.idle_timeout(session)
+            session.idle_timeout = timeout
+            if session.keepalive_idle is not None:
+                # Retune the kernel when the timeout has moved by more than an eighth
+                if abs(timeout - session.keepalive_idle) > session.keepalive_idle / 8:
+                    try:
+                        session.keepalive_idle = self.set_keepalive_idle(session.socket, timeout)
+                    except OSError:
+                        pass
+                silent_too_long = False
+            else:
+                silent_too_long = current_time - session.last_active > timeout
+
+            if silent_too_long or current_time - session.last_ping >= self.rtt_interval:
+                session.last_ping = session.pinged_at = current_time
                 try:
-                    client_socket.close()
+                    # Try to send a ping; the pong echoes "sent" back
+                    session.send(ping, "control")
                 except:
-                    pass
+                    # Failed to send - client is disconnected
+                    disconnected_clients.append(session)
 
-    def broadcast_message(self, sender, content):
-        message = json.dumps(
-            {
-                "type": "message",
-                "username": sender,
-                "content": content,
-                "timestamp": time.time(),
-            }
-        )
+        # Clean up disconnected clients
+        for session in disconnected_clients:
+            self.drop_session(session, "timeout")
 
-        self.broadcast(message)
+        return disconnected_clients
 
-    def broadcast_system_message(self, content):
-        message = json.dumps(
-            {"type": "system", "content": content, "timestamp": time.time()}
-        )
+    def broadcast_system_message(self, content, lane="live"):
+        message = {"type": "system", "content": content, "timestamp": time.time()}
 
-        self.broadcast(message)
+        self.broadcast(message, lane=lane)
 
-    def broadcast(self, message_json):
+    def broadcast(self, message, exclude=None, lane="live"):
         disconnected_clients = []
+        data = encode_frame(message)  # Serialise once for every recipient
 
-        with self.lock:
-            for client_socket in self.clients:
-                try:
-                    client_socket.send(message_json.encode("utf-8"))
-                except:
-                    disconnected_clients.append(client_socket)
+        # Iterate the current snapshot; joins and leaves never block the fan-out
+        for session in self.clients.snapshot():
+            if session is exclude:
+                continue
+            try:
+                session.send(data, lane)
+            except SlowConsumerError:
+                disconnected_clients.append((session, "slow consumer"))
+            except:
+                disconnected_clients.append((session, "connection error"))
 
         # Clean up any disconnected clients
-        for client_socket in disconnected_clients:
-            with self.lock:
-                if client_socket in self.clients:
-                    username = self.clients[client_socket]["username"]
-                    del self.clients[client_socket]
-                    self.log_event(
-                        "DISCONNECT", f"{username} disconnected (connection error)"
-                    )
+        for session, reason in disconnected_clients:
+            self.drop_session(session, reason)
+
+    def deliver_to(self, username, message):
+        """Send a message to every session of one user, returning how many got it"""
+        data = encode_frame(message)
+        delivered = 0
+
+        for session in self.clients.find(username):
+            try:
+                session.send(data)
+                delivered += 1
+            except SlowConsumerError:
+                self.drop_session(session, "slow consumer")
+            except:
+                self.drop_session(session, "connection error")
+
+        return delivered
+
+    def drop_session(self, session, reason=None):
+        """Unregister a session and announce the leave, once, whoever notices first"""
+        with self.presence_lock:
+            if self.clients.remove(session.socket) is None:
+                return  # Already cleaned up elsewhere
+            self.note_presence(session.username, joined=False)
+
+        if reason == "slow consumer":
+            self.slow_consumer_drops += 1
+
+        suffix = f" ({reason})" if reason else ""
+        self.log_event("DISCONNECT", f"{session.username} disconnected{suffix}")
+
+        # Closing also wakes the handler thread if it is still blocked in recv(),
+        # and the writer thread if it is waiting for frames
+        session.close()
+
+    def note_presence(self, username, joined):
+        """Queue a join or leave for the next presence frame (caller holds presence_lock)"""
+        # A leave and a rejoin inside one window cancel each other out
+        if joined:
+            if self.pending_leaves[username]:
+                self.pending_leaves[username] -= 1
+            else:
+                self.pending_joins[username] += 1
+        else:
+            if self.pending_joins[username]:
+                self.pending_joins[username] -= 1
+            else:
+                self.pending_leaves[username] += 1
+
+    def presence_loop(self):
+        while self.active:
+            time.sleep(self.presence_interval)
+            self.flush_presence()
+
+    def flush_presence(self):
+        """Broadcast everything queued since the last flush as one presence frame"""
+        with self.presence_lock:
+            joins, self.pending_joins = +self.pending_joins, Counter()
+            leaves, self.pending_leaves = +self.pending_leaves, Counter()
+            online = len(self.clients)
+
+        if not joins and not leaves:
+            return
+
+        joined = list(joins.elements())
+        left = list(leaves.elements())
+
+        self.broadcast({
+            "type": "presence",
+            "joined": joined[:self.max_presence_names],
+            "left": left[:self.max_presence_names],
+            "joined_count": len(joined),
+            "left_count": len(left),
+            "online": online,
+            "timestamp": time.time(),
+        }, lane="control")
+
+    def roster(self):
+        """Who was online as of the last presence frame (caller holds presence_lock)
+
+        Joins and leaves since then reach the client in the next presence
+        frame, so they are left out here rather than counted twice.
+        """
+        users = Counter(s.username for s in self.clients.snapshot())
+        users.subtract(self.pending_joins)
+        users.update(self.pending_leaves)
+        return sorted((+users).elements())
+
+    def send_roster(self, session, users):
+        """Send a newly connected client everyone who is online"""
+        session.send(encode_frame({
+            "type": "roster",
+            "users": users,
+            "online": len(users),
+            "timestamp": time.time(),
+        }), "control")
 
     def log_event(self, event_type, message):
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         log_entry = {"timestamp": timestamp, "type": event_type, "message": message}
 
         # Add to in-memory logs
-        with self.lock:
+        with self.logs_lock:
             self.logs.append(log_entry)
+            if event_type == "MESSAGE":
+                self.message_count += 1
 
         # Log to console and file via logger
         if event_type == "ERROR":
@@ -305,13 +1779,260 @@ class ChatServer:
         except Exception as e:
             self.logger.error(f"Error writing to log file: {e}")
 
+    def status_snapshot(self):
+        """Copy the state shown on the dashboard so it can be serialised lock-free"""
+        sessions = self.clients.snapshot()
+        clients_detailed = [session.to_dict() for session in sessions]
+
+        # Outbound lane totals across all sessions
+        lanes = {
+            "sent": Counter(),
+            "queued": Counter(),
+            "queued_bytes": 0,
+            "slow_consumer_drops": self.slow_consumer_drops,
+        }
+        for client in clients_detailed:
+            if client["lanes"]:
+                lanes["sent"].update(client["lanes"]["sent"])
+                lanes["queued"].update(client["lanes"]["queued"])
+                lanes["queued_bytes"] += client["lanes"]["queued_bytes"]
+
+        with self.logs_lock:
+            logs = list(self.logs)
+            message_count = self.message_count
+
+        return {
+            "client_count": len(sessions),
+            "clients": [session.username for session in sessions],
+            "clients_detailed": clients_detailed,
+            "logs": logs,
+            "message_count": message_count,
+            "series": list(self.stats_series),
+            "lanes": lanes,
+            "files": {
+                "uploading": sum(len(session.uploads) for session in sessions),
+                "bytes_received": self.file_bytes_received,
+                "served": self.files_served,
+                "bytes_served": self.file_bytes_served,
+            },
+            "node_id": self.node_id,
+            "federation": self.relay.status() if self.relay else None,
+        }
+
+    def lock_report(self, top=None):
+        """Lock contention report across all server locks, top contenders (by total wait) first"""
+        report = []
+        for lock in (self.clients.lock, self.logs_lock, self.history_lock, self.presence_lock, self.dedupe_lock,
+                     self.archive_lock):
+            report.extend(lock.report())
+        report.sort(key=lambda entry: entry["wait_total_ms"], reverse=True)
+        return report[:top] if top else report
+
+    def reset_lock_stats(self):
+        for lock in (self.clients.lock, self.logs_lock, self.history_lock, self.presence_lock, self.dedupe_lock,
+                     self.archive_lock):
+            lock.reset()
+
+    def snapshot_state(self):
+        """Capture history, counters and sequence state so another process can carry on"""
+        with self.history_lock:
+            history = list(self.message_history)
+            next_message_id = self.next_message_id
+
+        with self.logs_lock:
+            message_count = self.message_count
+
+        # The archive's sparse index, so the next start needn't rebuild it from the whole file
+        with self.archive_lock:
+            archive = {
+                "size": self.archive_size,
+                "unindexed": self.archive_unindexed,
+                "ids": list(self.archive_ids),
+                "offsets": list(self.archive_offsets),
+            }
+
+        # Carried over so clients resending after a reload aren't broadcast twice
+        with self.dedupe_lock:
+            dedupe = {
+                username: [[client_id, *entry] for client_id, entry in seen.items()]
+                for username, seen in self.recent_client_ids.items()
+            }
+
+        return {
+            "version": 1,
+            "saved_at": time.time(),
+            "next_message_id": next_message_id,
+            "message_count": message_count,
+            "message_history": history,
+            "series": list(self.stats_series),
+            "dedupe": dedupe,
+            "archive": archive,
+        }
+
+    def restore_state(self, state):
+        with self.history_lock:
+            self.message_history.extend(state["message_history"])
+            self.next_message_id = max(self.next_message_id, state["next_message_id"])
+
+        with self.logs_lock:
+            self.message_count += state["message_count"]
+
+        self.stats_series.extend(state.get("series", []))
+
+        # Only a hint: open_archive() checks it against the file before relying on it
+        archive = state.get("archive")
+        if archive:
+            with self.archive_lock:
+                if self.archive_file is None:
+                    self.archive_size = archive["size"]
+                    self.archive_unindexed = archive["unindexed"]
+                    self.archive_ids = archive["ids"]
+                    self.archive_offsets = archive["offsets"]
+
+        with self.dedupe_lock:
+            for username, entries in state.get("dedupe", {}).items():
+                seen = self.recent_client_ids.setdefault(username, OrderedDict())
+                for client_id, message_id, timestamp, seen_at in entries:
+                    seen[client_id] = (message_id, timestamp, seen_at)
+        self.prune_dedupe()
+
+    def save_state(self):
+        """Atomically write a compact snapshot_state() to disk for the next warm start"""
+        temp_path = self.state_path + ".tmp"
+        try:
+            with open(temp_path, "w", encoding="utf-8") as state_file:
+                json.dump(self.snapshot_state(), state_file, separators=(",", ":"))
+            os.replace(temp_path, self.state_path)
+        except Exception as e:
+            self.logger.error(f"Error saving server state: {e}")
+
+    def load_saved_state(self):
+        """Warm start from the last saved snapshot, returning whether one was loaded"""
+        if not os.path.exists(self.state_path):
+            return False
+
+        started = time.perf_counter()
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as state_file:
+                self.restore_state(json.load(state_file))
+        except Exception as e:
+            self.logger.error(f"Error loading saved server state: {e}")
+            return False
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.log_event(
+            "SERVER",
+            f"Warm start: {len(self.message_history)} messages restored in {elapsed_ms:.1f} ms",
+        )
+        return True
+
+    def sample_stats(self):
+        with self.logs_lock:
+            message_count = self.message_count
+        self.stats_series.append([time.time(), len(self.clients), message_count])
+
+    def state_loop(self):
+        last_saved = time.time()
+
+        # Stop once a reload starts; the new process owns the saved state from then on
+        while self.active and self.accepting:
+            time.sleep(self.series_interval)
+            self.sample_stats()
+            self.prune_dedupe()
+
+            if time.time() - last_saved >= self.state_interval:
+                self.save_state()
+                last_saved = time.time()
+
+    def write_handoff_state(self):
+        """Write snapshot_state() to a file for the process taking over, returning its path
+
+        Nothing is numbered after the snapshot, so the new process never
+        reuses an id we have already acknowledged.
+        """
+        path = os.path.join(self.logs_dir, f"handoff_{os.getpid()}.json")
+        with self.history_lock:
+            self.handoff_frozen = True
+        self.close_archive()  # The new process appends to it from here on
+        with open(path, "w", encoding="utf-8") as state_file:
+            json.dump(self.snapshot_state(), state_file)
+        return path
+
+    def cancel_handoff(self):
+        """Carry on after a reload was called off, recording the chat held back meanwhile"""
+        self.open_archive()  # Closed for the new process; the index kept in memory still fits
+        with self.history_lock:
+            self.handoff_frozen = False
+            withheld, self.withheld = self.withheld, []
+
+        for retry in withheld:
+            try:
+                retry()
+            except Exception as e:
+                self.log_event("ERROR", f"Error recording held back message: {e}")
+
+    def load_handoff_state(self, path):
+        with open(path, "r", encoding="utf-8") as state_file:
+            self.restore_state(json.load(state_file))
+        os.remove(path)
+        self.log_event("SERVER", f"Restored state from {path}")
+
+    def drain(self, period=None, batches=10):
+        """Stop accepting, then disconnect existing clients in batches spread over `period` seconds
+
+        Used after a reload has handed the listening socket to a new process,
+        so clients reconnect to it gradually instead of all at once.
+        """
+        period = self.drain_period if period is None else period
+        self.accepting = False
+        sessions = self.clients.snapshot()
+        self.log_event("SERVER", f"Draining {len(sessions)} clients over {period:g}s")
+
+        self.broadcast({
+            "type": "system",
+            "content": "Server is restarting, please reconnect.",
+            "reconnect": True,
+            "timestamp": time.time(),
+        }, lane="control")
+
+        batch_size = max(1, -(-len(sessions) // batches))
+        for start in range(0, len(sessions), batch_size):
+            for session in sessions[start:start + batch_size]:
+                if self.clients.remove(session.socket) is not None:
+                    # Let the restart notice go out before hanging up
+                    if session.queue is not None:
+                        session.queue.wait_empty(timeout=0.5)
+                    session.close()
+            time.sleep(period / batches)
+
+        self.handed_off = True
+        self.active = False
+
+        # Anyone accepted while the snapshot was being taken
+        for session in self.clients.clear():
+            session.close()
+
+        try:
+            self.server_socket.close()
+        except:
+            pass
+
+        self.stop_recording()
+        self.log_event("SERVER", "Drain complete, handed off to new process")
+
     def shutdown(self):
+        if self.handed_off:
+            return  # Clients and sockets now belong to the new process
+
         self.active = False
+        self.save_state()
+        self.stop_recording()
+        self.close_archive()
         self.log_event("SERVER", "Server shutting down")
 
         # Notify all clients
         try:
-            self.broadcast_system_message("Server is shutting down...")
+            self.broadcast_system_message("Server is shutting down...", lane="control")
         except:
             pass
 
@@ -319,14 +2040,8 @@ class ChatServer:
         time.sleep(1)
 
         # Disconnect all clients
-        with self.lock:
-            for client_socket in list(self.clients.keys()):
-                try:
-                    client_socket.close()
-                except:
-                    pass
-
-            self.clients.clear()
+        for session in self.clients.clear():
+            session.close()
 
         # Close server socket
         if self.server_socket:
@@ -507,11 +2222,12 @@ if not os.path.exists(templates_dir):
                         <th>IP Address</th>
                         <th>Connected Since</th>
                         <th>Last Active</th>
+                        <th>RTT</th>
                     </tr>
                 </thead>
                 <tbody id="clientsList">
                     <tr>
-                        <td colspan="4">Loading clients...</td>
+                        <td colspan="5">Loading clients...</td>
                     </tr>
                 </tbody>
             </table>
@@ -579,7 +2295,7 @@ if not os.path.exists(templates_dir):
             const clientsList = document.getElementById('clientsList');
 
             if (!clients || clients.length === 0) {
-                clientsList.innerHTML = '<tr><td colspan="4">No clients connected</td></tr>';
+                clientsList.innerHTML = '<tr><td colspan="5">No clients connected</td></tr>';
                 return;
             }
 
@@ -594,6 +2310,7 @@ if not os.path.exists(templates_dir):
                     <td>${escapeHtml(client.address)}</td>
                     <td>${formatDate(connectedSince)}</td>
                     <td>${formatDate(lastActive)}</td>
+                    <td>${client.rtt_ms === null ? '&mdash;' : client.rtt_ms.toFixed(1) + ' ms'}</td>
                 </tr>`;
             });
 
@@ -675,27 +2392,21 @@ def index():
 
 @app.route("/api/status")
 def status():
-    with chat_server.lock:
-        # Get more detailed client info
-        clients_detailed = [
-            {
-                "username": info["username"],
-                "address": info["address"],
-                "connected_at": info["connected_at"],
-                "last_active": info["last_active"]
-            }
-            for info in chat_server.clients.values()
-        ]
-
-        return jsonify(
-            {
-                "client_count": len(chat_server.clients),
-                "clients": list(info["username"] for info in chat_server.clients.values()),
-                "clients_detailed": clients_detailed,
-                "logs": chat_server.logs,
-                "message_count": sum(1 for log in chat_server.logs if log["type"] == "MESSAGE")
-            }
-        )
+    # Serialise from a snapshot so no server lock is held through jsonify
+    return jsonify(chat_server.status_snapshot())
+
+
+@app.route("/api/locks")
+def lock_contention():
+    """Endpoint reporting wait/hold times per lock call site"""
+    top = request.args.get("top", default=10, type=int)
+    return jsonify({"locks": chat_server.lock_report(top)})
+
+
+@app.route("/api/locks/reset", methods=["POST"])
+def reset_lock_contention():
+    chat_server.reset_lock_stats()
+    return jsonify({"reset": True})
 
 
 @app.route("/api/logs")
@@ -716,8 +2427,9 @@ def serve_static(path):
     return send_from_directory(static_dir, path)
 
 
-def start_web_server():
-    app.run(host="0.0.0.0", port=8080, debug=False, threaded=True)
+def create_web_server(port=8080, fd=None):
+    """Build the dashboard server, optionally on a listening socket inherited from a reload"""
+    return make_server("0.0.0.0", port, app, threaded=True, fd=fd)
 
 
 def signal_handler(sig, frame):
@@ -726,29 +2438,144 @@ def signal_handler(sig, frame):
     sys.exit(0)
 
 
+def reload_signal_handler(sig, frame):
+    # Reloading blocks while clients drain, so keep it off the signal handler
+    reload_thread = Thread(target=reload_server)
+    reload_thread.daemon = True
+    reload_thread.start()
+
+
+def reload_server():
+    """Zero-downtime restart: hand the listening sockets and state to a new process, then drain"""
+    if not chat_server.accepting:
+        return  # Already reloading
+
+    chat_fd = chat_server.server_socket.fileno()
+    web_fd = web_server.socket.fileno()
+    ready_read, ready_write = os.pipe()
+    state_path = chat_server.write_handoff_state()
+
+    # The new process inherits both listening sockets and says when it is accepting on them
+    child = subprocess.Popen(
+        [
+            sys.executable, os.path.abspath(__file__),
+            "--host", chat_server.host,
+            "--port", str(chat_server.port),
+            "--dashboard-port", str(web_server.port),
+            "--node-id", chat_server.node_id,
+            "--data-dir", chat_server.state_dir,
+            "--inherit-fd", str(chat_fd),
+            "--dashboard-fd", str(web_fd),
+            "--state", state_path,
+            "--ready-fd", str(ready_write),
+            "--drain-period", str(chat_server.drain_period),
+            "--no-browser",
+        ] + (["--relay", f"{chat_server.relay.host}:{chat_server.relay.port}"] if chat_server.relay else []),
+        pass_fds=(chat_fd, web_fd, ready_write),
+    )
+    os.close(ready_write)
+
+    # Keep accepting here until the new process is up, so there is no gap
+    readable, _, _ = select.select([ready_read], [], [], 30)
+    ready = bool(readable) and os.read(ready_read, 1) == b"1"
+    os.close(ready_read)
+
+    if not ready:
+        chat_server.log_event("ERROR", f"Reload aborted, new process (pid {child.pid}) did not start")
+        child.kill()
+        if os.path.exists(state_path):
+            os.remove(state_path)
+        chat_server.cancel_handoff()
+        return
+
+    chat_server.log_event("SERVER", f"Reload: new process (pid {child.pid}) is accepting connections")
+
+    web_server.shutdown()
+    chat_server.drain()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Whisper Chat server")
+    parser.add_argument("--host", default="0.0.0.0", help="Chat server address")
+    parser.add_argument("--port", type=int, default=9999, help="Chat server port")
+    parser.add_argument("--dashboard-port", type=int, default=8080, help="Web dashboard port")
+    parser.add_argument("--no-browser", action="store_true", help="Don't open the dashboard in a browser")
+    parser.add_argument("--relay", metavar="HOST:PORT", help="Federation relay to join (see relay_v002.py)")
+    parser.add_argument("--node-id", help="Name of this server in the federation (default hostname:port)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="Capture inbound traffic to PATH (.gz to compress) for replay_v002.py")
+    parser.add_argument("--data-dir", metavar="PATH",
+                        help="Directory for saved state, the message archive and shared files (default ./state)")
+    parser.add_argument("--drain-period", type=float, default=5.0,
+                        help="Seconds over which clients are disconnected after a reload (SIGHUP)")
+    # Passed by a reloading server to the process taking over from it
+    parser.add_argument("--inherit-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--dashboard-fd", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--state", help=argparse.SUPPRESS)
+    parser.add_argument("--ready-fd", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+web_server = None
+
+
 def main():
+    global web_server
+
+    args = parse_args()
+    chat_server.host = args.host
+    chat_server.port = args.port
+    chat_server.node_id = args.node_id or f"{socket.gethostname()}:{args.port}"
+    chat_server.drain_period = args.drain_period
+    if args.data_dir:
+        chat_server.set_data_dir(os.path.abspath(args.data_dir))
+
     # Register signal handlers for graceful shutdown
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, reload_signal_handler)
+
+    # Pick up where a reloading server left off, or warm start from the last saved state
+    if args.state:
+        chat_server.load_handoff_state(args.state)
+    else:
+        chat_server.load_saved_state()
+
+    listen_socket = socket.socket(fileno=args.inherit_fd) if args.inherit_fd is not None else None
 
     # Start chat server
-    if not chat_server.start():
+    if not chat_server.start(listen_socket):
         print("Failed to start chat server. Exiting.")
         return
 
+    if args.record:
+        chat_server.start_recording(args.record)
+
+    if args.relay:
+        relay_host, _, relay_port = args.relay.rpartition(":")
+        chat_server.join_federation(relay_host or "localhost", int(relay_port))
+
     # Start web interface in a separate thread
-    web_thread = Thread(target=start_web_server)
+    web_server = create_web_server(args.dashboard_port, args.dashboard_fd)
+    web_thread = Thread(target=web_server.serve_forever)
     web_thread.daemon = True
     web_thread.start()
 
+    # Tell the server we are taking over from that it can start draining
+    if args.ready_fd is not None:
+        os.write(args.ready_fd, b"1")
+        os.close(args.ready_fd)
+
     # Open web browser
-    webbrowser.open("http://localhost:8080")
+    if not args.no_browser:
+        webbrowser.open(f"http://localhost:{args.dashboard_port}")
 
     print("Whisper Chat server is running. Press Ctrl+C to stop.")
 
     try:
-        # Keep the main thread alive
-        while True:
+        # Keep the main thread alive until shutdown or a completed reload
+        while chat_server.active:
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nShutting down server...")
@@ -757,4 +2584,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
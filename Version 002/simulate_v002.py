@@ -0,0 +1,528 @@
+import socket
+import json
+import time
+import random
+import hashlib
+import argparse
+import logging
+import sys
+import tempfile
+import shutil
+
+from server_v002 import ChatServer, FrameDecoder, encode_frame
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class VirtualClock:
+    """Stands in for time.time() so simulated minutes pass instantly"""
+
+    def __init__(self, start=1_000_000.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class SimClient:
+    """One simulated client: both ends of a socketpair plus what the client received"""
+
+    def __init__(self, name, index):
+        self.name = name
+        self.address = (f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}", 40000 + index % 20000)
+        self.client_end, self.server_end = socket.socketpair()
+        self.client_end.setblocking(False)
+        self.server_end.setblocking(False)
+        self.slow = False
+        self.server_decoder = FrameDecoder()
+        self.client_decoder = FrameDecoder()
+        self.session = None
+        self.server_closed = False  # The server side has hung up (or been dropped)
+        self.client_closed = False  # The client side has gone away
+        self.partitioned = False  # Gone without the server being told, like a pulled cable
+        self.received = 0
+        self.pings = 0
+        self.online = None  # Online count as tracked from roster and presence frames
+
+    def stop_reading(self):
+        """Become a consumer that never reads, with as little buffering as the OS allows"""
+        self.slow = True
+        self.server_end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.client_end.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+
+    def track(self, message):
+        self.received += 1
+        message_type = message.get("type")
+        if message_type == "ping":
+            self.pings += 1
+        elif message_type == "roster":
+            self.online = message["online"]
+        elif message_type == "presence":
+            self.online = message["online"]
+
+
+class Simulation:
+    """Drives ChatServer's connection handling over socketpairs on one thread
+
+    Nothing runs in the background: server input is pumped, presence flushed
+    and heartbeats checked only when the simulation steps, all against a
+    virtual clock. Runs with the same seed produce the same frames, which
+    the digest confirms.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.clock = VirtualClock()
+        # Simulated traffic is logged and saved in a temp dir, never in the source tree
+        self.temp_dir = tempfile.mkdtemp(prefix="whisper_sim_")
+        self.server = ChatServer(host="sim", port=0, node_id="sim", data_dir=self.temp_dir, logs_dir=self.temp_dir)
+        self.server.clock = self.clock
+        self.server.threaded_writers = False  # flush_writes() does their job in step order
+        self.server.logger.setLevel(logging.WARNING)
+        self.clients = []
+        self.live = {}  # {name: SimClient} still connected from the client's side
+        self.digest = hashlib.sha256()
+        self.next_presence = self.clock() + self.server.presence_interval
+        self.next_heartbeat = self.clock() + self.server.heartbeat_interval
+        self.server_time = 0.0  # Wall time spent inside server code
+
+    # Client actions
+
+    def connect(self, name):
+        client = SimClient(name, len(self.clients))
+        self.clients.append(client)
+        self.live[name] = client
+        client.client_end.sendall(encode_frame({"type": "connect", "username": name}))
+        return client
+
+    def send(self, client, message):
+        client.client_end.sendall(encode_frame(message))
+
+    def leave(self, client, graceful=True):
+        """Disconnect from the client side, with or without a disconnect frame"""
+        if graceful:
+            self.send(client, {"type": "disconnect"})
+        client.client_end.close()
+        client.client_closed = True
+        self.live.pop(client.name, None)
+
+    def partition(self, client):
+        """Vanish without the server seeing EOF; only a failed send will notice"""
+        client.partitioned = True
+        self.leave(client, graceful=False)
+
+    # Server side, mirroring ChatServer.handle_client
+
+    def pump_server(self):
+        started = time.perf_counter()
+        for client in self.clients:
+            if client.server_closed or client.partitioned:
+                continue
+            if client.server_end.fileno() == -1:
+                client.server_closed = True  # Dropped by the server itself
+                continue
+
+            while not client.server_closed:
+                try:
+                    data = client.server_end.recv(65536)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self.hang_up(client)
+                    break
+
+                if not data:
+                    self.hang_up(client)
+                    break
+                self.handle_data(client, data)
+        self.server_time += time.perf_counter() - started
+
+    def handle_data(self, client, data):
+        server = self.server
+        try:
+            messages = client.server_decoder.feed(data)
+            if client.session is None:
+                if not messages:
+                    return
+                first = messages.pop(0)
+                if first["type"] != "connect":
+                    self.hang_up(client)
+                    return
+                client.session = server.open_session(client.server_end, client.address, first["username"])
+            else:
+                client.session.note_activity(self.clock())
+                client.session.bytes_in += len(data)
+
+            for message in messages:
+                client.session.messages_in += 1
+                if not server.process_message(client.session, message):
+                    self.hang_up(client)
+                    return
+        except Exception as e:
+            server.log_event("ERROR", f"Error handling client {client.name}: {e}")
+            self.hang_up(client)
+
+    def flush_writes(self):
+        """Do the writer threads' job: move queued frames onto sockets that have room"""
+        started = time.perf_counter()
+        for client in self.clients:
+            session = client.session
+            if session is None or client.server_end.fileno() == -1:
+                continue
+
+            queue = session.queue
+            while True:
+                item = queue.pop()
+                if item is None:
+                    break
+
+                lane, data = item
+                try:
+                    sent = client.server_end.send(data)
+                except BlockingIOError:
+                    queue.put_back(lane, data)
+                    break
+                except OSError:
+                    self.server.drop_session(session, "connection error")
+                    break
+
+                queue.task_done(lane, sent, frame_finished=sent == len(data))
+                if sent < len(data):
+                    queue.put_back(lane, data[sent:])
+                    break
+        self.server_time += time.perf_counter() - started
+
+    def hang_up(self, client):
+        client.server_closed = True
+        if client.session:
+            self.server.drop_session(client.session)
+        client.server_end.close()
+
+    # Client side
+
+    def drain_clients(self):
+        for client in self.clients:
+            if client.slow or client.client_closed:
+                continue
+            while True:
+                try:
+                    data = client.client_end.recv(65536)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    data = b""
+
+                if not data:
+                    client.client_end.close()
+                    client.client_closed = True
+                    self.live.pop(client.name, None)
+                    break
+
+                for message in client.client_decoder.feed(data):
+                    client.track(message)
+                    if message["type"] == "ping":
+                        # Healthy clients answer the heartbeat, as the real ones do
+                        client.client_end.sendall(encode_frame({"type": "pong", "sent": message.get("sent")}))
+                    message.pop("timestamp", None)
+                    self.digest.update(client.name.encode("utf-8"))
+                    self.digest.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+
+    # Time
+
+    def step(self):
+        self.pump_server()
+        self.flush_writes()
+        self.drain_clients()
+
+    def advance(self, seconds, tick=0.1):
+        """Move the virtual clock forward, running timers as they fall due"""
+        end = self.clock() + seconds
+        while self.clock() < end:
+            self.clock.advance(min(tick, end - self.clock()))
+            self.step()
+
+            started = time.perf_counter()
+            if self.clock() >= self.next_presence:
+                self.server.flush_presence()
+                self.next_presence += self.server.presence_interval
+            if self.clock() >= self.next_heartbeat:
+                self.server.check_heartbeats()
+                self.next_heartbeat += self.server.heartbeat_interval
+            self.server_time += time.perf_counter() - started
+
+            self.flush_writes()
+            self.drain_clients()
+
+    def check_invariants(self, observer):
+        """Registry, sockets and what clients were told must all agree"""
+        problems = []
+        registered = self.server.clients.snapshot()
+
+        for session in registered:
+            if session.socket.fileno() == -1:
+                problems.append(f"{session.username} is registered with a closed socket")
+
+        if observer.online is not None and observer.online != len(registered):
+            problems.append(f"observer counts {observer.online} online, server has {len(registered)}")
+
+        connected = sum(1 for client in self.clients if client.session and not client.server_closed
+                        and client.session.socket.fileno() != -1)
+        if connected != len(registered):
+            problems.append(f"{connected} open sessions but {len(registered)} registered")
+
+        return problems
+
+    def close(self):
+        for client in self.clients:
+            for end in (client.client_end, client.server_end):
+                try:
+                    end.close()
+                except OSError:
+                    pass
+        self.server.active = False
+
+        for handler in list(self.server.logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                self.server.logger.removeHandler(handler)
+                handler.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+
+def connect_many(sim, count, prefix="user", batch=100):
+    clients = []
+    for index in range(count):
+        clients.append(sim.connect(f"{prefix}{index}"))
+        # Drain between batches so rosters never fill the socket buffers
+        if (index + 1) % batch == 0:
+            sim.advance(0.1)
+    sim.advance(sim.server.presence_interval * 2)
+    return clients
+
+
+# Scenarios
+
+def scenario_fanout(sim, args):
+    """Broadcast cost as the number of recipients grows"""
+    started = time.perf_counter()
+    clients = connect_many(sim, args.clients)
+    connect_time = time.perf_counter() - started
+
+    sim.server_time = 0.0
+    for number in range(args.messages):
+        sender = sim.random.choice(clients)
+        sim.send(sender, {"type": "message", "content": f"message {number}"})
+        sim.step()
+
+    deliveries = args.clients * args.messages
+    return {
+        "clients": args.clients,
+        "messages": args.messages,
+        "connect_s": connect_time,
+        "broadcast_ms": sim.server_time / args.messages * 1000,
+        "per_recipient_us": sim.server_time / deliveries * 1e6,
+        "delivered": sum(client.received for client in clients),
+    }
+
+
+def scenario_heartbeat(sim, args):
+    """Vanished clients are found by the heartbeat; idle but healthy ones are only pinged"""
+    clients = connect_many(sim, args.clients)
+    observer = clients[0]
+    rest = clients[1:]
+    sim.random.shuffle(rest)
+
+    third = len(rest) // 3
+    vanished, idle, active = rest[:third], rest[third:2 * third], rest[2 * third:] + [observer]
+
+    for client in vanished:
+        sim.partition(client)
+
+    # Active clients only ping, so no broadcast stumbles on the dead sockets first.
+    # Each pings every 30 seconds, spread out so no one tick floods the buffers
+    dropped_at = {}
+    elapsed = 0.0
+    while elapsed < args.duration:
+        for second in range(30):
+            for client in active[second::30]:
+                sim.send(client, {"type": "ping"})
+            sim.advance(1.0, tick=0.5)
+            elapsed += 1.0
+            for client in vanished:
+                if client.name not in dropped_at and client.session.socket.fileno() == -1:
+                    dropped_at[client.name] = elapsed
+
+    timeout = sim.server.inactive_timeout + sim.server.heartbeat_interval + sim.server.default_pong_wait
+    return {
+        "clients": args.clients,
+        "vanished": len(vanished),
+        "vanished_dropped": len(dropped_at),
+        "detect_s_max": max(dropped_at.values()) if dropped_at else None,
+        "detect_bound_s": timeout,
+        "idle_still_connected": sum(1 for client in idle if client.session.socket.fileno() != -1),
+        "idle_pings": sum(client.pings for client in idle),
+        "active_dropped": sum(1 for client in active if client.session.socket.fileno() == -1),
+        "problems": sim.check_invariants(observer),
+    }
+
+
+def scenario_slow(sim, args):
+    """Consumers that stop reading back up in their own queues until dropped; nobody else waits"""
+    sim.server.max_queue_bytes = args.queue_bytes
+    clients = connect_many(sim, args.clients)
+    for index in sim.random.sample(range(1, args.clients), min(args.slow, args.clients - 1)):
+        clients[index].stop_reading()
+    slow = [client for client in clients if client.slow]
+    fast = [client for client in clients if not client.slow]
+    before = {client.name: client.received for client in fast}
+
+    dropped_after = {}
+    for number in range(args.messages):
+        sender = sim.random.choice(fast)
+        sim.send(sender, {"type": "message", "content": "x" * args.size})
+        sim.step()
+        for client in slow:
+            if client.name not in dropped_after and client.session.socket.fileno() == -1:
+                dropped_after[client.name] = number + 1
+    sim.advance(sim.server.presence_interval * 2)
+
+    received = [client.received - before[client.name] for client in fast]
+    return {
+        "clients": args.clients,
+        "slow": len(slow),
+        "messages": args.messages,
+        "message_bytes": args.size,
+        "queue_bytes": args.queue_bytes,
+        "slow_dropped": len(dropped_after),
+        "slow_consumer_drops": sim.server.slow_consumer_drops,
+        "dropped_after_messages_min": min(dropped_after.values()) if dropped_after else None,
+        "dropped_after_messages_max": max(dropped_after.values()) if dropped_after else None,
+        "fast_min_received": min(received),
+        "problems": sim.check_invariants(fast[0]),
+    }
+
+
+def scenario_race(sim, args):
+    """Disconnects racing broadcasts, graceful leaves, drops and same-window rejoins"""
+    clients = connect_many(sim, args.clients)
+    observer = clients[0]
+    rejoins = 0
+
+    for round_number in range(args.rounds):
+        candidates = [client for client in sim.live.values() if client is not observer]
+        for client in sim.random.sample(candidates, min(len(candidates), args.churn)):
+            action = sim.random.random()
+            if action < 0.3:
+                sim.leave(client, graceful=True)
+            elif action < 0.6:
+                # Gone mid-broadcast: the fan-out hits the dead socket before EOF is read
+                sim.leave(client, graceful=False)
+                sim.send(observer, {"type": "message", "content": f"round {round_number}"})
+            elif action < 0.8:
+                # Leave and come straight back inside one presence window
+                sim.leave(client, graceful=sim.random.random() < 0.5)
+                rejoins += 1
+                sim.connect(client.name)
+            else:
+                sim.partition(client)
+                sim.server.drop_session(client.session, "timeout")
+        sim.advance(sim.server.presence_interval)
+
+    sim.advance(sim.server.presence_interval * 2)
+    return {
+        "clients": args.clients,
+        "rounds": args.rounds,
+        "rejoins": rejoins,
+        "online": len(sim.server.clients),
+        "observer_online": observer.online,
+        "problems": sim.check_invariants(observer),
+    }
+
+
+SCENARIOS = {
+    "fanout": scenario_fanout,
+    "heartbeat": scenario_heartbeat,
+    "slow": scenario_slow,
+    "race": scenario_race,
+}
+
+
+def raise_fd_limit(needed):
+    """Socketpairs use two descriptors per client; ask for more if the soft limit is short"""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= needed:
+        return
+    target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    if target < needed:
+        print(f"Warning: only {target} file descriptors available, {needed} wanted", file=sys.stderr)
+
+
+def run_scenario(name, args):
+    sim = Simulation(args.seed)
+    started = time.perf_counter()
+    try:
+        result = SCENARIOS[name](sim, args)
+    finally:
+        sim.close()
+    result["wall_s"] = time.perf_counter() - started
+    result["virtual_s"] = sim.clock() - VirtualClock().now
+    result["digest"] = sim.digest.hexdigest()[:16]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic in-process simulation of a Whisper Chat server")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS) + ["all"], help="What to simulate")
+    parser.add_argument("--clients", type=int, default=1000, help="Simulated clients")
+    parser.add_argument("--messages", type=int, default=100, help="Messages broadcast (fanout, slow)")
+    parser.add_argument("--slow", type=int, default=10, help="Clients that stop reading (slow)")
+    parser.add_argument("--size", type=int, default=1000, help="Message size in bytes (slow)")
+    parser.add_argument("--queue-bytes", type=int, default=64 * 1024,
+                        help="Outbound queue limit before a client counts as slow (slow)")
+    parser.add_argument("--duration", type=float, default=300, help="Virtual seconds to run (heartbeat)")
+    parser.add_argument("--rounds", type=int, default=50, help="Churn rounds (race)")
+    parser.add_argument("--churn", type=int, default=20, help="Clients acted on per round (race)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed; same seed, same run")
+    parser.add_argument("--verify", action="store_true", help="Run twice and check the runs are identical")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    names = sorted(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    rejoin_fds = 2 * args.rounds * args.churn if "race" in names else 0
+    raise_fd_limit(2 * args.clients + rejoin_fds + 64)
+    results = {}
+    failed = False
+
+    for name in names:
+        result = run_scenario(name, args)
+        if args.verify:
+            repeat = run_scenario(name, args)
+            result["deterministic"] = repeat["digest"] == result["digest"]
+            failed |= not result["deterministic"]
+        failed |= bool(result.get("problems"))
+        results[name] = result
+
+        if not args.json:
+            print(f"{name}:")
+            for key, value in result.items():
+                if isinstance(value, float):
+                    value = f"{value:.3f}"
+                print(f"  {key:<28} {value}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
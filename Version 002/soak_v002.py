@@ -0,0 +1,286 @@
+import socket
+import threading
+import json
+import time
+import os
+import sys
+import random
+import argparse
+import logging
+import tempfile
+import shutil
+import tracemalloc
+import gc
+
+from server_v002 import ChatServer, FrameDecoder, encode_frame
+
+
+def count_open_fds():
+    """Open file descriptors in this process, or None where /proc isn't available"""
+    for fd_dir in ("/proc/self/fd", "/dev/fd"):
+        if os.path.isdir(fd_dir):
+            return len(os.listdir(fd_dir))
+    return None
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class SoakClient(threading.Thread):
+    """Connects, chats and disconnects over and over until told to stop"""
+
+    def __init__(self, harness, index):
+        super().__init__(daemon=True)
+        self.harness = harness
+        self.index = index
+        self.random = random.Random(index)
+
+    def run(self):
+        while not self.harness.stopping.is_set():
+            # Paused while the harness takes a quiet baseline sample
+            self.harness.running.wait()
+            try:
+                self.cycle()
+                self.harness.record_cycle()
+            except OSError:
+                self.harness.record_error()
+                time.sleep(0.1)
+
+    def cycle(self):
+        harness = self.harness
+        client = socket.create_connection(("127.0.0.1", harness.port), timeout=5)
+        decoder = FrameDecoder()
+
+        try:
+            client.sendall(encode_frame({"type": "connect", "username": f"soak{self.index}"}))
+            self.drain(client, decoder, wait=0.05)
+
+            for number in range(self.random.randint(1, harness.messages_per_cycle)):
+                client.sendall(encode_frame({
+                    "type": "message",
+                    "content": f"soak message {number} from client {self.index}",
+                }))
+                # Keep reading so the server never blocks on our receive buffer
+                self.drain(client, decoder, wait=harness.message_gap)
+
+            # Exercise both the graceful and the abrupt way of leaving
+            if self.random.random() < 0.5:
+                client.sendall(encode_frame({"type": "disconnect"}))
+        finally:
+            client.close()
+
+    @staticmethod
+    def drain(client, decoder, wait):
+        client.settimeout(wait)
+        try:
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    return
+                decoder.feed(data)
+        except socket.timeout:
+            pass
+
+
+class SoakHarness:
+    """Long-running churn against an in-process ChatServer, watching for leaks
+
+    Memory (tracemalloc), thread and file descriptor counts are sampled at
+    intervals. The run fails if traced memory grows faster than a threshold
+    per connect/chat/disconnect cycle, or if threads or FDs keep piling up.
+    """
+
+    def __init__(self, clients=20, messages_per_cycle=5, message_gap=0.01, trace_frames=1):
+        self.clients = clients
+        self.messages_per_cycle = messages_per_cycle
+        self.message_gap = message_gap
+        self.trace_frames = trace_frames
+        self.stopping = threading.Event()
+        self.running = threading.Event()
+        self.lock = threading.Lock()
+        self.cycles = 0
+        self.errors = 0
+        self.samples = []
+        self.server = None
+        self.port = None
+
+    def record_cycle(self):
+        with self.lock:
+            self.cycles += 1
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def start_server(self):
+        self.state_dir = tempfile.mkdtemp(prefix="whisper_soak_")
+        # Its chat log goes in the temp dir too, so an hour of churn leaves nothing behind
+        self.server = ChatServer(host="127.0.0.1", port=0, data_dir=self.state_dir, logs_dir=self.state_dir)
+        self.server.logger.setLevel(logging.CRITICAL)  # Abrupt disconnects are expected here
+        if not self.server.start():
+            raise RuntimeError("Could not start chat server")
+        self.port = self.server.port
+
+    def sample(self):
+        # Sessions and queues caught in reference cycles are garbage, not growth
+        gc.collect()
+
+        with self.lock:
+            cycles = self.cycles
+            errors = self.errors
+
+        traced, peak = tracemalloc.get_traced_memory()
+        sample = {
+            "time": time.time(),
+            "cycles": cycles,
+            "errors": errors,
+            "traced_bytes": traced,
+            "traced_peak_bytes": peak,
+            "rss_bytes": rss_bytes(),
+            "threads": threading.active_count(),
+            "fds": count_open_fds(),
+            "sessions": len(self.server.clients),
+            "snapshot": tracemalloc.take_snapshot(),
+        }
+        self.samples.append(sample)
+        return sample
+
+    def quiesce(self, expected_threads, timeout=10.0):
+        """Wait for the server to finish cleaning up connections after the clients pause or stop"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if len(self.server.clients) == 0 and threading.active_count() <= expected_threads:
+                break
+            time.sleep(0.1)
+        time.sleep(self.server.presence_interval * 2)
+
+    def run(self, duration, interval, warmup):
+        tracemalloc.start(self.trace_frames)
+        self.start_server()
+        time.sleep(0.5)
+        self.idle_threads = threading.active_count()
+
+        workers = [SoakClient(self, index) for index in range(self.clients)]
+        self.running.set()
+        for worker in workers:
+            worker.start()
+
+        started = time.time()
+        time.sleep(warmup)
+
+        # Both the baseline and the final sample are taken with no connections
+        # open, so anything still allocated at the end was left behind
+        self.running.clear()
+        self.quiesce(self.idle_threads + self.clients)
+        baseline = self.sample()
+        self.print_sample(baseline, started)
+        self.running.set()
+
+        next_sample = time.time() + interval
+        while time.time() - started < duration:
+            time.sleep(max(0.0, min(next_sample, started + duration) - time.time()))
+            if time.time() >= next_sample:
+                self.print_sample(self.sample(), started)
+                next_sample += interval
+
+        self.stopping.set()
+        self.running.set()
+        for worker in workers:
+            worker.join(timeout=10)
+
+        self.quiesce(self.idle_threads)
+        final = self.sample()
+        self.print_sample(final, started)
+
+        self.server.shutdown()
+        for handler in list(self.server.logger.handlers):
+            if isinstance(handler, logging.FileHandler):
+                self.server.logger.removeHandler(handler)
+                handler.close()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        tracemalloc.stop()
+        return baseline, final
+
+    def print_sample(self, sample, started):
+        fds = "n/a" if sample["fds"] is None else sample["fds"]
+        rss = "n/a" if sample["rss_bytes"] is None else f"{sample['rss_bytes'] / 1048576:.1f} MiB"
+        print(
+            f"[{time.time() - started:8.0f}s] cycles {sample['cycles']:>8}  "
+            f"traced {sample['traced_bytes'] / 1048576:8.2f} MiB  rss {rss}  "
+            f"threads {sample['threads']:>4}  fds {fds}  sessions {sample['sessions']}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test a Whisper Chat server for memory and resource leaks")
+    parser.add_argument("--duration", type=float, default=3600, help="Seconds of churn (default one hour)")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between samples")
+    parser.add_argument("--warmup", type=float, default=30, help="Seconds of churn before the baseline sample")
+    parser.add_argument("--clients", type=int, default=20, help="Concurrent churning clients")
+    parser.add_argument("--messages", type=int, default=5, help="Most messages a client sends per cycle")
+    parser.add_argument("--max-growth-per-cycle", type=float, default=64.0,
+                        help="Allowed traced memory growth in bytes per connection cycle")
+    parser.add_argument("--max-thread-growth", type=int, default=2, help="Allowed extra threads at the end")
+    parser.add_argument("--max-fd-growth", type=int, default=4, help="Allowed extra open FDs at the end")
+    parser.add_argument("--top", type=int, default=10, help="Growing allocation sites to list")
+    parser.add_argument("--trace-frames", type=int, default=1, help="Stack frames tracemalloc keeps")
+    parser.add_argument("--report", metavar="PATH", help="Save the samples and verdict as JSON")
+    args = parser.parse_args()
+
+    harness = SoakHarness(args.clients, args.messages, trace_frames=args.trace_frames)
+    baseline, final = harness.run(args.duration, args.interval, args.warmup)
+
+    cycles = final["cycles"] - baseline["cycles"]
+    growth = final["traced_bytes"] - baseline["traced_bytes"]
+    growth_per_cycle = growth / cycles if cycles else 0.0
+    thread_growth = final["threads"] - baseline["threads"] + harness.clients  # Workers have exited
+    fd_growth = None
+    if final["fds"] is not None and baseline["fds"] is not None:
+        fd_growth = final["fds"] - baseline["fds"]
+
+    print()
+    print(f"{cycles} cycles since baseline, {final['errors']} client errors")
+    print(f"Traced memory grew {growth / 1024:.1f} KiB, {growth_per_cycle:.1f} bytes per cycle")
+    print(f"Thread growth {thread_growth}, FD growth {'n/a' if fd_growth is None else fd_growth}")
+
+    print(f"\nTop {args.top} growing allocation sites:")
+    for stat in final["snapshot"].compare_to(baseline["snapshot"], "lineno")[:args.top]:
+        print(f"  {stat}")
+
+    failures = []
+    if growth_per_cycle > args.max_growth_per_cycle:
+        failures.append(f"memory growth {growth_per_cycle:.1f} B/cycle > {args.max_growth_per_cycle:g}")
+    if thread_growth > args.max_thread_growth:
+        failures.append(f"thread growth {thread_growth} > {args.max_thread_growth}")
+    if fd_growth is not None and fd_growth > args.max_fd_growth:
+        failures.append(f"FD growth {fd_growth} > {args.max_fd_growth}")
+
+    if args.report:
+        report = {
+            "cycles": cycles,
+            "growth_bytes": growth,
+            "growth_per_cycle": growth_per_cycle,
+            "thread_growth": thread_growth,
+            "fd_growth": fd_growth,
+            "failures": failures,
+            "samples": [
+                {key: value for key, value in sample.items() if key != "snapshot"}
+                for sample in harness.samples
+            ],
+        }
+        with open(args.report, "w", encoding="utf-8") as report_file:
+            json.dump(report, report_file, indent=2)
+
+    if failures:
+        print("\nFAIL: " + "; ".join(failures))
+        sys.exit(1)
+    print("\nPASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,14 +10,30 @@ function updateDashboard() {
             const clientsList = document.getElementById('clients-list');
             clientsList.innerHTML = '';
 
-            data.clients.forEach(client => {
+            data.clients_detailed.forEach(client => {
                 const row = document.createElement('tr');
-                const cell = document.createElement('td');
-                cell.textContent = client;
-                row.appendChild(cell);
+                [
+                    client.username,
+                    formatMilliseconds(client.rtt_ms),
+                    formatMilliseconds(client.jitter_ms),
+                    formatMilliseconds(client.client_rtt_ms),
+                ].forEach(value => {
+                    const cell = document.createElement('td');
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
                 clientsList.appendChild(row);
             });
 
+            // Update federation peer links
+            updateFederation(data.node_id, data.federation);
+
+            // Update activity chart
+            updateActivityChart(data.series);
+
+            // Update outbound lane counters
+            updateLanes(data.lanes);
+
             // Update logs
             const logsList = document.getElementById('logs-list');
             logsList.innerHTML = '';
@@ -47,6 +63,124 @@ function updateDashboard() {
         });
 }
 
+// Function to show this node's relay link and the lag to each peer
+function updateFederation(nodeId, federation) {
+    const panel = document.getElementById('federation-panel');
+    if (!federation) {
+        panel.hidden = true;
+        return;
+    }
+
+    panel.hidden = false;
+    document.getElementById('node-id').textContent = nodeId;
+    document.getElementById('relay-status').textContent =
+        `${federation.relay} (${federation.connected ? 'connected' : 'disconnected'}` +
+        (federation.backlog ? `, ${federation.backlog} queued)` : ')');
+
+    const peersList = document.getElementById('peers-list');
+    peersList.innerHTML = '';
+
+    federation.peers.forEach(peer => {
+        const row = document.createElement('tr');
+        [
+            peer.node_id,
+            peer.frames,
+            peer.lag_ms === null ? '-' : peer.lag_ms.toFixed(1),
+            peer.last_lag_ms === null ? '-' : peer.last_lag_ms.toFixed(1),
+            peer.last_seen === null ? '-' : new Date(peer.last_seen * 1000).toLocaleTimeString()
+        ].forEach(value => {
+            const cell = document.createElement('td');
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        peersList.appendChild(row);
+    });
+}
+
+// Function to scale a list of values into SVG polyline points
+function toPoints(values, width, height) {
+    const max = Math.max(1, ...values);
+    const step = values.length > 1 ? width / (values.length - 1) : 0;
+    return values
+        .map((value, i) => `${(i * step).toFixed(1)},${(height - (value / max) * height).toFixed(1)}`)
+        .join(' ');
+}
+
+// Round-trip times are unknown until the first ping has been answered
+function formatMilliseconds(value) {
+    return value === null || value === undefined ? '\u2014' : `${value.toFixed(1)} ms`;
+}
+
+// Function to draw clients and message rate from the server's time series
+function updateActivityChart(series) {
+    if (!series) {
+        return;
+    }
+
+    const clients = series.map(sample => sample[1]);
+    const messages = series.slice(1).map((sample, i) => Math.max(0, sample[2] - series[i][2]));
+
+    document.getElementById('clients-line').setAttribute('points', toPoints(clients, 600, 120));
+    document.getElementById('messages-line').setAttribute('points', toPoints(messages, 600, 120));
+}
+
+// Function to show frames sent and waiting in each outbound priority lane
+function updateLanes(lanes) {
+    if (!lanes) {
+        return;
+    }
+
+    document.getElementById('lanes-queued-bytes').textContent = lanes.queued_bytes;
+    document.getElementById('slow-consumer-drops').textContent = lanes.slow_consumer_drops;
+
+    const lanesList = document.getElementById('lanes-list');
+    lanesList.innerHTML = '';
+
+    ['control', 'live', 'backfill'].forEach(lane => {
+        const row = document.createElement('tr');
+        [lane, lanes.sent[lane] || 0, lanes.queued[lane] || 0].forEach(value => {
+            const cell = document.createElement('td');
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        lanesList.appendChild(row);
+    });
+}
+
+// Function to update the lock contention table
+function updateLocks() {
+    fetch('/api/locks?top=10')
+        .then(response => response.json())
+        .then(data => {
+            const locksList = document.getElementById('locks-list');
+            locksList.innerHTML = '';
+
+            data.locks.forEach(entry => {
+                const row = document.createElement('tr');
+
+                const siteCell = document.createElement('td');
+                siteCell.textContent = `${entry.lock}: ${entry.site}`;
+                row.appendChild(siteCell);
+
+                [
+                    entry.acquisitions,
+                    entry.wait_avg_ms.toFixed(3),
+                    entry.wait_max_ms.toFixed(3),
+                    entry.hold_avg_ms.toFixed(3),
+                    entry.hold_max_ms.toFixed(3)
+                ].forEach(value => {
+                    const cell = document.createElement('td');
+                    cell.textContent = value;
+                    row.appendChild(cell);
+                });
+
+                locksList.appendChild(row);
+            });
+        });
+}
+
 // Update dashboard initially and every 2 seconds
 updateDashboard();
-setInterval(updateDashboard, 2000);
\ No newline at end of file
+updateLocks();
+setInterval(updateDashboard, 2000);
+setInterval(updateLocks, 2000);
\ No newline at end of file